@@ -0,0 +1,178 @@
+import os, sys, csv, json, time, random, tempfile, threading, tracemalloc
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import snuffleupghus
+from fake_ckan import FakeCKAN
+
+# An offline benchmark harness: Synthetic BigBurgh exports (with the real
+# headers) are generated at each size, served from a local HTTP server
+# standing in for bigburgh.com, and run through parse_file, schema loading,
+# transmit, and the full main, against a FakeCKAN instead of a real CKAN.
+#
+# Usage: python benchmark.py [number of rows ...]
+#   (The default sizes are 1000, 100000, and 1000000 rows.)
+
+DEFAULT_SIZES = [1000, 100000, 1000000]
+BENCHMARK_SERVER = 'benchmark' # The name of the fake server in the generated settings file
+table_prefixes = {'events': '(Event)', 'safePlaces': '(Safe Place)', 'services': '(Service)'}
+neighborhoods = ['Bloomfield', 'Downtown', 'East Liberty', 'Hazelwood', 'Hill District', 'Oakland', 'South Side Flats']
+categories = ['Food', 'Shelter', 'Health', 'Work', 'Help', 'Hygiene', '']
+
+# Words that bigburgh.com's headers leave in lower case (as in "Program Lat and Long")
+lower_case_words = ['and', 'or', 'for']
+
+def raw_headers(table):
+    # Reconstruct the headers of a BigBurgh export (like "Event Name" and
+    # "Program Lat and Long") from the table's schema fields, undoing the
+    # header replacements and the renaming that read_export does.
+    inverse = {}
+    for header, replacement in snuffleupghus.replacement_headers.items():
+        if not header.startswith('(') or header.startswith(table_prefixes[table]):
+            inverse[replacement] = header
+    names = []
+    for name, _, _ in snuffleupghus.table_registry[table]['fields']:
+        if name == 'latitude':
+            names.append('program_lat_and_long')
+        elif name == 'category':
+            names += ['category_one', 'category_two']
+        elif name != 'longitude':
+            names.append(name)
+    return [inverse.get(name) or " ".join(word if word in lower_case_words else word.title()
+        for word in name.split('_')) for name in names]
+
+def synthetic_value(table, header, i, rng):
+    field = snuffleupghus.replacement_headers.get(header, snuffleupghus.schema_header(header))
+    if field == 'program_lat_and_long':
+        double_comma = snuffleupghus.table_registry[table].get('double_comma_coordinates')
+        separator = ',,' if double_comma and i % 1009 == 0 else ',' # The occasional ",," that services tolerates
+        return "Latitude: {:.6f}{} Longitude: {:.6f}".format(rng.uniform(40.36, 40.50), separator, rng.uniform(-80.09, -79.86))
+    if field in ['category_one', 'category_two']:
+        return rng.choice(categories)
+    if field == 'program_neighborhood':
+        return rng.choice(neighborhoods)
+    if field.endswith('_name'):
+        return "{} {}".format(field.split('_')[0].title(), i % 5000) # Names repeat, as they do in the real exports.
+    if field == 'program_address':
+        return "{} Main St".format(i % 3000)
+    if field.endswith('phone'):
+        return "412-555-{:04d}".format(i % 10000)
+    if field.endswith('narrative'):
+        return "Synthetic description number {}, with a comma.".format(i)
+    return "{} {}".format(field, i % 50)
+
+def write_synthetic_export(table, filepath, rows, seed=0):
+    # Write a pipe-delimited export in the same layout as bigburgh.com's.
+    rng = random.Random(seed)
+    headers = raw_headers(table)
+    with open(filepath, 'w', newline='') as f:
+        f.write('sep=|\n')
+        writer = csv.writer(f, delimiter='|', quotechar='"', lineterminator='\n')
+        writer.writerow(headers)
+        for i in range(rows):
+            writer.writerow([synthetic_value(table, header, i, rng) for header in headers])
+
+def serve_directory(directory):
+    # Serve a directory over HTTP (with Last-Modified and If-Modified-Since
+    # support) from a background thread. Returns the server and its URL.
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def timed(results, label, function, *args, **kwargs):
+    start = time.time()
+    value = function(*args, **kwargs)
+    results[label] = round(time.time() - start, 3)
+    print("  {:<32} {:>9.3f} s".format(label, results[label]))
+    return value
+
+def measured(results, label, function, *args, **kwargs):
+    # Record the memory held (in MB) by what the function returns.
+    tracemalloc.start()
+    try:
+        value = function(*args, **kwargs)
+        held, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    results[label] = round(held/1024**2, 1)
+    print("  {:<32} {:>9.1f} MB".format(label, results[label]))
+    return value
+
+def dict_rows(filepath):
+    # The rows of a tmp CSV file as a list of dicts, which is how shelves
+    # used to be kept.
+    with open(filepath, newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+def benchmark(size, workdir, batch_size=10000):
+    # Run every stage at one size and return the timings (in seconds).
+    results = {'rows': size}
+    workdir = os.path.join(workdir, str(size))
+    export_directory = os.path.join(workdir, 'exports')
+    os.makedirs(os.path.join(export_directory, 'tmp'), exist_ok=True) # parse_file writes next to the export.
+    os.makedirs(os.path.join(workdir, 'tmp', 'tmp'), exist_ok=True) # main downloads to tmp/ and parses into tmp/tmp/.
+    snuffleupghus.DATA_PATH = os.path.join(workdir, 'data')
+    print("{} rows per table:".format(size))
+    for table in snuffleupghus.table_registry:
+        write_synthetic_export(table, os.path.join(export_directory, table + '.csv'), size)
+
+    with FakeCKAN() as ckan:
+        settings_path = os.path.join(workdir, 'settings.json')
+        with open(settings_path, 'w') as f:
+            json.dump({'loader': {BENCHMARK_SERVER: {'ckan_root_url': ckan.site,
+                'package_id': ckan.package_id, 'ckan_api_key': 'benchmark'}}}, f)
+        snuffleupghus.SETTINGS_FILE = settings_path
+        snuffleupghus.set_upload_batching(batch_size)
+
+        table = 'events'
+        export_path = os.path.join(export_directory, table + '.csv')
+        _, _, tmp_path = timed(results, 'parse_file', snuffleupghus.parse_file, export_path, table, True)
+        timed(results, 'parse_file (in memory)', snuffleupghus.parse_file, export_path, table)
+        shelf = measured(results, 'shelf memory', lambda: snuffleupghus.parse_file(export_path, table)[0])
+        rows = measured(results, 'dict rows memory', dict_rows, tmp_path)
+        assert len(shelf) == len(rows) == size
+        del shelf, rows
+        def load_through_schema():
+            with open(tmp_path, newline='') as f:
+                return sum(1 for _ in snuffleupghus.transform_rows(snuffleupghus.schema_dict[table], csv.DictReader(f)))
+        timed(results, 'schema load', load_through_schema)
+        processes = max(os.cpu_count() or 1, 2)
+        snuffleupghus.set_validation_processes(processes)
+        try:
+            timed(results, 'schema load ({} processes)'.format(processes), load_through_schema)
+        finally:
+            snuffleupghus.set_validation_processes(None)
+        timed(results, 'transmit', snuffleupghus.transmit, target=tmp_path, update_method='insert',
+            schema=snuffleupghus.schema_dict[table], fields_to_publish=snuffleupghus.ckan_fields[table],
+            key_fields=[], resource_name='Benchmark Transmit', server=BENCHMARK_SERVER)
+
+        httpd, base_url = serve_directory(export_directory)
+        snuffleupghus.BIGBURGH_URL = base_url + '/{}.csv'
+        try:
+            failures = timed(results, 'main (three tables)', snuffleupghus.main, fetch_files=True,
+                server=BENCHMARK_SERVER, mute_alerts=True, force=True, batch_size=batch_size,
+                report_path=os.path.join(workdir, 'run-report.json'))
+            failures += timed(results, 'main (streamed downloads)', snuffleupghus.main, fetch_files=True,
+                server=BENCHMARK_SERVER, mute_alerts=True, force=True, batch_size=batch_size,
+                stream_download=True, report_path=os.path.join(workdir, 'run-report-streamed.json'))
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+        if failures:
+            raise RuntimeError("main failed on the benchmark data: {}".format(failures))
+        results['ckan_calls'] = dict(ckan.calls)
+        results['rows_received'] = sum(ckan.rows_received.values())
+    return results
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    all_results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            all_results.append(benchmark(size, workdir))
+    print(json.dumps(all_results, indent=4))
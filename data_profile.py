@@ -0,0 +1,144 @@
+from collections import Counter
+
+PITTSBURGH_BOUNDS = (40.36, 40.51, -80.10, -79.86) # (south, north, west, east), with a little room around the city limits
+MAX_EXAMPLES = 5 # Examples kept of each kind of problem
+MAX_REPORTED_CATEGORIES = 20
+
+# The thresholds that block publishing, where None turns a check off. By
+# default, only malformed coordinates are blocked (since the schemas'
+# pre_load hooks always failed on them, which stopped the table from being
+# published). Every other check is opt-in.
+#   min_rows: the fewest rows an export may have
+#   malformed_coordinates: the most coordinates that may fail to parse
+#   empty_name_fraction: the largest fraction of rows that may have an empty name
+#   missing_coordinates_fraction: the largest fraction of rows that may lack coordinates
+#   out_of_bounds_fraction: the largest fraction of the points that may be outside the bounds
+#   duplicate_name_fraction: the largest fraction of rows that may repeat an earlier row's name
+#   max_categories: the most distinct categories there may be
+#   null_rates: the largest null rate allowed for each of the given fields
+DEFAULT_THRESHOLDS = {
+    'min_rows': None,
+    'malformed_coordinates': 0,
+    'empty_name_fraction': None,
+    'missing_coordinates_fraction': None,
+    'out_of_bounds_fraction': None,
+    'duplicate_name_fraction': None,
+    'max_categories': None,
+    'null_rates': {},
+}
+
+class DataQualityError(ValueError):
+    pass
+
+class DataProfile:
+    """Profiles the rows of an export in the same pass that parses them:
+    the null rate of each column, the coordinates that couldn't be parsed
+    (which parse_coordinates adds to malformed_coordinates, instead of
+    raising), the points outside the bounds (PITTSBURGH_BOUNDS, by
+    default), the names (the values of name_field) that repeat, and the
+    number of distinct categories (splitting the |-delimited ones).
+
+    Rows are profiled as they pass through observe. as_dict gives the
+    results (for the run report), and problems lists the thresholds
+    (see DEFAULT_THRESHOLDS) that the export fails."""
+
+    def __init__(self, name_field=None, bounds=PITTSBURGH_BOUNDS, category_field='category'):
+        self.name_field = name_field
+        self.bounds = bounds
+        self.category_field = category_field
+        self.rows = 0
+        self.fields = []
+        self.nulls = Counter()
+        self.malformed_coordinates = []
+        self.points = 0
+        self.out_of_bounds = 0
+        self.out_of_bounds_examples = []
+        self.names = Counter()
+        self.categories = Counter()
+
+    def observe(self, rows):
+        # Profile the rows (dicts) as they pass through.
+        for row in rows:
+            self.add(row)
+            yield row
+
+    def add(self, row):
+        self.rows += 1
+        if self.rows == 1:
+            self.fields = list(row)
+        for field, value in row.items():
+            if value is None or value == '':
+                self.nulls[field] += 1
+        latitude, longitude = row.get('latitude'), row.get('longitude')
+        if latitude not in [None, ''] and longitude not in [None, '']:
+            self.points += 1
+            latitude, longitude = float(latitude), float(longitude)
+            south, north, west, east = self.bounds
+            if not (south <= latitude <= north and west <= longitude <= east):
+                self.out_of_bounds += 1
+                if len(self.out_of_bounds_examples) < MAX_EXAMPLES:
+                    self.out_of_bounds_examples.append({'name': row.get(self.name_field),
+                        'latitude': latitude, 'longitude': longitude})
+        if self.name_field is not None:
+            self.names[row.get(self.name_field)] += 1
+        if row.get(self.category_field):
+            self.categories.update(row[self.category_field].split('|'))
+
+    def duplicate_names(self):
+        # The number of rows whose name was already used by an earlier row
+        return sum(count - 1 for name, count in self.names.items() if count > 1 and name not in [None, ''])
+
+    def as_dict(self):
+        rows = max(self.rows, 1)
+        return {'rows': self.rows,
+                'null_rates': {field: round(self.nulls[field]/rows, 4) for field in self.fields},
+                'malformed_coordinates': len(self.malformed_coordinates),
+                'malformed_coordinate_examples': self.malformed_coordinates[:MAX_EXAMPLES],
+                'points': self.points,
+                'out_of_bounds': self.out_of_bounds,
+                'out_of_bounds_examples': self.out_of_bounds_examples,
+                'duplicate_names': self.duplicate_names(),
+                'most_repeated_names': [[name, count] for name, count in self.names.most_common(MAX_EXAMPLES)
+                                        if count > 1 and name not in [None, '']],
+                'category_cardinality': len(self.categories),
+                'categories': dict(self.categories.most_common(MAX_REPORTED_CATEGORIES))}
+
+    def problems(self, thresholds=None):
+        # Describe each threshold that the export fails (thresholds missing
+        # from the given dict default to those in DEFAULT_THRESHOLDS).
+        thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+        rows = max(self.rows, 1)
+        problems = []
+        if thresholds['min_rows'] is not None and self.rows < thresholds['min_rows']:
+            problems.append("only {} rows (the minimum is {})".format(self.rows, thresholds['min_rows']))
+        if thresholds['malformed_coordinates'] is not None and len(self.malformed_coordinates) > thresholds['malformed_coordinates']:
+            problems.append("{} malformed coordinates, like {!r}".format(len(self.malformed_coordinates), self.malformed_coordinates[0]))
+        empty_names = self.nulls[self.name_field]/rows if self.name_field is not None else 0
+        if self.rows > 0 and thresholds['empty_name_fraction'] is not None and empty_names > thresholds['empty_name_fraction']:
+            problems.append("{:.1%} of the rows have no {}".format(empty_names, self.name_field))
+        missing = (self.rows - self.points)/rows
+        if self.rows > 0 and thresholds['missing_coordinates_fraction'] is not None and missing > thresholds['missing_coordinates_fraction']:
+            problems.append("{:.1%} of the rows have no coordinates".format(missing))
+        outside = self.out_of_bounds/max(self.points, 1)
+        if thresholds['out_of_bounds_fraction'] is not None and outside > thresholds['out_of_bounds_fraction']:
+            problems.append("{:.1%} of the points are outside the bounds {}".format(outside, self.bounds))
+        duplicates = self.duplicate_names()/rows
+        if thresholds['duplicate_name_fraction'] is not None and duplicates > thresholds['duplicate_name_fraction']:
+            problems.append("{:.1%} of the rows repeat an earlier row's {}".format(duplicates, self.name_field))
+        if thresholds['max_categories'] is not None and len(self.categories) > thresholds['max_categories']:
+            problems.append("{} distinct categories (the maximum is {})".format(len(self.categories), thresholds['max_categories']))
+        for field, maximum in thresholds['null_rates'].items():
+            if self.rows > 0 and self.nulls[field]/rows > maximum:
+                problems.append("{:.1%} of the {} values are missing".format(self.nulls[field]/rows, field))
+        return problems
+
+    def summary(self):
+        # A short, human-readable version of the profile.
+        profile = self.as_dict()
+        lines = ["{} rows, {} malformed coordinates, {} of {} points outside the bounds, {} repeated names, {} categories".format(
+            profile['rows'], profile['malformed_coordinates'], profile['out_of_bounds'], profile['points'],
+            profile['duplicate_names'], profile['category_cardinality'])]
+        null_rates = ["{} {:.1%}".format(field, rate) for field, rate in profile['null_rates'].items() if rate > 0]
+        if len(null_rates) > 0:
+            lines.append("Null rates: " + ", ".join(null_rates))
+        return "\n".join(lines)
@@ -0,0 +1,182 @@
+import re, json, uuid, threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeCKAN:
+    """A local, in-memory stand-in for a CKAN instance, served over HTTP
+    from a background thread, so that the ETL code (and ckanapi) can be
+    exercised and timed without touching a real CKAN site.
+
+    It implements just enough of the action API for this script:
+    package_show, resource_show, resource_create, datastore_create,
+    datastore_upsert, datastore_delete, datastore_search, and the forms of
+    datastore_search_sql that this script generates (SELECT COUNT(*),
+    SELECT * or a list of quoted columns, FROM one resource, with optional
+    ANDed equality conditions and a LIMIT). Every action call is counted in
+    calls, and every record received by datastore_create or
+    datastore_upsert is counted in rows_received (per resource ID)."""
+
+    def __init__(self, package_id='fake-package', private=False):
+        self.package_id = package_id
+        self.private = private
+        self.resources = {} # resource ID -> resource dict (with '_fields' and '_records' for the datastore)
+        self.calls = Counter()
+        self.rows_received = Counter()
+        self.lock = threading.Lock()
+        self.httpd = None
+
+    def start(self):
+        # Start serving on a free local port and return the site URL.
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self.respond(json.loads(body.decode('utf-8')) if body else {})
+
+            def do_GET(self):
+                self.respond({})
+
+            def respond(self, data_dict):
+                action = self.path.split('?')[0].rstrip('/').split('/')[-1]
+                status, response = fake.call(action, data_dict)
+                payload = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def __enter__(self):
+        self.site = self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def call(self, action, data_dict):
+        # Run an action, returning the HTTP status and the response body.
+        with self.lock:
+            self.calls[action] += 1
+            method = getattr(self, 'action_' + action, None)
+            if method is None:
+                return 400, {'success': False, 'error': {'__type': 'Bad Request', 'message': 'Unknown action: ' + action}}
+            try:
+                return 200, {'success': True, 'result': method(**data_dict)}
+            except KeyError as e:
+                return 404, {'success': False, 'error': {'__type': 'Not Found Error', 'message': 'Not found: {}'.format(e)}}
+            except ValueError as e:
+                return 409, {'success': False, 'error': {'__type': 'Validation Error', 'message': str(e)}}
+
+    def public_resource(self, resource):
+        return {key: value for key, value in resource.items() if not key.startswith('_')}
+
+    def action_package_show(self, id, **kwargs):
+        if id != self.package_id:
+            raise KeyError(id)
+        resources = [self.public_resource(r) for r in self.resources.values()]
+        return {'id': self.package_id, 'name': self.package_id, 'private': self.private,
+                'resources': resources, 'num_resources': len(resources)}
+
+    def action_resource_show(self, id, **kwargs):
+        return self.public_resource(self.resources[id])
+
+    def action_resource_create(self, package_id, name=None, **kwargs):
+        if package_id != self.package_id:
+            raise KeyError(package_id)
+        resource_id = str(uuid.uuid4())
+        self.resources[resource_id] = dict(kwargs, id=resource_id, name=name, package_id=package_id,
+            datastore_active=False, _fields=[], _records=[])
+        return self.public_resource(self.resources[resource_id])
+
+    def action_datastore_create(self, resource_id=None, resource=None, fields=None, records=None, **kwargs):
+        if resource_id is None:
+            resource_id = self.action_resource_create(**resource)['id']
+        r = self.resources[resource_id]
+        known = [f['id'] for f in r['_fields']]
+        r['_fields'] += [f for f in (fields or []) if f['id'] not in known]
+        r['datastore_active'] = True
+        if records:
+            self.action_datastore_upsert(resource_id, records)
+        return {'resource_id': resource_id, 'fields': r['_fields']}
+
+    def action_datastore_upsert(self, resource_id, records, method='upsert', **kwargs):
+        r = self.resources[resource_id]
+        if not r['datastore_active']:
+            raise KeyError(resource_id)
+        field_ids = [f['id'] for f in r['_fields']]
+        for record in records:
+            unknown = set(record) - set(field_ids)
+            if unknown:
+                raise ValueError("Unknown fields: {}".format(sorted(unknown)))
+            r['_records'].append(tuple(record.get(f) for f in field_ids))
+        self.rows_received[resource_id] += len(records)
+        return {'resource_id': resource_id, 'method': method}
+
+    def action_datastore_delete(self, id=None, resource_id=None, filters=None, **kwargs):
+        r = self.resources[id or resource_id]
+        if filters is None: # Delete the whole table.
+            r['_fields'], r['_records'], r['datastore_active'] = [], [], False
+        else:
+            r['_records'] = [record for record in r['_records'] if not self.matches(r, record, filters)]
+        return {'resource_id': r['id']}
+
+    def matches(self, r, record, filters):
+        field_ids = [f['id'] for f in r['_fields']]
+        return all(record[field_ids.index(field)] == value for field, value in filters.items())
+
+    def search(self, r, filters, columns):
+        field_ids = [f['id'] for f in r['_fields']]
+        if columns is None:
+            columns = field_ids
+        positions = [field_ids.index(column) for column in columns]
+        for number, record in enumerate(r['_records'], 1):
+            if self.matches(r, record, filters):
+                found = {'_id': number} if columns == field_ids else {}
+                found.update((column, record[p]) for column, p in zip(columns, positions))
+                yield found
+
+    def action_datastore_search(self, id=None, resource_id=None, filters=None, limit=100, offset=0, fields=None, **kwargs):
+        r = self.resources[id or resource_id]
+        if not r['datastore_active']:
+            raise KeyError(r['id'])
+        if isinstance(fields, str):
+            fields = fields.split(',')
+        matching = list(self.search(r, filters or {}, fields))
+        return {'resource_id': r['id'], 'fields': [{'id': '_id', 'type': 'int'}] + r['_fields'],
+                'records': matching[offset:offset+int(limit)], 'total': len(matching)}
+
+    sql_pattern = re.compile(r'^\s*SELECT (.+?) FROM "([^"]+)"(?: WHERE (.+?))?(?: LIMIT (\d+))?\s*$', re.IGNORECASE | re.DOTALL)
+    condition_pattern = re.compile(r'"?(\w+)"?\s*=\s*\'((?:[^\']|\'\')*)\'')
+
+    def action_datastore_search_sql(self, sql, **kwargs):
+        match = self.sql_pattern.match(sql)
+        if match is None:
+            raise ValueError("The fake CKAN can't run this query: {}".format(sql))
+        selected, resource_id, where, limit = match.groups()
+        r = self.resources[resource_id]
+        filters = {}
+        if where is not None:
+            for condition in re.split(r'\s+AND\s+', where, flags=re.IGNORECASE):
+                field, value = self.condition_pattern.match(condition.strip()).groups()
+                filters[field] = value.replace("''", "'")
+        if re.match(r'COUNT\(\*\)', selected, re.IGNORECASE):
+            return {'sql': sql, 'records': [{'count': sum(1 for _ in self.search(r, filters, None))}]}
+        columns = None if selected.strip() == '*' else [c.strip().strip('"') for c in selected.split(',')]
+        records = list(self.search(r, filters, columns))
+        if limit is not None:
+            records = records[:int(limit)]
+        return {'sql': sql, 'records': records}
@@ -1,39 +1,186 @@
+import os, re, json, time, queue, atexit, socket, functools, threading
+import requests
 from parameters.remote_parameters import webhook_url
 
-def send_to_slack(message,username=None,channel=None,icon=None):
-    """This script sends the given message to a particular channel on
-    Slack, as configured by the webhook_url. Note that this shouldn't 
-    be heavily used (e.g., for reporting every error a script 
-    encounters) as API limits are a consideration. This script IS 
-    suitable for running when a script-terminating exception is caught, 
-    so that you can report the irregular termination of an ETL script."""
-
-    import os, re, json, requests
-    import socket
-    IP_address = socket.gethostbyname(socket.gethostname())
-    hostname = re.sub(".local","",socket.gethostname())
+SLACK_TIMEOUT = (5, 15) # (connect, read) timeouts, in seconds, for posting to the webhook
+QUEUE_SIZE = 100 # Messages waiting to be sent (beyond this, new ones are dropped and counted)
+COALESCE_SECONDS = 2.0 # How long to wait for more messages to bundle into one post
+MIN_INTERVAL = 1.0 # Slack allows roughly one message per second per webhook.
+MAX_ATTEMPTS = 5
+FLUSH_TIMEOUT = 30.0 # How long to wait at exit for queued messages to go out
+
+@functools.lru_cache(maxsize=None)
+def caboose():
+    # Where the messages come from (computed only once, since it takes a DNS lookup).
+    hostname = socket.gethostname()
+    try:
+        IP_address = socket.gethostbyname(hostname)
+    except OSError:
+        IP_address = "an unknown IP address"
     name_of_current_script = os.path.basename(__file__)
+    return "(Sent from {} running on a computer called {} at {}.)".format(name_of_current_script, re.sub(".local","",hostname), IP_address)
+
+class SlackNotifier:
+    """Sends messages to Slack through a webhook from a background thread,
+    so that alerting never blocks or crashes the ETL code that calls it.
+
+    Messages are put on a bounded queue (when it's full, new messages are
+    dropped, and the number dropped is mentioned in the next post). The
+    worker waits briefly for more messages, so that a burst of them (to the
+    same channel, under the same username and icon) goes out as a single
+    digest post. Posts are spaced out to respect the webhook's rate limit,
+    and when Slack answers 429 (or fails), the post is retried after the
+    Retry-After delay (or an exponential backoff). Errors are printed,
+    never raised. flush waits for the queue to empty (and is called at
+    exit for the module's notifier), and reports whether every message
+    since the last flush went out."""
+
+    def __init__(self, url=None, queue_size=QUEUE_SIZE, coalesce_seconds=COALESCE_SECONDS,
+                 min_interval=MIN_INTERVAL, max_attempts=MAX_ATTEMPTS):
+        self.url = url
+        self.coalesce_seconds = coalesce_seconds
+        self.min_interval = min_interval
+        self.max_attempts = max_attempts
+        self.messages = queue.Queue(maxsize=queue_size)
+        self.session = requests.Session()
+        self.dropped = 0
+        self.unsent = 0 # Messages dropped or given up on since the last flush
+        self.pending = 0 # Messages queued or being sent
+        self.condition = threading.Condition()
+        self.hurry = threading.Event() # Set by flush, to skip the waiting.
+        self.last_post = 0.0
+        self.worker = None
+
+    def send(self, message, username=None, channel=None, icon=None):
+        # Queue a message, returning False if it had to be dropped.
+        with self.condition:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, name='slack-notifier', daemon=True)
+                self.worker.start()
+            try:
+                self.messages.put_nowait((message, username, channel, icon))
+            except queue.Full:
+                self.dropped += 1
+                self.unsent += 1
+                print("The Slack queue is full, so this message was dropped: {}".format(message))
+                return False
+            self.pending += 1
+        return True
+
+    def run(self):
+        while True:
+            batch = [self.messages.get()]
+            deadline = time.time() + self.coalesce_seconds
+            while not self.hurry.is_set() and time.time() < deadline:
+                try:
+                    batch.append(self.messages.get(timeout=min(0.05, max(deadline - time.time(), 0))))
+                except queue.Empty:
+                    pass
+            while True: # Whatever else is already waiting goes out now too.
+                try:
+                    batch.append(self.messages.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.send_batch(batch)
+            except Exception as e: # Never let the worker die.
+                print("Unable to send {} messages to Slack: {}".format(len(batch), e))
+                with self.condition:
+                    self.unsent += len(batch)
+            with self.condition:
+                self.pending -= len(batch)
+                self.condition.notify_all()
+
+    def send_batch(self, batch):
+        # Post one digest for each (username, channel, icon) in the batch.
+        groups = {}
+        for message, username, channel, icon in batch:
+            groups.setdefault((username, channel, icon), []).append(message)
+        with self.condition:
+            dropped, self.dropped = self.dropped, 0
+        for (username, channel, icon), messages in groups.items():
+            if len(messages) == 1:
+                text = messages[0]
+            else:
+                text = "{} messages:\n".format(len(messages)) + "\n\n".join("• " + message for message in messages)
+            if dropped > 0:
+                text += "\n({} more message{} had to be dropped.)".format(dropped, "" if dropped == 1 else "s")
+                dropped = 0
+            slack_data = {'text': text + " " + caboose()}
+            slack_data['username'] = 'TACHYON'
+            if username is not None:
+                slack_data['username'] = username
+            if channel is not None: # To send this as a direct message, use '@username'.
+                slack_data['channel'] = channel
+            if icon is not None:
+                slack_data['icon_emoji'] = icon #':coffin:' #':tophat:' # ':satellite_antenna:'
+            if not self.post(slack_data):
+                with self.condition:
+                    self.unsent += len(messages)
+
+    def post(self, slack_data):
+        # Post to the webhook, retrying on rate limiting and server or
+        # network errors. Returns whether the post went through.
+        url = self.url or webhook_url
+        for attempt in range(self.max_attempts):
+            wait = self.last_post + self.min_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.last_post = time.time()
+            delay = 2**attempt
+            try:
+                response = self.session.post(url, data=json.dumps(slack_data),
+                    headers={'Content-Type': 'application/json'}, timeout=SLACK_TIMEOUT)
+            except requests.RequestException as e:
+                print("Posting to Slack failed ({}).".format(e))
+            else:
+                if response.status_code == 200:
+                    return True
+                if response.status_code == 429:
+                    try:
+                        delay = float(response.headers.get('Retry-After', delay))
+                    except ValueError:
+                        pass
+                elif response.status_code < 500:
+                    print('Request to Slack returned an error {}, the response is:\n{}'.format(response.status_code, response.text))
+                    return False # Sending the same thing again won't help.
+                else:
+                    print("Slack returned an error {}.".format(response.status_code))
+            if attempt < self.max_attempts - 1:
+                time.sleep(delay)
+        print("Giving up on sending this to Slack: {}".format(slack_data['text']))
+        return False
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        # Send whatever is queued right away and wait (up to timeout seconds)
+        # for it to go out. Returns whether everything queued since the last
+        # flush was sent (and not dropped, given up on, or still waiting).
+        self.hurry.set()
+        try:
+            with self.condition:
+                emptied = self.condition.wait_for(lambda: self.pending == 0, timeout)
+                unsent, self.unsent = self.unsent, 0
+                return emptied and unsent == 0
+        finally:
+            self.hurry.clear()
+
+notifier = SlackNotifier()
+atexit.register(notifier.flush)
+
+def send_to_slack(message,username=None,channel=None,icon=None):
+    """This function sends the given message to a particular channel on
+    Slack, as configured by the webhook_url. The message is queued and
+    sent from a background thread (see SlackNotifier), so this returns
+    right away and never raises, and bursts of messages are bundled into
+    one post. It's still best not to use this heavily (e.g., for reporting
+    every error a script encounters). It IS suitable for running when a
+    script-terminating exception is caught, so that you can report the
+    irregular termination of an ETL script, as queued messages are sent
+    before the script exits."""
+    return notifier.send(message,username,channel,icon)
 
-    caboose = "(Sent from {} running on a computer called {} at {}.)".format(name_of_current_script, hostname, IP_address)
-    # Set the webhook_url to the one provided by Slack when you create the webhook at https://my.slack.com/services/new/incoming-webhook/
-    slack_data = {'text': message + " " + caboose}
-    slack_data['username'] = 'TACHYON'
-    if username is not None:
-        slack_data['username'] = username
-    #To send this as a direct message instead, use the following line. 
-    if channel is not None:
-        slack_data['channel'] = channel
-    if icon is not None:
-        slack_data['icon_emoji'] = icon #':coffin:' #':tophat:' # ':satellite_antenna:'
-    response = requests.post(
-        webhook_url, data=json.dumps(slack_data),
-        headers={'Content-Type': 'application/json'}
-    )
-    if response.status_code != 200:
-        raise ValueError(
-            'Request to Slack returned an error %s, the response is:\n%s'
-            % (response.status_code, response.text)
-        )
+def flush(timeout=FLUSH_TIMEOUT):
+    return notifier.flush(timeout)
 
 if __name__ == '__main__':
     msg = "No sir, away! A papaya war is on!"
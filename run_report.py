@@ -0,0 +1,101 @@
+import json, time, threading
+from contextlib import contextmanager
+from datetime import datetime
+
+class RunReport:
+    """Collects wall time, bytes, row counts, and HTTP calls for each stage
+    of a run (per table), so that the results can be written out as a
+    machine-readable JSON report at the end of the run.
+
+    Stages are timed with the stage context manager. While a stage is
+    active on a thread, increment adds to its counters, which is how the
+    HTTP response hook attributes calls to stages. Work handed off to
+    other threads can be attributed to a stage with attach."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started_at = datetime.now().isoformat()
+        self.start = time.time()
+        self.stages = []
+        self.extras = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self):
+        # The innermost stage active on this thread (or None).
+        stack = self._stack()
+        return stack[-1] if len(stack) > 0 else None
+
+    @contextmanager
+    def attach(self, record):
+        # Attribute work done on this thread to a stage started on another.
+        stack = self._stack()
+        stack.append(record)
+        try:
+            yield record
+        finally:
+            stack.pop()
+
+    @contextmanager
+    def stage(self, name, table=None, **details):
+        record = {'table': table, 'stage': name, 'started_at': datetime.now().isoformat(),
+                  'seconds': None, 'bytes': 0, 'rows': 0, 'http_calls': 0}
+        record.update(details)
+        with self._lock:
+            self.stages.append(record)
+        start = time.time()
+        with self.attach(record):
+            try:
+                yield record
+            except BaseException as e:
+                record['error'] = repr(e)
+                raise
+            finally:
+                record['seconds'] = round(time.time() - start, 3)
+
+    def increment(self, counter, amount=1):
+        record = self.current()
+        if record is not None:
+            with self._lock:
+                record[counter] = record.get(counter, 0) + amount
+
+    def count_http_call(self, response, *args, **kwargs):
+        # A requests response hook.
+        self.increment('http_calls')
+        return response
+
+    def add(self, key, value):
+        # Add run-level information (not tied to a stage) to the report.
+        with self._lock:
+            self.extras[key] = value
+
+    def as_dict(self):
+        with self._lock:
+            return dict({'started_at': self.started_at,
+                    'seconds': round(time.time() - self.start, 3),
+                    'stages': [dict(record) for record in self.stages]}, **self.extras)
+
+    def write(self, filepath):
+        with open(filepath, 'w') as f:
+            json.dump(self.as_dict(), f, indent=4)
+
+    def summary(self):
+        # A short, human-readable version of the report.
+        report = self.as_dict()
+        lines = ["Run took {:.1f} seconds".format(report['seconds'])]
+        for record in report['stages']:
+            lines.append("  {:<12} {:<20} {:>8.2f} s {:>9} rows {:>12} bytes {:>5} HTTP calls{}".format(
+                record['table'] or '', record['stage'], record['seconds'] or 0.0,
+                record['rows'], record['bytes'], record['http_calls'],
+                "  ERROR: {}".format(record['error']) if 'error' in record else ""))
+        return "\n".join(lines)
+
+# The report for the current run
+report = RunReport()
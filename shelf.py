@@ -0,0 +1,60 @@
+import sys
+
+class Shelf:
+    """A compact, in-memory container for the parsed rows of a table.
+
+    Instead of one dict per row (each repeating every header as a key),
+    the headers are kept once (interned) and each row is a tuple of values
+    in header order. The values are kept just as they appear in the tmp
+    CSV file ('' for None, and strings for everything else), so the rows
+    of a shelf can stand in for the rows of that file. The values of the
+    columns named in interned_fields (those with few distinct values, like
+    neighborhoods and categories) are interned, so each distinct value is
+    stored only once.
+
+    Rows can be read back as tuples (by iterating), as dicts (with dicts,
+    which makes them one at a time), or by column (column and keys)."""
+
+    __slots__ = ('headers', 'positions', 'rows', 'interned_positions')
+
+    def __init__(self, headers, interned_fields=()):
+        self.headers = tuple(sys.intern(header) for header in headers)
+        self.positions = {header: position for position, header in enumerate(self.headers)}
+        self.rows = []
+        self.interned_positions = tuple(self.positions[field] for field in interned_fields if field in self.positions)
+
+    def append(self, row):
+        # Add a row, given as a dict (missing keys are treated as None).
+        values = ['' if row.get(header) is None else str(row[header]) for header in self.headers]
+        for position in self.interned_positions:
+            values[position] = sys.intern(values[position])
+        self.rows.append(tuple(values))
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, index):
+        return dict(zip(self.headers, self.rows[index]))
+
+    def dicts(self):
+        # Yield each row as a (new) dict.
+        headers = self.headers
+        for values in self.rows:
+            yield dict(zip(headers, values))
+
+    def column(self, name):
+        position = self.positions[name]
+        return [values[position] for values in self.rows]
+
+    def keys(self, fields):
+        # Yield the tuple of the values of the given fields for each row.
+        positions = [self.positions[field] for field in fields]
+        for values in self.rows:
+            yield tuple(values[p] for p in positions)
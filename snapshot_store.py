@@ -0,0 +1,186 @@
+import os, csv, gzip, json, shutil
+from collections import Counter, defaultdict
+
+def arrow():
+    # Import pyarrow (and its Parquet module) when a store first needs it,
+    # returning None for both if it isn't installed. Without pyarrow, each
+    # column is kept in its own gzipped JSON file.
+    global pa, pq, _arrow_checked
+    if not _arrow_checked:
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            pa = pq = None
+        _arrow_checked = True
+    return pa, pq
+
+pa = pq = None
+_arrow_checked = False
+
+class SnapshotStore:
+    """A local, columnar store of the rows of each table for each
+    year_month, so that historical questions (how many services there were
+    in a given month, or what changed from one month to the next) can be
+    answered without scanning the cumulative archives on CKAN.
+
+    A month of a table is kept as a Parquet file ({table}/{year_month}.parquet)
+    if pyarrow is installed, and otherwise as a directory
+    ({table}/{year_month}/) with one gzipped JSON array per column and a
+    meta.json file listing the columns and the number of rows. Either way,
+    a query reads only the columns it needs. All values are kept as the
+    strings of the tmp CSV files (with '' for a missing value)."""
+
+    def __init__(self, directory, use_arrow=None):
+        self.directory = directory
+        arrow()
+        self.use_arrow = (pq is not None) if use_arrow is None else use_arrow
+        if self.use_arrow and pq is None:
+            raise ImportError("pyarrow is needed to store snapshots as Parquet files.")
+
+    def parquet_path(self, table, year_month):
+        return os.path.join(self.directory, table, "{}.parquet".format(year_month))
+
+    def column_directory(self, table, year_month):
+        return os.path.join(self.directory, table, str(year_month))
+
+    def months(self, table):
+        # The year_months stored for the table, in order.
+        table_directory = os.path.join(self.directory, table)
+        if not os.path.isdir(table_directory):
+            return []
+        return sorted({name.split('.')[0] for name in os.listdir(table_directory) if not name.endswith('.tmp')})
+
+    def has(self, table, year_month):
+        return (os.path.exists(self.parquet_path(table, year_month)) or
+                os.path.exists(os.path.join(self.column_directory(table, year_month), 'meta.json')))
+
+    def write(self, table, year_month, headers, rows):
+        # Store the rows (sequences of values, in the order of headers) as
+        # the snapshot of the table for year_month, replacing any earlier one.
+        columns = [[] for _ in headers]
+        for row in rows:
+            for column, value in zip(columns, row):
+                column.append('' if value is None else str(value))
+        self.remove(table, year_month)
+        os.makedirs(os.path.join(self.directory, table), exist_ok=True)
+        if self.use_arrow:
+            path = self.parquet_path(table, year_month)
+            arrow_table = pa.table({name: pa.array(column, type=pa.string()) for name, column in zip(headers, columns)})
+            pq.write_table(arrow_table, path + '.tmp')
+            os.replace(path + '.tmp', path)
+        else:
+            path = self.column_directory(table, year_month)
+            temporary_path = path + '.tmp'
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            os.makedirs(temporary_path)
+            for number, column in enumerate(columns):
+                with gzip.open(os.path.join(temporary_path, "{}.json.gz".format(number)), 'wt', encoding='utf-8') as f:
+                    json.dump(column, f)
+            with open(os.path.join(temporary_path, 'meta.json'), 'w') as f:
+                json.dump({'columns': list(headers), 'rows': len(columns[0]) if len(columns) > 0 else 0}, f)
+            os.replace(temporary_path, path)
+        return len(columns[0]) if len(columns) > 0 else 0
+
+    def write_csv(self, table, year_month, filepath):
+        # Store the rows of a tmp CSV file as the table's snapshot for year_month.
+        with open(filepath, newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            headers = next(reader)
+            return self.write(table, year_month, headers, reader)
+
+    def merge(self, table, year_month, headers, rows, key_fields=None):
+        # Add the rows to the snapshot of the table for year_month, skipping
+        # each one whose key (its key_fields values, or the whole row) the
+        # snapshot already has. Without a snapshot with the same columns,
+        # this is the same as write. Returns the number of rows stored.
+        headers = list(headers)
+        if not self.has(table, year_month) or self.meta(table, year_month)['columns'] != headers:
+            return self.write(table, year_month, headers, rows)
+        positions = [headers.index(field) for field in key_fields] if key_fields else range(len(headers))
+        stored = self.project(table, year_month, headers)
+        unmatched = Counter(tuple(row[i] for i in positions) for row in stored)
+        merged = list(stored)
+        for row in rows:
+            row = tuple('' if value is None else str(value) for value in row)
+            key = tuple(row[i] for i in positions)
+            if unmatched[key] > 0:
+                unmatched[key] -= 1
+            else:
+                merged.append(row)
+        return self.write(table, year_month, headers, merged)
+
+    def merge_csv(self, table, year_month, filepath, key_fields=None):
+        # Add the rows of a tmp CSV file to the table's snapshot for year_month (see merge).
+        with open(filepath, newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            headers = next(reader)
+            return self.merge(table, year_month, headers, reader, key_fields)
+
+    def remove(self, table, year_month):
+        if os.path.exists(self.parquet_path(table, year_month)):
+            os.remove(self.parquet_path(table, year_month))
+        shutil.rmtree(self.column_directory(table, year_month), ignore_errors=True)
+
+    def meta(self, table, year_month):
+        if os.path.exists(self.parquet_path(table, year_month)):
+            if pq is None:
+                raise ImportError("pyarrow is needed to read {}.".format(self.parquet_path(table, year_month)))
+            metadata = pq.ParquetFile(self.parquet_path(table, year_month)).metadata
+            return {'columns': list(metadata.schema.names), 'rows': metadata.num_rows}
+        meta_path = os.path.join(self.column_directory(table, year_month), 'meta.json')
+        if not os.path.exists(meta_path):
+            raise KeyError("There is no {} snapshot for {}.".format(table, year_month))
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def columns(self, table, year_month, names=None):
+        # Return a dict that maps each of the named columns (by default,
+        # all of them) to its list of values.
+        meta = self.meta(table, year_month)
+        names = meta['columns'] if names is None else list(names)
+        unknown = [name for name in names if name not in meta['columns']]
+        if len(unknown) > 0:
+            raise ValueError("The {} snapshot for {} has no columns named {}.".format(table, year_month, unknown))
+        if os.path.exists(self.parquet_path(table, year_month)):
+            return pq.read_table(self.parquet_path(table, year_month), columns=names).to_pydict()
+        found = {}
+        for name in names:
+            path = os.path.join(self.column_directory(table, year_month), "{}.json.gz".format(meta['columns'].index(name)))
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                found[name] = json.load(f)
+        return found
+
+    def project(self, table, year_month, names):
+        # Return the values of the named columns as a list of row tuples.
+        found = self.columns(table, year_month, names)
+        return list(zip(*[found[name] for name in names]))
+
+    def count(self, table, year_month, **filters):
+        # Count the rows (that have the given column values, if any).
+        if len(filters) == 0:
+            return self.meta(table, year_month)['rows']
+        names = list(filters)
+        wanted = tuple(str(filters[name]) for name in names)
+        return sum(1 for row in self.project(table, year_month, names) if row == wanted)
+
+    def key_counts(self, table, year_month, key_fields):
+        # A multiset (Counter) of the keys (tuples of the key_fields values).
+        return Counter(self.project(table, year_month, key_fields))
+
+    def diff(self, table, old_year_month, new_year_month, key_fields):
+        # Compare two months of a table by key, returning a dict with the
+        # lists of keys that were added, changed (whose group of rows
+        # differs), and removed between them.
+        old_rows, new_rows = defaultdict(list), defaultdict(list)
+        for year_month, keyed_rows in [(old_year_month, old_rows), (new_year_month, new_rows)]:
+            found = self.columns(table, year_month)
+            names = list(found)
+            positions = [names.index(field) for field in key_fields]
+            for row in zip(*[found[name] for name in names]):
+                keyed_rows[tuple(row[p] for p in positions)].append(row)
+            for rows in keyed_rows.values():
+                rows.sort()
+        return {'added': [key for key in new_rows if key not in old_rows],
+                'changed': [key for key in new_rows if key in old_rows and new_rows[key] != old_rows[key]],
+                'removed': [key for key in old_rows if key not in new_rows]}
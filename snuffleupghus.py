@@ -1,231 +1,501 @@
-import sys, re, csv, json, time, ckanapi, requests, traceback
-from marshmallow import fields, pre_load, post_load
+import sys, re, csv, json, time, traceback
+import os, shutil, codecs, functools, hashlib, threading
+from collections import Counter, defaultdict, deque
+from collections.abc import Mapping
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from datetime import datetime
-from pprint import pprint
+
+# The heavy dependencies (requests, ckanapi, marshmallow, and wprdc-etl's
+# pipeline package) are only imported by the functions that use them, so
+# that parsing doesn't have to wait for them to load.
 
 # Note that the wprdc-etl documentation claims that it can handle |-delimited files,
 # if the pipeline is properly configured.
-sys.path.insert(0, '/Users/drw/WPRDC/etl-dev/wprdc-etl') # A path that we need to import code from
-import pipeline as pl
+ETL_PATH = os.environ.get('WPRDC_ETL_PATH', '/Users/drw/WPRDC/etl-dev/wprdc-etl') # Where to import wprdc-etl from (if it isn't installed)
 
 from parameters.local_parameters import SETTINGS_FILE, DATA_PATH
-from notify import send_to_slack
-
-# The three base schema could certainly be refactored, but it's not clear
-# if it's worth doing.
-class EventsSchema(pl.BaseSchema): 
-    event_name = fields.String(allow_none=False)
-    recurrence = fields.String(allow_none=True)
-    program_or_facility = fields.String(allow_none=True)
-    program_neighborhood = fields.String(dump_to='neighborhood',allow_none=True)
-    program_address = fields.String(dump_to='address',allow_none=True)
-    latitude = fields.Float(allow_none=True)
-    longitude = fields.Float(allow_none=True)
-    organization_name = fields.String(dump_to="organization",allow_none=True)
-    category = fields.String(allow_none=True)
-    recommended_for = fields.String(allow_none=True)
-    requirements = fields.String(allow_none=True)
-    event_phone = fields.String(allow_none=True)
-    event_narrative = fields.String(allow_none=True)
-    schedule = fields.String(allow_none=True)
-    holiday_exception = fields.String(allow_none=True)
-    # Never let any of the key fields have None values. It's just asking for
-    # multiplicity problems on upsert.
-
-    # [Note that since this script is taking data from CSV files, there should be no
-    # columns with None values. It should all be instances like [value], [value],, [value],...
-    # where the missing value starts as as a zero-length string, which this script
-    # is then responsible for converting into something more apropriate.
-    class Meta:
-        ordered = True
-
-    @pre_load
-    def get_lat_and_lon(self, data):
-    # Split geocoordinates field ("Program Lat and Long") into new latitude and longitude fields.
-        if 'program_lat_and_long' not in data or data['program_lat_and_long'] is None:
-            data['latitude'] = None
-            data['longitude'] = None
-        else:
-            latpart, lonpart = data['program_lat_and_long'].split(',')
-            _, latitude = latpart.split(': ')
-            _, longitude = lonpart.split(': ')
-            data['latitude'] = float(latitude)
-            data['longitude'] = float(longitude)
-        if 'program_lat_and_long' in data:
-            del data['program_lat_and_long']
-
-    @pre_load
-    def fuse_cats(self,data):
-        # Combine Category One and Category Two into a |-delimited category field
-        if 'category_one' not in data and 'category_two' not in data:
-            return None
-        elif 'category_two' not in data:
-            return data['category_one']
-        elif 'category_one' not in data:
-            return data['category_two']
-
-        cat1 = data['category_one']
-        cat2 = data['category_two'] # Empty fields are empty strings (since we're loading a CSV file).
-        if cat2 is None or len(cat2) == 0:
-            if cat1 is None or len(cat1) == 0:
-                data['category'] = None
-            else:
-                data['category'] = cat1
-        elif cat1 is None or len(cat1) == 0:
-            data['category'] = cat2
-        else:
-            data['category'] = "{}|{}".format(cat1,cat2)
+from run_report import report
+from spatial_index import SpatialIndex
+from snapshot_store import SnapshotStore
+from shelf import Shelf
+from data_profile import DataProfile, DataQualityError, DEFAULT_THRESHOLDS
 
-        del data['category_one']
-        del data['category_two']
+@functools.lru_cache(maxsize=None)
+def etl():
+    # Import wprdc-etl's pipeline package the first time it's needed.
+    if ETL_PATH and ETL_PATH not in sys.path:
+        sys.path.insert(0, ETL_PATH) # A path that we need to import code from
+    import pipeline
+    return pipeline
 
-class EventsArchiveSchema(EventsSchema):
-    year_month = fields.String(allow_none=False)
+def send_to_slack(message,username=None,channel=None,icon=None):
+    # notify (and with it, requests) is only imported once there's something to send.
+    import notify
+    return notify.send_to_slack(message,username,channel,icon)
 
-    @pre_load
-    def add_year_month(self, data):
-        data['year_month'] = datetime.strftime(datetime.now(),"%Y%m")
+# Normalization of whole batches of rows, which does once per column (and
+# once per run, for year_month) what the schemas' pre_load hooks would do
+# once per row. The schemas recognize rows that have been normalized and
+# leave them alone, apart from restoring the None values that the tmp CSV
+# file turns into empty strings, so the output is the same either way.
+lat_and_lon_pattern = re.compile(r'^[^:,]*: ([^,]*),[^:,]*: ([^,]*)$')
+double_comma_pattern = re.compile(r'^[^:,]*: ([^,]*),,?[^:,]*: ([^,]*)$') # For tables with double_comma_coordinates
+NORMALIZATION_BATCH_SIZE = 5000
+normalized_nullable_fields = ['latitude', 'longitude', 'category']
+# Columns with few distinct values, whose values a Shelf stores only once
+shelf_interned_fields = ['program_neighborhood', 'category', 'organization_name', 'recurrence', 'year_month']
 
-class SafePlacesSchema(pl.BaseSchema): 
-    safe_place_name = fields.String(allow_none=False)
-    program_or_facility = fields.String(allow_none=True)
-    program_neighborhood = fields.String(dump_to='neighborhood',allow_none=True)
-    program_address = fields.String(dump_to='address',allow_none=True)
-    latitude = fields.Float(allow_none=True)
-    longitude = fields.Float(allow_none=True)
-    organization_name = fields.String(dump_to="organization",allow_none=True)
-    recommended_for = fields.String(allow_none=True)
-    requirements = fields.String(allow_none=True)
-    safe_place_phone = fields.String(dump_to="phone",allow_none=True)
-    safe_place_narrative = fields.String(dump_to="narrative",allow_none=True)
-    schedule = fields.String(allow_none=True)
-    # Never let any of the key fields have None values. It's just asking for
-    # multiplicity problems on upsert.
-
-    # [Note that since this script is taking data from CSV files, there should be no
-    # columns with None values. It should all be instances like [value], [value],, [value],...
-    # where the missing value starts as as a zero-length string, which this script
-    # is then responsible for converting into something more apropriate.
-    class Meta:
-        ordered = True
-
-    @pre_load
-    def get_lat_and_lon(self, data):
-    # Split geocoordinates field ("Program Lat and Long") into new latitude and longitude fields.
-        if 'program_lat_and_long' not in data or data['program_lat_and_long'] is None:
-            data['latitude'] = None
-            data['longitude'] = None
-        else:
-            latpart, lonpart = data['program_lat_and_long'].split(',')
-            _, latitude = latpart.split(': ')
-            _, longitude = lonpart.split(': ')
-            data['latitude'] = float(latitude)
-            data['longitude'] = float(longitude)
-        if 'program_lat_and_long' in data:
-            del data['program_lat_and_long']
-
-class SafePlacesArchiveSchema(SafePlacesSchema):
-    year_month = fields.String(allow_none=False)
-
-    @pre_load
-    def add_year_month(self, data):
-        data['year_month'] = datetime.strftime(datetime.now(),"%Y%m")
+def restore_nones(data):
+    for field in normalized_nullable_fields:
+        if data.get(field) == '':
+            data[field] = None
 
-class ServicesSchema(pl.BaseSchema): 
-    service_name = fields.String(allow_none=False)
-    program_or_facility = fields.String(allow_none=True)
-    program_neighborhood = fields.String(dump_to='neighborhood',allow_none=True)
-    program_address = fields.String(dump_to='address',allow_none=True)
-    latitude = fields.Float(allow_none=True)
-    longitude = fields.Float(allow_none=True)
-    organization_name = fields.String(dump_to="organization",allow_none=True)
-    category = fields.String(allow_none=True)
-    recommended_for = fields.String(allow_none=True)
-    requirements = fields.String(allow_none=True)
-    service_phone = fields.String(dump_to="phone",allow_none=True)
-    service_narrative = fields.String(dump_to="narrative",allow_none=True)
-    schedule = fields.String(allow_none=True)
-    holiday_exception = fields.String(allow_none=True)
-    # Never let any of the key fields have None values. It's just asking for
-    # multiplicity problems on upsert.
-
-    # [Note that since this script is taking data from CSV files, there should be no
-    # columns with None values. It should all be instances like [value], [value],, [value],...
-    # where the missing value starts as as a zero-length string, which this script
-    # is then responsible for converting into something more apropriate.
-    class Meta:
-        ordered = True
-
-    @pre_load
-    def get_lat_and_lon(self, data):
-    # Split geocoordinates field ("Program Lat and Long") into new latitude and longitude fields.
-        if 'program_lat_and_long' not in data or data['program_lat_and_long'] is None:
-            data['latitude'] = None
-            data['longitude'] = None
-        else:
+def coordinates_pattern(table):
+    # The pattern that a table's "Program Lat and Long" values must match.
+    if table_registry.get(table, {}).get('double_comma_coordinates'):
+        return double_comma_pattern
+    return lat_and_lon_pattern
+
+def parse_coordinates(column,malformed=None,pattern=lat_and_lon_pattern):
+    # Convert a column of "Program Lat and Long" values (like
+    # "Latitude: 40.44, Longitude: -79.99") into columns of latitudes
+    # and longitudes. Only None gives no coordinates; anything else
+    # (including an empty string) has to match the pattern. If a list is
+    # given as malformed, values that can't be parsed are added to it (and
+    # given no coordinates) instead of raising a ValueError.
+    latitudes, longitudes = [], []
+    for value, match in zip(column, map(pattern.match, [value or '' for value in column])):
+        coordinates = None
+        if match is not None:
             try:
-                latpart, lonpart = data['program_lat_and_long'].split(',')
-            except:
-                print(data['program_lat_and_long'])
-                latpart, lonpart = data['program_lat_and_long'].split(',,') # Klugy workaround to deal with
-                # one case of latitude and longitude being separated by two commas.
-            _, latitude = latpart.split(': ')
-            _, longitude = lonpart.split(': ')
-            data['latitude'] = float(latitude)
-            data['longitude'] = float(longitude)
-        if 'program_lat_and_long' in data:
-            del data['program_lat_and_long']
-
-    @pre_load
-    def fuse_cats(self,data):
-        # Combine Category One and Category Two into a |-delimited category field
-        if 'category_one' not in data and 'category_two' not in data:
-            return None
-        elif 'category_two' not in data:
-            return data['category_one']
-        elif 'category_one' not in data:
-            return data['category_two']
-
-        cat1 = data['category_one']
-        cat2 = data['category_two'] # Empty fields are empty strings (since we're loading a CSV file).
-        if cat2 is None or len(cat2) == 0:
-            if cat1 is None or len(cat1) == 0:
-                data['category'] = None
-            else:
-                data['category'] = cat1
-        elif cat1 is None or len(cat1) == 0:
-            data['category'] = cat2
+                coordinates = float(match.group(1)), float(match.group(2))
+            except ValueError: # Like "Latitude: , Longitude: "
+                pass
+        if coordinates is not None:
+            latitudes.append(coordinates[0])
+            longitudes.append(coordinates[1])
+        elif value is None or malformed is not None:
+            if value is not None:
+                malformed.append(value)
+            latitudes.append(None)
+            longitudes.append(None)
         else:
-            data['category'] = "{}|{}".format(cat1,cat2)
+            raise ValueError("Unable to parse the coordinates {}".format(value))
+    return latitudes, longitudes
+
+def fuse_categories(column_one,column_two):
+    # Combine the Category One and Category Two columns into a |-delimited category column.
+    return [("{}|{}".format(cat1,cat2) if cat2 else cat1) if cat1 else (cat2 or None)
+        for cat1, cat2 in zip(column_one,column_two)]
+
+def normalized_headers(headers):
+    # The headers of the rows produced by normalize_rows, given the parsed headers.
+    new_headers = []
+    for header in headers:
+        if header == 'program_lat_and_long':
+            new_headers += ['latitude', 'longitude']
+        elif header == 'category_one':
+            new_headers.append('category')
+        elif header != 'category_two':
+            new_headers.append(header)
+    return new_headers + ['year_month']
 
-        del data['category_one']
-        del data['category_two']
+def normalize_batch(batch,year_month,malformed=None,pattern=lat_and_lon_pattern):
+    if 'program_lat_and_long' in batch[0]:
+        latitudes, longitudes = parse_coordinates([row.pop('program_lat_and_long') for row in batch],malformed,pattern)
+        for row, latitude, longitude in zip(batch, latitudes, longitudes):
+            row['latitude'] = latitude
+            row['longitude'] = longitude
+    if 'category_one' in batch[0] or 'category_two' in batch[0]:
+        categories = fuse_categories([row.pop('category_one', None) for row in batch],
+            [row.pop('category_two', None) for row in batch])
+        for row, category in zip(batch, categories):
+            row['category'] = category
+    for row in batch:
+        row['year_month'] = year_month
+    return batch
 
-class ServicesArchiveSchema(ServicesSchema):
-    year_month = fields.String(allow_none=False)
+def normalize_rows(rows,year_month,batch_size=NORMALIZATION_BATCH_SIZE,malformed=None,pattern=lat_and_lon_pattern):
+    # Lazily normalize parsed rows, batch_size rows at a time, parsing the
+    # coordinates with pattern (see coordinates_pattern).
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield from normalize_batch(batch,year_month,malformed,pattern)
+            batch = []
+    if len(batch) > 0:
+        yield from normalize_batch(batch,year_month,malformed,pattern)
 
-    @pre_load
-    def add_year_month(self, data):
+# Each BigBurgh table is declared here once. The schema for the table, its
+# archive variant (which adds year_month), and the lists of CKAN fields for
+# both are generated from these entries (the first time any of them is
+# needed), so adding a table only takes a new entry. The fields are given
+# in order, as (field name, name of the marshmallow field class, keyword
+# arguments), where allow_none defaults to True. n is the position of the table's file among
+# the command-line arguments, and identity_fields are the (parsed) fields
+# that identify a row when diffing and deduplicating. double_comma_coordinates
+# lets a table's coordinates be separated by ",," (as in one services record).
+table_registry = {
+    'events': {
+        'n': 1,
+        'resource_designation': "Events",
+        'identity_fields': ['event_name', 'program_or_facility', 'program_address'],
+        'fields': [('event_name', 'String', {'allow_none': False}),
+                   ('recurrence', 'String', {}),
+                   ('program_or_facility', 'String', {}),
+                   ('program_neighborhood', 'String', {'dump_to': 'neighborhood'}),
+                   ('program_address', 'String', {'dump_to': 'address'}),
+                   ('latitude', 'Float', {}),
+                   ('longitude', 'Float', {}),
+                   ('organization_name', 'String', {'dump_to': 'organization'}),
+                   ('category', 'String', {}),
+                   ('recommended_for', 'String', {}),
+                   ('requirements', 'String', {}),
+                   ('event_phone', 'String', {}),
+                   ('event_narrative', 'String', {}),
+                   ('schedule', 'String', {}),
+                   ('holiday_exception', 'String', {})]
+    },
+    'safePlaces': {
+        'n': 2,
+        'resource_designation': "Safe Places",
+        'identity_fields': ['safe_place_name', 'program_or_facility', 'program_address'],
+        'fields': [('safe_place_name', 'String', {'allow_none': False}),
+                   ('program_or_facility', 'String', {}),
+                   ('program_neighborhood', 'String', {'dump_to': 'neighborhood'}),
+                   ('program_address', 'String', {'dump_to': 'address'}),
+                   ('latitude', 'Float', {}),
+                   ('longitude', 'Float', {}),
+                   ('organization_name', 'String', {'dump_to': 'organization'}),
+                   ('recommended_for', 'String', {}),
+                   ('requirements', 'String', {}),
+                   ('safe_place_phone', 'String', {'dump_to': 'phone'}),
+                   ('safe_place_narrative', 'String', {'dump_to': 'narrative'}),
+                   ('schedule', 'String', {})]
+    },
+    'services': {
+        'n': 3,
+        'resource_designation': "Services",
+        'double_comma_coordinates': True,
+        'identity_fields': ['service_name', 'program_or_facility', 'program_address'],
+        'fields': [('service_name', 'String', {'allow_none': False}),
+                   ('program_or_facility', 'String', {}),
+                   ('program_neighborhood', 'String', {'dump_to': 'neighborhood'}),
+                   ('program_address', 'String', {'dump_to': 'address'}),
+                   ('latitude', 'Float', {}),
+                   ('longitude', 'Float', {}),
+                   ('organization_name', 'String', {'dump_to': 'organization'}),
+                   ('category', 'String', {}),
+                   ('recommended_for', 'String', {}),
+                   ('requirements', 'String', {}),
+                   ('service_phone', 'String', {'dump_to': 'phone'}),
+                   ('service_narrative', 'String', {'dump_to': 'narrative'}),
+                   ('schedule', 'String', {}),
+                   ('holiday_exception', 'String', {})]
+    }
+}
+
+def add_year_month(self, data):
+    if not data.get('year_month'): # normalize_rows stamps year_month once per run.
         data['year_month'] = datetime.strftime(datetime.now(),"%Y%m")
 
+def generate_schemas(table,spec,base_schema):
+    # Generate the schema and archive schema for a table in the registry.
+    # The class names follow the table names (e.g., 'safePlaces' gives
+    # SafePlacesSchema and SafePlacesArchiveSchema).
+    from marshmallow import fields, pre_load
+    class_name = table[0].upper() + table[1:] + 'Schema'
+    attributes = {'__module__': __name__, 'coordinates_pattern': coordinates_pattern(table)}
+    for name, field_class, options in spec['fields']:
+        attributes[name] = getattr(fields, field_class)(**dict({'allow_none': True}, **options))
+    schema = type(class_name, (base_schema,), attributes)
+    archive_attributes = {'__module__': __name__,
+                          'year_month': fields.String(allow_none=False),
+                          'add_year_month': pre_load(add_year_month)}
+    archive_schema = type(class_name.replace('Schema','ArchiveSchema'), (schema,), archive_attributes)
+    return schema, archive_schema
+
+_schema_lock = threading.Lock()
+_generated = {}
+
+def build_schemas():
+    # Generate all the schemas (importing marshmallow and wprdc-etl) the
+    # first time they're needed, and return a dict holding schema_dict,
+    # ckan_fields, and published_names:
+    # schema_dict maps 'events', 'events_archive', etc. to the generated schemas,
+    # which are also made available as module attributes (EventsSchema, ...).
+    # ckan_fields maps the same keys to the fields to publish (with year_month
+    # moved to the front for the archives), and published_names maps each
+    # schema's field names to the names they are published under.
+    with _schema_lock:
+        if len(_generated) > 0:
+            return _generated
+        from marshmallow import pre_load
+        pl = etl()
+
+        class BigBurghSchema(pl.BaseSchema):
+            # The hooks shared by all the generated BigBurgh schemas.
+
+            # Never let any of the key fields have None values. It's just asking for
+            # multiplicity problems on upsert.
+
+            # [Note that since this script is taking data from CSV files, there should be no
+            # columns with None values. It should all be instances like [value], [value],, [value],...
+            # where the missing value starts as as a zero-length string, which this script
+            # is then responsible for converting into something more apropriate.
+            class Meta:
+                ordered = True
+
+            @pre_load
+            def get_lat_and_lon(self, data):
+            # Split geocoordinates field ("Program Lat and Long") into new latitude and longitude fields.
+                if 'program_lat_and_long' not in data and 'latitude' in data:
+                    restore_nones(data) # The rows were already normalized by normalize_rows.
+                    return
+                latitudes, longitudes = parse_coordinates([data.pop('program_lat_and_long', None)],pattern=self.coordinates_pattern)
+                data['latitude'] = latitudes[0]
+                data['longitude'] = longitudes[0]
+
+            @pre_load
+            def fuse_cats(self,data):
+                # Combine Category One and Category Two into a |-delimited category field
+                if 'category_one' not in data and 'category_two' not in data:
+                    return
+                data['category'] = fuse_categories([data.pop('category_one', None)], [data.pop('category_two', None)])[0]
+
+        BigBurghSchema.__qualname__ = 'BigBurghSchema' # So that the schemas can be pickled.
+        globals()['BigBurghSchema'] = BigBurghSchema
+        schema_dict, ckan_fields, published_names = {}, {}, {}
+        for table, spec in table_registry.items():
+            schema, archive_schema = generate_schemas(table,spec,BigBurghSchema)
+            schema_dict[table] = schema
+            schema_dict[table+'_archive'] = archive_schema
+            ckan_fields[table] = schema().serialize_to_ckan_fields()
+            archive_fields = archive_schema().serialize_to_ckan_fields()
+            ckan_fields[table+'_archive'] = [archive_fields[-1]] + archive_fields[:-1]
+            for generated in [schema, archive_schema]:
+                globals()[generated.__name__] = generated
+                published_names[generated] = {name: field.dump_to or name for name, field in generated().fields.items()}
+        _generated.update(schema_dict=schema_dict, ckan_fields=ckan_fields, published_names=published_names)
+        return _generated
+
+class LazySchemaMapping(Mapping):
+    # A read-only view of one of the mappings made by build_schemas, which
+    # only generates the schemas once something is looked up.
+    def __init__(self, name):
+        self.name = name
+
+    def __getitem__(self, key):
+        return build_schemas()[self.name][key]
+
+    def __iter__(self):
+        return iter(build_schemas()[self.name])
+
+    def __len__(self):
+        return len(build_schemas()[self.name])
+
+schema_dict = LazySchemaMapping('schema_dict')
+ckan_fields = LazySchemaMapping('ckan_fields')
+published_names = LazySchemaMapping('published_names')
+
+def __getattr__(name):
+    # The generated schema classes (EventsSchema, ...) are made on demand.
+    if name.endswith('Schema') and not name.startswith('_'):
+        build_schemas()
+        if name in globals():
+            return globals()[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
 def write_to_csv(filename,list_of_dicts,keys):
     with open(filename, 'w') as output_file:
         dict_writer = csv.DictWriter(output_file, keys, extrasaction='ignore', lineterminator='\n')
         dict_writer.writeheader()
         dict_writer.writerows(list_of_dicts)
 
+def data_directory():
+    # The directory containing DATA_PATH, where the tmp directory and the
+    # state files live.
+    dpath = '/'.join(DATA_PATH.split("/")[:-1]) + '/'
+    if dpath == '/':
+        dpath = ''
+    return dpath
+
+# The state file records, for each publishing target (see
+# publishing_target) and table, what was last published there successfully
+# (a digest of the normalized rows, the year_month, and the ETag and
+# Last-Modified headers of the download), so that unchanged exports can be
+# skipped.
+STATE_FILENAME = 'snuffleupghus-state.json'
+_state_lock = threading.Lock()
+
+def publishing_target(server):
+    # The CKAN site and package that a server (in the settings file)
+    # publishes to, which identifies what the state describes, so that
+    # publishing to one server is never skipped because of another.
+    site, _, package_id = open_a_channel(SETTINGS_FILE,server)
+    return "{} {}".format(site.rstrip('/'), package_id)
+
+def target_directory(target):
+    # A directory name for the files kept for a publishing target.
+    return re.sub(r'[^\w.-]+', '_', target)
+
+def load_state():
+    try:
+        with open(data_directory() + STATE_FILENAME) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_json_atomically(filepath,data):
+    tmp_path = filepath + '.tmp'
+    with open(tmp_path,'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, filepath) # Never leave a half-written file behind.
+
+def table_state(table,target):
+    return load_state().get(target, {}).get(table, {})
+
+def save_table_state(table,target,**values):
+    with _state_lock:
+        state = load_state()
+        state.setdefault(target, {})[table] = values
+        write_json_atomically(data_directory() + STATE_FILENAME, state)
+
+def file_hash(filepath):
+    digest = hashlib.sha256()
+    with open(filepath,'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# The journal records which steps of the current run have finished for
+# each publishing target (see publishing_target) and table, along with the year_month and the content hash (the SHA-256
+# of the export file) they were done with, so that a rerun after a failure
+# can pick up at the first unfinished step. A table's entry is removed
+# once all of its steps are done.
+JOURNAL_FILENAME = 'snuffleupghus-journal.json'
+journal_steps = ['download', 'parse', 'current', 'cumulative_archive', 'monthly_archive']
+
+def load_journal():
+    try:
+        with open(data_directory() + JOURNAL_FILENAME) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def finished_steps(table,target,year_month):
+    # Return the finished steps (mapped to the details recorded with them)
+    # and the content hash of an unfinished run of this table (against the
+    # same target) from the same year_month.
+    entry = load_journal().get(target, {}).get(table, {})
+    if entry.get('year_month') != year_month:
+        return {}, None
+    return entry['steps'], entry['content_hash']
+
+def record_step(table,target,step,year_month,content_hash,**details):
+    # Record that a step has finished. Steps recorded with a different
+    # content hash or year_month are forgotten, since they were done
+    # with different data.
+    with _state_lock:
+        journal = load_journal()
+        entry = journal.get(target, {}).get(table, {})
+        if entry.get('year_month') != year_month or entry.get('content_hash') != content_hash:
+            entry = {'year_month': year_month, 'content_hash': content_hash, 'steps': {}}
+        details['finished_at'] = datetime.now().isoformat()
+        entry['steps'][step] = details
+        journal.setdefault(target, {})[table] = entry
+        write_json_atomically(data_directory() + JOURNAL_FILENAME, journal)
+
+def clear_journal(table,target):
+    with _state_lock:
+        journal = load_journal()
+        if table in journal.get(target, {}):
+            del journal[target][table]
+            write_json_atomically(data_directory() + JOURNAL_FILENAME, journal)
+
+# A run touches the same package about a dozen times, so CKAN clients
+# (with their keep-alive connection pools), package metadata, and
+# resource-name-to-ID lookups are shared across calls. Cached metadata
+# expires after CACHE_TTL seconds and is invalidated whenever this script
+# creates a resource.
+CACHE_TTL = 300 # seconds
+CKAN_POOL_SIZE = 10 # Maximum number of pooled connections per CKAN site
+_cache_lock = threading.RLock()
+_ckan_clients = {}
+_package_cache = {}
+_resource_id_cache = {}
+
+@functools.lru_cache(maxsize=None)
+def load_settings(settings_file_path):
+    with open(settings_file_path) as f:
+        return json.load(f)
+
 def open_a_channel(settings_file_path,server):
     # Get parameters to communicate with a CKAN instance
     # from the specified JSON file.
-    with open(settings_file_path) as f:
-        settings = json.load(f)
+    settings = load_settings(settings_file_path)
     site = settings['loader'][server]['ckan_root_url']
     package_id = settings['loader'][server]['package_id']
     API_key = settings['loader'][server]['ckan_api_key']
 
     return site, API_key, package_id
 
+CKAN_PARALLELISM = 2 # Default number of tables that may talk to one CKAN server at once
+_ckan_slots = {}
+
+def set_ckan_parallelism(limit):
+    # Set how many concurrent operations (uploads and archive queries) are
+    # allowed against each CKAN server.
+    global CKAN_PARALLELISM
+    with _cache_lock:
+        CKAN_PARALLELISM = limit
+        _ckan_slots.clear()
+
+def ckan_slot(site):
+    # Return the semaphore that limits concurrent operations against a CKAN server.
+    with _cache_lock:
+        if site not in _ckan_slots:
+            _ckan_slots[site] = threading.BoundedSemaphore(CKAN_PARALLELISM)
+        return _ckan_slots[site]
+
+def get_ckan(site,API_key=None):
+    # Return the shared ckanapi.RemoteCKAN for this (site, API key) pair.
+    import ckanapi, requests
+    from requests.adapters import HTTPAdapter
+    with _cache_lock:
+        if (site,API_key) not in _ckan_clients:
+            session = requests.Session()
+            session.hooks['response'].append(report.count_http_call)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=CKAN_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _ckan_clients[(site,API_key)] = ckanapi.RemoteCKAN(site, apikey=API_key, session=session)
+        return _ckan_clients[(site,API_key)]
+
+def invalidate_package(site,package_id):
+    # Forget cached metadata and resource IDs for a package (e.g., after
+    # a resource has been added to it).
+    with _cache_lock:
+        for key in [k for k in _package_cache if k[:2] == (site,package_id)]:
+            del _package_cache[key]
+        for key in [k for k in _resource_id_cache if k[:2] == (site,package_id)]:
+            del _resource_id_cache[key]
+
+def get_package(site,package_id,API_key=None):
+    # Run package_show, reusing the result if it is less than CACHE_TTL seconds old.
+    key = (site,package_id,API_key)
+    with _cache_lock:
+        cached = _package_cache.get(key)
+    if cached is not None and time.time() - cached[0] < CACHE_TTL:
+        return cached[1]
+    metadata = get_ckan(site,API_key).action.package_show(id=package_id)
+    with _cache_lock:
+        _package_cache[key] = (time.time(), metadata)
+    return metadata
+
 def get_package_parameter(site,package_id,parameter,API_key=None):
     # Some package parameters you can fetch from the WPRDC with
     # this function are:
@@ -241,8 +511,7 @@ def get_package_parameter(site,package_id,parameter,API_key=None):
     # 'temporal_coverage', 'related_documents', 'license_url',
     # 'organization', 'revision_id'
     try:
-        ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
-        metadata = ckan.action.package_show(id=package_id)
+        metadata = get_package(site,package_id,API_key)
         desired_string = metadata[parameter]
         #print("The parameter {} for this package is {}".format(parameter,metadata[parameter]))
     except:
@@ -252,9 +521,16 @@ def get_package_parameter(site,package_id,parameter,API_key=None):
     
 def find_resource_id(site,package_id,resource_name,API_key=None):
     # Get the resource ID given the package ID and resource name.
+    key = (site,package_id,resource_name,API_key)
+    with _cache_lock:
+        cached = _resource_id_cache.get(key)
+    if cached is not None and time.time() - cached[0] < CACHE_TTL:
+        return cached[1]
     resources = get_package_parameter(site,package_id,'resources',API_key)
     for r in resources:
         if r['name'] == resource_name:
+            with _cache_lock:
+                _resource_id_cache[key] = (time.time(), r['id'])
             return r['id']
     return None
 
@@ -264,7 +540,7 @@ def query_resource(site,query,API_key=None):
     # Note that this doesn't work for private datasets. 
     # The relevant CKAN GitHub issue has been closed.
     # https://github.com/ckan/ckan/issues/1954
-    ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
+    ckan = get_ckan(site, API_key)
 
     response = ckan.action.datastore_search_sql(sql=query)
     # A typical response is a dictionary like this
@@ -292,68 +568,555 @@ def query_resource(site,query,API_key=None):
     data = response['records']
     return data
 
-def query_private_resource(site,resource_id,filters,API_key=None,limit=99999999999):
+def query_private_resource(site,resource_id,filters,API_key=None,limit=99999999999,fields=None):
     # Private resources can be queried using the datastore_search API 
-    # endpoint, which supports filters.
-    ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
-    response = ckan.action.datastore_search(id=resource_id,filters=filters,limit=limit)
+    # endpoint, which supports filters (and, through fields, projections).
+    ckan = get_ckan(site, API_key)
+    if fields is None:
+        response = ckan.action.datastore_search(id=resource_id,filters=filters,limit=limit)
+    else:
+        response = ckan.action.datastore_search(id=resource_id,filters=filters,limit=limit,fields=fields)
     data = response['records']
     return data
 
-def query_any_resource(site,query,resource_id,filters,API_key=None,limit=99999999999):
-    ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
+_private_resources = {} # Whether each (site, resource ID) is in a private package
+
+def resource_is_private(site,resource_id,API_key=None):
+    # Determine whether a resource's package is private, remembering the
+    # answer so that resource_show and package_show only get called once
+    # per resource.
+    with _cache_lock:
+        if (site,resource_id) in _private_resources:
+            return _private_resources[(site,resource_id)]
+    ckan = get_ckan(site, API_key)
     # From resource ID determine package ID.
     package_id = ckan.action.resource_show(id=resource_id)['package_id']
     # From package ID determine if the package is private.
-    private = ckan.action.package_show(id=package_id)['private']
-    if private:
+    private = get_package(site,package_id,API_key)['private']
+    with _cache_lock:
+        _private_resources[(site,resource_id)] = private
+    return private
+
+def query_any_resource(site,query,resource_id,filters,API_key=None,limit=99999999999,fields=None):
+    # The fields argument, if given, should match the columns that the query selects.
+    if resource_is_private(site,resource_id,API_key):
         #print("As of February 2018, CKAN still doesn't allow you to run a datastore_search_sql query on a private dataset. Sorry. See this GitHub issue if you want to know a little more: https://github.com/ckan/ckan/issues/1954")
         #raise ValueError("CKAN can't query private resources (like {}) yet.".format(resource_id))
-        return query_private_resource(site,resource_id,filters,API_key,limit)
+        return query_private_resource(site,resource_id,filters,API_key,limit,fields)
     else:
         return query_resource(site,query,API_key)
 
-def parse_file(filepath,basename):
-    replacement_headers = {"Recurring, One-Time or One-on-One?": "recurrence",
-                            "Program (Facility) Name": "program_or_facility",
-                            "(Event) Recommended For :": "recommended_for",
-                            "(Event) Requirements": "requirements",
-                            "(Safe Place) Recommended For :": "recommended_for",
-                            "(Safe Place) Requirements": "requirements",
-                            "(Service) Recommended For :": "recommended_for",
-                            "(Service) Requirements": "requirements"
-                            }
-
-    # Use local file
-    f = open(filepath,'r', newline='')
-    # "If newline='' is not specified, newlines embedded inside quoted fields will not be interpreted correctly,..."
-    #   - the official Python documentation
-    # This unfortunately didn't have the desired effect as there's still a lingering newline in 
-    # the last field read.
-    f.readline() #f.next() # Skip the first line, since it gives the delimiter.
-    reader = csv.DictReader(f, delimiter='|', quotechar='"') 
-    list_of_dicts = list(reader) 
-    f.close()
-    f = open(filepath,'r')
-    _ = f.readline()
-    headers = f.readline()[:-1].split('|')
+def count_resource(site,resource_id,filters,API_key=None):
+    # Count the records matching the filters with a COUNT(*) query, rather
+    # than downloading them. (Like query_resource, this only works for
+    # public datasets.)
+    conditions = ["\"{}\" = '{}'".format(field,str(value).replace("'","''")) for field, value in filters.items()]
+    query = "SELECT COUNT(*) AS count FROM \"{}\"".format(resource_id)
+    if len(conditions) > 0:
+        query += " WHERE " + " AND ".join(conditions)
+    return int(query_resource(site,query,API_key)[0]['count'])
 
-    new_headers = []
-    for header in headers:
-        if header in replacement_headers.keys():
-            old_header = header
-            header = replacement_headers[header]
-            for x in list_of_dicts:
-                x[header] = x[old_header]
-                del x[old_header]
-        new_headers.append(header)
+def count_private_resource(site,resource_id,filters,API_key=None):
+    # A datastore_search with limit=0 returns no records, but its 'total'
+    # field still gives the number of matching records.
+    ckan = get_ckan(site, API_key)
+    response = ckan.action.datastore_search(id=resource_id,filters=filters,limit=0)
+    return response['total']
+
+def count_any_resource(site,resource_id,filters,API_key=None):
+    if resource_is_private(site,resource_id,API_key):
+        return count_private_resource(site,resource_id,filters,API_key)
+    else:
+        return count_resource(site,resource_id,filters,API_key)
+
+BIGBURGH_URL = "http://bigburgh.com/csvdownload/{}.csv" # Where the exports are downloaded from, given the table name
+DOWNLOAD_TIMEOUT = (10, 120) # (connect, read) timeouts, in seconds, for fetching the exports
+DOWNLOAD_CHUNK_SIZE = 256*1024 # Bytes read from the response at a time when streaming an export
+line_ending_pattern = re.compile(r'\r\n|\r|\n')
+
+@functools.lru_cache(maxsize=None)
+def download_session():
+    # A single session shared by all the export downloads, so that the
+    # connections to bigburgh.com are reused.
+    import requests
+    session = requests.Session()
+    session.hooks['response'].append(report.count_http_call)
+    return session
+
+def fetched_export_path(table):
+    # Where a table's export is downloaded to (by the pipeline or the fetch subcommand).
+    return "{}tmp/{}-with-pipes.csv".format(data_directory(),table)
+
+def fetched_validators_path(table):
+    # Where the fetch subcommand keeps the ETag and Last-Modified of the export it downloaded.
+    return "{}tmp/{}-with-pipes.json".format(data_directory(),table)
+
+def fetched_validators(table,content_hash):
+    # The ETag and Last-Modified of the fetched export, if the file with the
+    # given content hash is the one that was fetched (and otherwise, {}).
+    try:
+        with open(fetched_validators_path(table)) as f:
+            validators = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return validators if validators.get('content_hash') == content_hash else {}
+
+def conditional_headers(last_publish):
+    # Make the request for an export conditional, so that an unchanged file
+    # isn't transferred at all.
+    request_headers = {}
+    if last_publish.get('etag') is not None:
+        request_headers['If-None-Match'] = last_publish['etag']
+    if last_publish.get('last_modified') is not None:
+        request_headers['If-Modified-Since'] = last_publish['last_modified']
+    return request_headers
+
+def download_export(table,filepath,request_headers=None):
+    # Download a table's export to filepath in chunks, returning the number
+    # of bytes and the ETag and Last-Modified headers (or None, if the
+    # request was conditional and the export hasn't changed).
+    with download_session().get(BIGBURGH_URL.format(table), headers=request_headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        size = sum(len(chunk) for chunk in export_chunks(response, copy_path=filepath))
+        return size, response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+def export_chunks(response,digest=None,copy_path=None):
+    # Yield the body of a streamed response in chunks, feeding each one to
+    # digest (a hashlib object) and counting its bytes toward the current
+    # report stage. If copy_path is given, the raw export is also written
+    # there (which is only needed for debugging).
+    copy = open(copy_path,'wb') if copy_path is not None else None
+    try:
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if digest is not None:
+                digest.update(chunk)
+            if copy is not None:
+                copy.write(chunk)
+            report.increment('bytes', len(chunk))
+            yield chunk
+    finally:
+        if copy is not None:
+            copy.close()
+
+def decoded_lines(chunks,encoding='utf-8'):
+    # Incrementally decode byte chunks into lines, keeping their line
+    # endings (just like iterating over a file opened with newline=''),
+    # so that the csv module can read quoted fields with embedded newlines.
+    decoder = codecs.getincrementaldecoder(encoding)()
+    remainder = ''
+    for chunk in chunks:
+        text = remainder + decoder.decode(chunk)
+        start = 0
+        for match in line_ending_pattern.finditer(text):
+            if match.end() == len(text) and match.group() == '\r':
+                break # This could be the first half of a \r\n split across chunks.
+            yield text[start:match.end()]
+            start = match.end()
+        remainder = text[start:]
+    remainder += decoder.decode(b'', final=True)
+    if remainder != '':
+        yield remainder
+
+replacement_headers = {"Recurring, One-Time or One-on-One?": "recurrence",
+                        "Program (Facility) Name": "program_or_facility",
+                        "(Event) Recommended For :": "recommended_for",
+                        "(Event) Requirements": "requirements",
+                        "(Safe Place) Recommended For :": "recommended_for",
+                        "(Safe Place) Requirements": "requirements",
+                        "(Service) Recommended For :": "recommended_for",
+                        "(Service) Requirements": "requirements"
+                        }
+
+def schema_header(header):
+    # The field name that the wprdc-etl extractor makes of a header (like
+    # "Program Lat and Long"), which is what the schemas expect.
+    return header.lower().replace(' ', '_')
+
+def read_export(lines):
+    # Given an iterable of lines from a BigBurgh export, skip the first line
+    # (which gives the delimiter), read the header line, and rename the
+    # headers once, at the header level, rather than rewriting every row.
+    # The headers that the extractor's renaming would mangle are replaced
+    # (see replacement_headers), and the rest are renamed the way it does.
+    # Returns the original headers, the renamed headers, and a lazy reader
+    # that yields one dict (keyed by the renamed headers) per row.
+    lines = iter(lines)
+    next(lines, None) # Skip the first line, since it gives the delimiter.
+    reader = csv.DictReader(lines, delimiter='|', quotechar='"')
+    headers = reader.fieldnames or []
+    new_headers = [replacement_headers.get(header,schema_header(header)) for header in headers]
+    reader.fieldnames = new_headers
+    return headers, new_headers, reader
+
+def stream_to_csv(rows,outputfilepath,keys,digest=None):
+    # Write each row to the tmp CSV file as it passes through, so that the
+    # whole file never has to be held in memory at once. If a hashlib
+    # object is given as digest, it is updated with each written row.
+    # If outputfilepath is None, no file is written (but the rows still
+    # pass through, and the digest is still computed).
+    with (open(outputfilepath, 'w') if outputfilepath is not None else nullcontext()) as output_file:
+        if output_file is not None:
+            dict_writer = csv.DictWriter(output_file, keys, extrasaction='ignore', lineterminator='\n')
+            dict_writer.writeheader()
+        if digest is not None:
+            digest.update(json.dumps(keys).encode('utf-8'))
+        for row in rows:
+            if output_file is not None:
+                dict_writer.writerow(row)
+            if digest is not None:
+                digest.update(json.dumps([row.get(k) for k in keys]).encode('utf-8'))
+            yield row
+
+def parse_lines(lines,outputfilepath,streaming=False,digest=None,year_month=None,normalize=True,profile=None,table=None):
+    # Convert an iterable of lines from a pipe-delimited export into a
+    # comma-delimited tmp file at outputfilepath in a single pass. By
+    # default, the rows are also returned in a compact Shelf (see shelf.py).
+    # In streaming mode, the rows are written out as they are read and only
+    # the number of rows is returned in place of the shelf, so memory use
+    # stays flat regardless of file size. Otherwise, outputfilepath can be
+    # None, to keep the rows only in the shelf.
+    # digest (optional) is a hashlib object to feed the normalized rows to.
+    # Unless normalize is False, the rows are run through normalize_rows,
+    # with year_month defaulting to the current one and the coordinates
+    # parsed the way table's schema parses them. If a DataProfile is
+    # given, the rows are profiled along the way (and malformed coordinates
+    # are counted there, rather than raising an exception).
+    if year_month is None:
+        year_month = datetime.strftime(datetime.now(),"%Y%m")
+    headers, new_headers, rows = read_export(lines)
+    if normalize:
+        rows = normalize_rows(rows,year_month,malformed=None if profile is None else profile.malformed_coordinates,
+            pattern=coordinates_pattern(table))
+        new_headers = normalized_headers(new_headers)
+    if profile is not None:
+        rows = profile.observe(rows)
+    rows = stream_to_csv(rows,outputfilepath,new_headers,digest)
+    if streaming:
+        shelf = 0
+        for _ in rows:
+            shelf += 1
+    else:
+        shelf = Shelf(new_headers, shelf_interned_fields)
+        shelf.extend(rows)
+    return shelf, headers
+
+def parse_file(filepath,basename,streaming=False,digest=None,year_month=None,normalize=True,profile=None,table=None):
+    # Parse the pipe-delimited file at filepath (see parse_lines) into
+    # tmp/{basename}.csv, next to it. table defaults to basename.
     dpath = '/'.join(filepath.split("/")[:-1]) + '/'
     if dpath == '/':
         dpath = ''
     outputfilepath = "{}tmp/{}.csv".format(dpath,basename)
-    # [ ] If the temp directory doesn't exist, create it. 
-    write_to_csv(outputfilepath,list_of_dicts,new_headers)
-    return list_of_dicts, headers, outputfilepath
+    # [ ] If the temp directory doesn't exist, create it.
+
+    # "If newline='' is not specified, newlines embedded inside quoted fields will not be interpreted correctly,..."
+    #   - the official Python documentation
+    with open(filepath,'r', newline='') as f:
+        shelf, headers = parse_lines(f,outputfilepath,streaming,digest,year_month,normalize,profile,table or basename)
+    return shelf, headers, outputfilepath
+
+# The exports are profiled as they're parsed (see data_profile.py), and a
+# table whose export fails the QUALITY_THRESHOLDS isn't published. None
+# turns the blocking off (though the profile still goes into the run report).
+QUALITY_THRESHOLDS = DEFAULT_THRESHOLDS
+
+def set_quality_thresholds(thresholds):
+    global QUALITY_THRESHOLDS
+    QUALITY_THRESHOLDS = thresholds
+
+def table_profile(table):
+    # A DataProfile for an export of the table, which checks the table's
+    # name (its first identity field) for repeats and empty values.
+    return DataProfile(table_registry[table]['identity_fields'][0])
+
+def quality_problems(table,profile):
+    # Describe the thresholds that the table's profiled export fails.
+    if QUALITY_THRESHOLDS is None:
+        return []
+    return profile.problems(QUALITY_THRESHOLDS)
+
+# Uploads can be split into batches of UPLOAD_BATCH_SIZE rows, which are
+# sent with datastore_upsert by a pool of UPLOAD_WORKERS threads (with at
+# most twice that many batches in flight), and each failed batch is retried
+# up to UPLOAD_RETRIES times with exponential backoff. If UPLOAD_BATCH_SIZE
+# is None, transmit hands the whole file to the wprdc-etl pipeline instead.
+UPLOAD_BATCH_SIZE = None
+UPLOAD_WORKERS = 4
+UPLOAD_RETRIES = 3
+
+def set_upload_batching(batch_size,workers=UPLOAD_WORKERS,retries=UPLOAD_RETRIES):
+    global UPLOAD_BATCH_SIZE, UPLOAD_WORKERS, UPLOAD_RETRIES
+    UPLOAD_BATCH_SIZE, UPLOAD_WORKERS, UPLOAD_RETRIES = batch_size, workers, retries
+
+# Loading rows through the schemas is CPU-bound, so if VALIDATION_PROCESSES
+# is more than 1, transform_rows splits the rows into chunks of
+# VALIDATION_CHUNK_SIZE and loads them in a pool of that many worker
+# processes (shared by all the tables, with at most twice as many chunks in
+# flight as there are processes), yielding the records in their original order.
+VALIDATION_PROCESSES = None
+VALIDATION_CHUNK_SIZE = 2000
+MAX_REPORTED_ERRORS = 10 # Rows with errors described in the exception
+_validation_pool = None
+
+def set_validation_processes(processes):
+    global VALIDATION_PROCESSES, _validation_pool
+    with _cache_lock:
+        if processes != VALIDATION_PROCESSES and _validation_pool is not None:
+            _validation_pool.shutdown(cancel_futures=True)
+            _validation_pool = None
+        VALIDATION_PROCESSES = processes
+
+def validation_pool():
+    global _validation_pool
+    with _cache_lock:
+        if _validation_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # The workers are spawned rather than forked, since the tables
+            # are processed in threads. (Each worker imports this module and
+            # generates the schemas the first time it unpickles one.)
+            _validation_pool = ProcessPoolExecutor(max_workers=VALIDATION_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn'))
+        return _validation_pool
+
+def numbered_rows(f):
+    # Read a CSV file (with headers) as (line number, row) pairs, where the
+    # line number is that of the line the row starts on. (For a tmp CSV
+    # file, that isn't the line of the export it came from, since the
+    # export's sep= line and any embedded line breaks are gone.)
+    reader = csv.DictReader(f)
+    reader.fieldnames # Reads the headers.
+    last_line = reader.line_num
+    for row in reader:
+        yield last_line + 1, row
+        last_line = reader.line_num
+
+def tmp_file_description(filepath):
+    # How errors refer to a tmp CSV file (whose line numbers differ from the export's).
+    return "the parsed (comma-delimited) file {}".format(filepath)
+
+def load_chunk(schema,chunk):
+    # Load a chunk of (number, row) pairs through the schema (in a worker
+    # process) and return the dumped records, the (position in the chunk,
+    # number, errors) of each row that failed to load, and the seconds spent.
+    s = schema()
+    records, failures = [], []
+    start = time.time()
+    for position, (number, row) in enumerate(chunk):
+        data, errors = s.load(row)
+        if errors:
+            failures.append((position, number, errors))
+        else:
+            records.append(s.dump(data).data)
+    return records, failures, time.time() - start
+
+def load_error(schema,failures,label,source=None):
+    # The exception for the (position, number, errors) of the failed rows
+    # (of source, the file that the numbers refer to, if given).
+    of_source = "" if source is None else " of {}".format(source)
+    if len(failures) == 1:
+        _, number, errors = failures[0]
+        return ValueError("{} {}{} could not be loaded through {}: {}".format(label.capitalize(),number,of_source,schema.__name__,errors))
+    described = "; ".join("{} {}: {}".format(label,number,errors) for _, number, errors in failures[:MAX_REPORTED_ERRORS])
+    if len(failures) > MAX_REPORTED_ERRORS:
+        described += "; and {} more".format(len(failures) - MAX_REPORTED_ERRORS)
+    return ValueError("{} rows{} could not be loaded through {}: {}".format(len(failures),of_source,schema.__name__,described))
+
+def transform_rows(schema,rows,numbered=None,source=None):
+    # Load each row through the schema and dump it under the published
+    # field names, as the pipeline would. The rows can also be given as
+    # (number, row) pairs (like those from numbered_rows), with numbered
+    # saying what the numbers count ('line' or 'row'), so that errors can
+    # point to where the bad rows came from. Otherwise, errors give the
+    # position of the row among the rows. source describes the file that
+    # the numbers refer to (for the errors).
+    label = numbered or 'row'
+    pairs = rows if numbered else enumerate(rows, 1)
+    schema_seconds = 0.0
+    try:
+        if VALIDATION_PROCESSES is None or VALIDATION_PROCESSES <= 1:
+            s = schema()
+            for number, row in pairs:
+                start = time.time()
+                data, errors = s.load(row)
+                if errors:
+                    raise load_error(schema,[(0, number, errors)],label,source)
+                dumped = s.dump(data).data
+                schema_seconds += time.time() - start
+                yield dumped
+        else:
+            pool = validation_pool()
+            futures = deque()
+            try:
+                chunks = batches(pairs, VALIDATION_CHUNK_SIZE)
+                for chunk in chunks:
+                    futures.append(pool.submit(load_chunk, schema, chunk))
+                    if len(futures) == 2*VALIDATION_PROCESSES:
+                        break
+                while len(futures) > 0:
+                    records, failures, seconds = futures.popleft().result()
+                    schema_seconds += seconds
+                    report.increment('validation_chunks')
+                    chunk = next(chunks, None) # Keep the pool busy while the records are used.
+                    if chunk is not None:
+                        futures.append(pool.submit(load_chunk, schema, chunk))
+                    if len(failures) > 0:
+                        # Like the serial loading, yield the records before the first bad row.
+                        yield from records[:failures[0][0]]
+                        raise load_error(schema,failures,label,source)
+                    yield from records
+            finally:
+                for future in futures: # If loading stopped early
+                    future.cancel()
+    finally:
+        report.increment('schema_seconds', round(schema_seconds, 3))
+
+def batches(rows,batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def send_batch(ckan,resource_id,records,method,batch_number,retries,stage=None):
+    with report.attach(stage):
+        return _send_batch(ckan,resource_id,records,method,batch_number,retries)
+
+def never_sent(e):
+    # Whether a failed request certainly never reached the server (because
+    # no connection could be made), so that sending it again can't repeat
+    # anything the server already did.
+    import requests
+    from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(e, requests.exceptions.ConnectionError) and len(e.args) > 0:
+        return isinstance(getattr(e.args[0], 'reason', None), (ConnectTimeoutError, NewConnectionError))
+    return False
+
+def _send_batch(ckan,resource_id,records,method,batch_number,retries):
+    # Inserts are only retried if they never reached CKAN, since after a
+    # read timeout or a server error, CKAN may have committed the batch
+    # anyway, and inserting it again would duplicate its rows. (Upserts
+    # can be repeated safely.)
+    import ckanapi
+    for attempt in range(retries+1):
+        start = time.time()
+        try:
+            ckan.action.datastore_upsert(resource_id=resource_id, records=records, method=method, force=True)
+        except (ckanapi.ValidationError, ckanapi.NotAuthorized, ckanapi.NotFound):
+            raise # Sending the same records again won't help.
+        except Exception as e:
+            if method == 'insert' and not never_sent(e):
+                print("Batch {} failed ({}). It may have been inserted anyway, so it won't be sent again.".format(batch_number,e))
+                raise
+            if attempt == retries:
+                raise
+            delay = 2**attempt
+            print("Batch {} failed ({}). Retrying in {} seconds.".format(batch_number,e,delay))
+            time.sleep(delay)
+            continue
+        elapsed = time.time() - start
+        print("Batch {}: {} rows in {:.2f} seconds ({:.0f} rows/second)".format(batch_number,len(records),elapsed,len(records)/max(elapsed,1e-6)))
+        report.increment('batches')
+        return len(records)
+
+def upload_in_batches(site,resource_id,records,API_key=None,method='insert',batch_size=None,workers=None,retries=None):
+    # Send the records to the datastore in batches, over a small pool of
+    # worker threads. Returns the number of records sent. (Batches may
+    # finish out of order, so the rows' _id values won't necessarily follow
+    # the order of the records.)
+    batch_size = batch_size or UPLOAD_BATCH_SIZE or 10000
+    workers = workers or UPLOAD_WORKERS
+    retries = UPLOAD_RETRIES if retries is None else retries
+    ckan = get_ckan(site, API_key)
+    in_flight = threading.BoundedSemaphore(2*workers)
+    futures = []
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_number, batch in enumerate(batches(records,batch_size), 1):
+            in_flight.acquire()
+            if any(f.done() and f.exception() is not None for f in futures):
+                in_flight.release()
+                break # Stop sending batches once one has failed for good.
+            future = executor.submit(send_batch, ckan, resource_id, batch, method, batch_number, retries, report.current())
+            future.add_done_callback(lambda f: in_flight.release())
+            futures.append(future)
+    total = sum(f.result() for f in futures) # Raises the exception of any failed batch.
+    elapsed = time.time() - start
+    print("Sent {} rows in {} batches in {:.2f} seconds ({:.0f} rows/second)".format(total,len(futures),elapsed,total/max(elapsed,1e-6)))
+    return total
+
+def fan_out(site,rows,schema,destinations,API_key=None,batch_size=None,workers=None,retries=None):
+    # Load the rows (dicts, as read from a tmp CSV file) through the schema
+    # just once, and insert the resulting records into every destination,
+    # in batches, over a small pool of worker threads (as upload_in_batches
+    # does for a single resource). Each destination is a dict with a name,
+    # the resource_id to insert into, and optionally accept (a predicate
+    # that picks out the rows to send there) and add_fields (fields to add
+    # to each record, like the year_month of an archive). Rows that no
+    # destination accepts aren't loaded at all. Returns the number of
+    # records sent to each destination.
+    batch_size = batch_size or UPLOAD_BATCH_SIZE or 10000
+    workers = workers or UPLOAD_WORKERS
+    retries = UPLOAD_RETRIES if retries is None else retries
+    ckan = get_ckan(site, API_key)
+    in_flight = threading.BoundedSemaphore(2*workers)
+    futures = [] # (destination index, future)
+    pending = [[] for _ in destinations]
+    batch_counts = [0 for _ in destinations]
+    wanted_by = deque() # The destinations of each row on its way through the schema
+
+    def wanted_rows():
+        for row_number, row in enumerate(rows, 1):
+            # Every predicate sees every row exactly once, since some keep count.
+            wanted = [i for i, d in enumerate(destinations) if d.get('accept') is None or d['accept'](row)]
+            if len(wanted) > 0:
+                wanted_by.append(wanted)
+                yield row_number, row
+
+    def submit(executor,i):
+        # Send the pending batch of destination i. Returns False once any batch has failed for good.
+        in_flight.acquire()
+        if any(f.done() and f.exception() is not None for _, f in futures):
+            in_flight.release()
+            return False
+        batch_counts[i] += 1
+        batch_name = "{} ({})".format(batch_counts[i],destinations[i]['name'])
+        future = executor.submit(send_batch, ckan, destinations[i]['resource_id'], pending[i], 'insert', batch_name, retries, report.current())
+        future.add_done_callback(lambda f: in_flight.release())
+        futures.append((i, future))
+        pending[i] = []
+        return True
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        healthy = True
+        for record in transform_rows(schema, wanted_rows(), 'row'):
+            for i in wanted_by.popleft():
+                add_fields = destinations[i].get('add_fields')
+                pending[i].append(dict(record, **add_fields) if add_fields else record)
+                if len(pending[i]) == batch_size:
+                    healthy = submit(executor, i) and healthy
+            if not healthy:
+                break # Stop sending batches once one has failed for good.
+        else:
+            for i in range(len(destinations)):
+                if len(pending[i]) > 0:
+                    submit(executor, i)
+    sent = [0 for _ in destinations]
+    for i, future in futures:
+        sent[i] += future.result() # Raises the exception of any failed batch.
+    elapsed = time.time() - start
+    for d, count, batch_count in zip(destinations, sent, batch_counts):
+        print("Sent {} rows to {} in {} batches".format(count,d['name'],batch_count))
+    print("Fanned out {} rows in {:.2f} seconds".format(sum(sent),elapsed))
+    return sent
 
 def transmit(**kwargs):
     target = kwargs.pop('target') # raise ValueError('Target file must be specified.')
@@ -369,8 +1132,9 @@ def transmit(**kwargs):
     pipe_name = kwargs.pop('pipe_name', 'generic_pipeline_name')
     clear_first = kwargs.pop('clear_first', False) # If this parameter is true,
     # the datastore will be deleted (leaving the resource intact).
+    batch_size = kwargs.pop('batch_size', UPLOAD_BATCH_SIZE) # See upload_in_batches.
 
-    log = open('uploaded.log', 'w+')
+    log = open('uploaded.log', 'a')
 
 
     # There's two versions of kwargs running around now: One for passing to transmit, and one for passing to the pipeline.
@@ -385,30 +1149,46 @@ def transmit(**kwargs):
         resource_specifier = kwargs['resource_id']
     
     print("Preparing to pipe data from {} to resource {} package ID {} on {}".format(target,resource_specifier,package_id,site))
+    report.increment('bytes', os.path.getsize(target))
 
-    a_pipeline = pl.Pipeline(pipe_name,
-                              pipe_name,
-                              log_status=False,
-                              settings_file=SETTINGS_FILE,
-                              settings_from_file=True
-                              ) \
-        .connect(pl.FileConnector, target, encoding='utf-8') \
-        .extract(pl.CSVExtractor, firstline_headers=True) \
-        .schema(schema) \
-        .load(pl.CKANDatastoreLoader, server,
-              fields=fields_to_publish,
-              clear_first=clear_first,
-              #package_id=package_id,
-              #resource_id=resource_id,
-              #resource_name=resource_name,
-              #key_fields=['dtd','lien_description','tax_year','pin','block_lot','assignee'],
-              # A potential problem with making the pin field a key is that one property
-              # could have two different PINs (due to the alternate PIN) though I
-              # have gone to some lengths to avoid this.
-              method=update_method,
-              **kwargs).run()
+    with ckan_slot(site):
+        if batch_size is not None:
+            resource_id = kwargs.get('resource_id')
+            if resource_id is None:
+                resource_id = prepare_datastore(site,package_id,kwargs['resource_name'],fields_to_publish,API_key,truncate=clear_first)
+            elif clear_first:
+                get_ckan(site, API_key).action.datastore_delete(id=resource_id, filters={}, force=True)
+            with open(target, newline='', encoding='utf-8') as f:
+                records = transform_rows(schema, numbered_rows(f), 'line', tmp_file_description(target))
+                upload_in_batches(site, resource_id, records, API_key, update_method, batch_size)
+            kwargs['resource_id'] = resource_id
+            kwargs.pop('resource_name', None)
+        else:
+            pl = etl()
+            a_pipeline = pl.Pipeline(pipe_name,
+                                      pipe_name,
+                                      log_status=False,
+                                      settings_file=SETTINGS_FILE,
+                                      settings_from_file=True
+                                      ) \
+                .connect(pl.FileConnector, target, encoding='utf-8') \
+                .extract(pl.CSVExtractor, firstline_headers=True) \
+                .schema(schema) \
+                .load(pl.CKANDatastoreLoader, server,
+                      fields=fields_to_publish,
+                      clear_first=clear_first,
+                      #package_id=package_id,
+                      #resource_id=resource_id,
+                      #resource_name=resource_name,
+                      #key_fields=['dtd','lien_description','tax_year','pin','block_lot','assignee'],
+                      # A potential problem with making the pin field a key is that one property
+                      # could have two different PINs (due to the alternate PIN) though I
+                      # have gone to some lengths to avoid this.
+                      method=update_method,
+                      **kwargs).run()
 
     if 'resource_name' in kwargs:
+        invalidate_package(site,package_id) # The pipeline may have just created the resource.
         resource_id = find_resource_id(site,package_id,kwargs['resource_name'],API_key)
     else:
         resource_id = kwargs['resource_id']
@@ -426,92 +1206,559 @@ def transmit(**kwargs):
     #    print("Something went wrong.")
     #    return None
 
-def clear_and_upload(kwparams):
-    resource_id = transmit(**kwparams) # This is a hack to get around the ETL framework's limitations. 1) Update (or create) the resource. 
-    time.sleep(0.5)
-    kwparams['clear_first']=True                  # Then...
-    resource_id = transmit(**kwparams) # Clear the datastore and upload the data again.
-    print("(Yes, this data is being deliberately piped to the CKAN resource twice. It has something to do with using the clear_first parameter to clear the datastore, which can only be done if the datastore has already been created, since the ETL framework is flawed.)")
+def datastore_plan(site,package_id,resource_name,fields,API_key=None,truncate=True):
+    # Work out (with read-only lookups) what prepare_datastore has to do to
+    # the named resource. Returns the resource ID (None if the resource
+    # doesn't exist yet) and one of these actions: 'create' (the resource
+    # and its datastore), 'create_datastore', 'rebuild' (the fields have
+    # changed), 'clear', or 'keep'.
+    resource_id = find_resource_id(site,package_id,resource_name,API_key)
+    if resource_id is None:
+        return None, 'create'
+    ckan = get_ckan(site, API_key)
+    if not ckan.action.resource_show(id=resource_id).get('datastore_active'):
+        return resource_id, 'create_datastore'
+    if not truncate:
+        return resource_id, 'keep'
+    existing_fields = ckan.action.datastore_search(id=resource_id,limit=0)['fields']
+    existing_ids = [f['id'] for f in existing_fields if f['id'] != '_id']
+    if existing_ids == [f['id'] for f in fields]:
+        return resource_id, 'clear'
+    return resource_id, 'rebuild'
+
+def prepare_datastore(site,package_id,resource_name,fields,API_key=None,truncate=True):
+    # Make sure that the named resource exists and has an empty datastore
+    # with the given fields, without sending any data: Create the resource
+    # and its datastore if they are missing, truncate the datastore (which
+    # keeps the table and its fields) if it already has the right fields,
+    # and rebuild it if the fields have changed. Returns the resource ID.
+    # If truncate is False, an existing datastore is left as it is.
+    ckan = get_ckan(site, API_key)
+    resource_id, action = datastore_plan(site,package_id,resource_name,fields,API_key,truncate)
+    if action == 'create':
+        response = ckan.action.datastore_create(resource={'package_id': package_id, 'name': resource_name},
+            fields=fields, force=True)
+        invalidate_package(site,package_id)
+        return response['resource_id']
+    if action == 'keep':
+        return resource_id
+    if action == 'clear':
+        ckan.action.datastore_delete(id=resource_id, filters={}, force=True) # An empty filter deletes all the rows but keeps the table.
+        return resource_id
+    if action == 'rebuild':
+        ckan.action.datastore_delete(id=resource_id, force=True) # Without filters, the whole table is deleted.
+    ckan.action.datastore_create(resource_id=resource_id, fields=fields, force=True)
+    return resource_id
+
+def clear_and_upload(kwparams,double_upload=False):
+    # Replace the contents of a resource, uploading the data only once:
+    # prepare_datastore creates the datastore if it is missing and truncates
+    # it otherwise, and then the rows are inserted by a single transmit.
+    if double_upload: # The old way, kept as a fallback.
+        resource_id = transmit(**kwparams) # This is a hack to get around the ETL framework's limitations. 1) Update (or create) the resource.
+        time.sleep(0.5)
+        kwparams['clear_first']=True                  # Then...
+        resource_id = transmit(**kwparams) # Clear the datastore and upload the data again.
+        print("(Yes, this data is being deliberately piped to the CKAN resource twice. It has something to do with using the clear_first parameter to clear the datastore, which can only be done if the datastore has already been created, since the ETL framework is flawed.)")
+        return resource_id
+
+    kwparams = dict(kwparams)
+    server = kwparams.get('server', 'secret-cool-data')
+    site, API_key, package_id = open_a_channel(SETTINGS_FILE,server)
+    resource_name = kwparams.pop('resource_name')
+    kwparams['resource_id'] = prepare_datastore(site,package_id,resource_name,kwparams['fields_to_publish'],API_key)
+    kwparams['clear_first'] = False
+    return transmit(**kwparams)
+
+def build_key_index(site,resource_id,key_columns,year_month,API_key=None):
+    # Build a compact index of the keys already in an archive for one
+    # year_month, using one query that projects just the key columns.
+    # The index is a Counter (a multiset), since keys can repeat.
+    selected = ",".join('"{}"'.format(column) for column in key_columns)
+    query = "SELECT {} FROM \"{}\" WHERE year_month = \'{}\' LIMIT 999999".format(selected,resource_id,year_month)
+    records = query_any_resource(site, query, resource_id, {'year_month': year_month}, API_key, fields=key_columns)
+    # CSV files have empty strings where the datastore may have nulls.
+    return Counter(tuple('' if r[column] is None else r[column] for column in key_columns) for r in records)
+
+def unarchived_filter(identity_fields,key_index):
+    # Return a predicate that accepts the rows (dicts) whose keys aren't
+    # already in the key index (counting multiplicity), adding their keys
+    # to the index. It must see each row exactly once.
+    remaining = Counter(key_index)
+    def accept(row):
+        key = tuple(row[field] for field in identity_fields)
+        if remaining[key] > 0:
+            remaining[key] -= 1
+            return False
+        key_index[key] += 1
+        return True
+    return accept
+
+def write_filtered_rows(filepath,accept,outputfilepath):
+    # Write to outputfilepath those rows of the tmp CSV file at filepath
+    # that the predicate accepts, and return how many rows were written.
+    written = 0
+    with open(filepath, newline='') as f, open(outputfilepath, 'w') as g:
+        reader = csv.DictReader(f)
+        writer = csv.DictWriter(g, reader.fieldnames, lineterminator='\n')
+        writer.writeheader()
+        for row in reader:
+            if accept(row):
+                writer.writerow(row)
+                written += 1
+    return written
+
+def key_filter(identity_fields,keys):
+    # Return a predicate that accepts the rows (dicts) whose identity keys are in keys.
+    keys = set(keys)
+    return lambda row: tuple(row[field] for field in identity_fields) in keys
+
+MAX_CHANGED_FRACTION = 0.5 # Above this fraction of changed keys, a full reload is cheaper than a diff.
+
+def key_rows(headers,rows,identity_fields,fields=None):
+    # Group rows (sequences of values, in the order of headers) into a dict
+    # that maps each identity key (the tuple of identity_fields values) to
+    # the sorted list of rows with that key. Rows are kept as tuples, since
+    # keys aren't guaranteed to be unique. If fields is given, only those
+    # columns are kept (in the order of headers), so that columns that
+    # aren't published (like year_month) don't make rows look changed.
+    headers = list(headers)
+    kept = [p for p, header in enumerate(headers) if fields is None or header in fields]
+    headers = [headers[p] for p in kept]
+    keyed_rows = defaultdict(list)
+    positions = [headers.index(field) for field in identity_fields]
+    for row in rows:
+        row = tuple(row[p] for p in kept)
+        keyed_rows[tuple(row[p] for p in positions)].append(row)
+    for rows in keyed_rows.values():
+        rows.sort()
+    return headers, keyed_rows
+
+def read_keyed_rows(filepath,identity_fields,fields=None):
+    # Read a tmp CSV file into keyed rows (see key_rows).
+    with open(filepath, newline='') as f:
+        reader = csv.reader(f)
+        headers = next(reader)
+        return key_rows(headers,reader,identity_fields,fields)
+
+@contextmanager
+def parsed_rows(filepath,shelf=None):
+    # Provide the parsed rows of a table as dicts: from the shelf, if it's
+    # in memory, and otherwise from the tmp CSV file at filepath.
+    if shelf is not None:
+        yield shelf.dicts()
+    else:
+        with open(filepath, newline='', encoding='utf-8') as f:
+            yield csv.DictReader(f)
+
+def diff_keyed_rows(old_rows,new_rows):
+    # Compare two outputs of read_keyed_rows and return the lists of keys
+    # to be inserted, updated, and deleted.
+    inserts = [key for key in new_rows if key not in old_rows]
+    updates = [key for key in new_rows if key in old_rows and new_rows[key] != old_rows[key]]
+    deletes = [key for key in old_rows if key not in new_rows]
+    return inserts, updates, deletes
+
+def snapshot_path(table,target):
+    # Where the last version of a table's current resource published to
+    # the target (see publishing_target) is kept.
+    return "{}snapshots/{}/{}-current.csv".format(data_directory(),target_directory(target),table)
+
+def spatial_index_path(table):
+    # Where the spatial index of a table's last published rows is kept.
+    return "{}spatial/{}.index".format(data_directory(),table)
+
+def spatial_label_fields(table):
+    # The fields that the spatial index returns for each facility it finds.
+    return table_registry[table]['identity_fields'] + ['program_neighborhood', 'schedule']
+
+def load_spatial_index(table):
+    # Load the spatial index built when the table was last published, for
+    # nearest and within queries (see spatial_index.SpatialIndex).
+    return SpatialIndex.load(spatial_index_path(table))
+
+def local_history(target):
+    # The local, columnar store of the rows archived for each table in
+    # each month, for historical queries (see snapshot_store.SnapshotStore).
+    # Each publishing target (see publishing_target) has its own, since
+    # what one server's archives hold says nothing about another's.
+    return SnapshotStore(data_directory() + 'history/' + target_directory(target) + '/')
+
+def archived_locally(table,target,year_month,filepath,shelf_size,identity_fields=None,shelf=None):
+    # Check the local history for whether all the rows of the tmp CSV file
+    # at filepath (or the shelf) were already archived for year_month, which
+    # saves counting (and indexing) the rows of the cumulative archive on CKAN.
+    history = local_history(target)
+    try:
+        if not history.has(table,year_month):
+            return False
+        if identity_fields is None:
+            return history.count(table,year_month) >= shelf_size
+        archived = history.key_counts(table,year_month,identity_fields)
+    except (ImportError, ValueError): # A snapshot that can't be read here is no help.
+        return False
+    if shelf is not None:
+        keys = Counter(shelf.keys(identity_fields))
+    else:
+        with open(filepath, newline='', encoding='utf-8') as f:
+            keys = Counter(tuple(row[field] for field in identity_fields) for row in csv.DictReader(f))
+    return len(keys - archived) == 0
+
+def remember_archived_rows(table,target,year_month,filepath,identity_fields=None,shelf=None):
+    # Now that the cumulative archive has all the rows of the tmp CSV file
+    # (or the shelf) for year_month, add them to the local history (which
+    # keeps the rows archived by earlier runs in the same month).
+    with report.stage('local_history', table) as stage:
+        if shelf is not None:
+            stage['rows'] = local_history(target).merge(table,year_month,shelf.headers,shelf,identity_fields)
+        else:
+            stage['rows'] = local_history(target).merge_csv(table,year_month,filepath,identity_fields)
+
+def save_snapshot(filepath,snapshot_file_path,shelf=None):
+    # Keep a copy of the tmp CSV file (or write out the shelf, whose values
+    # are the same as the file's) as the published snapshot.
+    os.makedirs(os.path.dirname(snapshot_file_path), exist_ok=True)
+    if shelf is None:
+        shutil.copyfile(filepath, snapshot_file_path)
+        return
+    with open(snapshot_file_path + '.tmp', 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(shelf.headers)
+        writer.writerows(shelf)
+    os.replace(snapshot_file_path + '.tmp', snapshot_file_path)
+
+def parsed_file_exists(finished):
+    # Whether an earlier run left a tmp CSV file of its parsed rows.
+    return 'parse' in finished and finished['parse'].get('output') is not None and os.path.exists(finished['parse']['output'])
+
+def diff_current(kwparams,identity_fields,snapshot_file_path,shelf=None):
+    # Work out (with read-only lookups) which rows of the current resource
+    # have changed since the last published snapshot, with rows grouped by
+    # their identity key. Returns the resource ID, the keys whose rows (in
+    # the tmp CSV file) need to be inserted, and the keys whose rows need to
+    # be deleted from the datastore first (those that changed or
+    # disappeared), along with the number of published rows they have.
+    # Whenever the diff can't be trusted (no snapshot, a missing datastore,
+    # a changed set of columns, a row count that doesn't match the
+    # snapshot, or an empty key value that a filter couldn't match), the
+    # keys are returned as None, meaning that the whole resource has to be
+    # reloaded. If the rows are in memory, they can be given as a shelf, so
+    # that the tmp CSV file isn't reread.
+    target = kwparams['target']
+    server = kwparams.get('server', 'secret-cool-data')
+    site, API_key, package_id = open_a_channel(SETTINGS_FILE,server)
+    resource_id = find_resource_id(site,package_id,kwparams['resource_name'],API_key)
+
+    def full_reload(reason):
+        print("Reloading all of {} ({}).".format(kwparams['resource_name'],reason))
+        return resource_id, None, None, 0
+
+    if resource_id is None or not os.path.exists(snapshot_file_path):
+        return full_reload("no previously published snapshot")
+    ckan = get_ckan(site, API_key)
+    if not ckan.action.resource_show(id=resource_id).get('datastore_active'):
+        return full_reload("no datastore")
+
+    # Only the columns that the current resource publishes are compared.
+    # (Every row's year_month changes at the start of each month.)
+    published_fields = published_names[kwparams['schema']]
+    old_headers, old_rows = read_keyed_rows(snapshot_file_path,identity_fields,published_fields)
+    if shelf is not None:
+        new_headers, new_rows = key_rows(shelf.headers,shelf,identity_fields,published_fields)
+    else:
+        new_headers, new_rows = read_keyed_rows(target,identity_fields,published_fields)
+    if old_headers != new_headers:
+        return full_reload("the columns have changed")
+    published_count = ckan.action.datastore_search(id=resource_id,limit=0)['total']
+    if published_count != sum(len(rows) for rows in old_rows.values()):
+        return full_reload("the datastore doesn't match the snapshot")
+
+    inserts, updates, deletes = diff_keyed_rows(old_rows,new_rows)
+    changed_keys = updates + deletes
+    if len(inserts) + len(changed_keys) > MAX_CHANGED_FRACTION * max(len(new_rows),1):
+        return full_reload("too many changes")
+    if any(value == '' for key in changed_keys for value in key):
+        return full_reload("a changed row has an empty identity field")
+    print("{}: {} inserted, {} updated, and {} deleted keys".format(kwparams['resource_name'],len(inserts),len(updates),len(deletes)))
+    return resource_id, inserts + updates, changed_keys, sum(len(old_rows[key]) for key in changed_keys)
+
+def plan_changes(kwparams,identity_fields,snapshot_file_path,shelf=None):
+    # Find the changes since the last published snapshot (see diff_current)
+    # and delete every key whose group of rows has changed or disappeared
+    # from the datastore (with a datastore_delete filter). Returns the
+    # resource ID and the keys whose rows now need to be inserted (or None,
+    # if the whole resource has to be reloaded, in which case nothing is
+    # deleted).
+    resource_id, keys, changed_keys, _ = diff_current(kwparams,identity_fields,snapshot_file_path,shelf)
+    if keys is None:
+        return resource_id, None
+    server = kwparams.get('server', 'secret-cool-data')
+    site, API_key, package_id = open_a_channel(SETTINGS_FILE,server)
+    ckan = get_ckan(site, API_key)
+    # Filters have to use the names of the fields as published.
+    filter_names = [published_names[kwparams['schema']][field] for field in identity_fields]
+    with ckan_slot(site):
+        for key in changed_keys:
+            ckan.action.datastore_delete(id=resource_id, filters=dict(zip(filter_names,key)), force=True)
+    return resource_id, keys
+
+def upload_changes(kwparams,identity_fields,snapshot_file_path):
+    # Bring the current resource up to date by sending only the changes
+    # since the last published snapshot (see plan_changes), falling back
+    # to clear_and_upload when the whole resource has to be reloaded.
+    target = kwparams['target']
+    resource_id, keys = plan_changes(kwparams,identity_fields,snapshot_file_path)
+    if keys is None:
+        resource_id = clear_and_upload(kwparams)
+    elif len(keys) > 0:
+        delta_file_path = re.sub(r'\.csv$', '-delta.csv', target)
+        write_filtered_rows(target, key_filter(identity_fields,keys), delta_file_path)
+        delta_kwparams = dict(kwparams, target = delta_file_path, update_method = 'insert', resource_id = resource_id)
+        del delta_kwparams['resource_name']
+        transmit(**delta_kwparams)
+    save_snapshot(target, snapshot_file_path)
     return resource_id
 
-def get_nth_file_and_insert(fetch_files,n,table,key_fields,resource_designation,server,add_to_archive=False):
+def get_nth_file_and_insert(fetch_files,n,table,key_fields,resource_designation,server,add_to_archive=False,streaming=False,force=False,identity_fields=None,stream_download=False,keep_files=False,local_file=None,update_current=True):
     # Fetch all three CSV files with requests.
     #   events.csv, safePlaces.csv, services.csv
     # Then process them according to their needs.
+    # With stream_download=True, each export is parsed as it arrives,
+    # rather than being saved to disk and read back, and the raw export is
+    # only written out (to tmp/{table}-with-pipes.csv) if keep_files is True.
+    # Without fetch_files, the export is read from local_file. With
+    # update_current=False, only the archives are updated.
     resource_name = "Current List of {}".format(resource_designation)
     archive_resource_name = "{} Archive (Cumulative)".format(resource_designation)
+    current_year_month = datetime.strftime(datetime.now(),"%Y%m")
 
-    if not fetch_files and len(sys.argv) > n+2:
-        # Interpret command-line arguments (after fetch_files and server) as local filenames to use.
+    # If this table was already published this month from identical data,
+    # there's nothing to do. (Unchanged data still has to be published once
+    # each month so that the monthly archive gets created, which is why the
+    # year_month must match too.) force=True publishes regardless.
+    target = publishing_target(server)
+    last_publish = table_state(table,target)
+    if force or last_publish.get('year_month') != current_year_month:
+        last_publish = {}
+    etag = last_modified = None
+    export_lines = None # The lines of an export being streamed straight into the parser
+    # Pick up where an unfinished run this month left off.
+    finished, journaled_hash = ({}, None) if force else finished_steps(table,target,current_year_month)
+
+    if not fetch_files and local_file is not None:
         print("Obtaining {} from local files.".format(table))
-        events_shelf, events_headers, events_file_path = parse_file(sys.argv[n+2],table) # Where a shelf is a list of dictionaries
+        pipe_delimited_file_path = local_file
+        content_hash = file_hash(pipe_delimited_file_path)
+        # The fetch subcommand records the ETag and Last-Modified of what it downloads.
+        validators = fetched_validators(table,content_hash)
+        etag, last_modified = validators.get('etag'), validators.get('last_modified')
     elif fetch_files:
-        print("Getting {} from bigburgh.com".format(table))
-        r = requests.get("http://bigburgh.com/csvdownload/{}.csv".format(table))
-        dpath = '/'.join(DATA_PATH.split("/")[:-1]) + '/'
-        if dpath == '/':
-            dpath = ''
+        dpath = data_directory()
         basename = "pipeorama"
-        pipe_delimited_file_path = "{}tmp/{}-with-pipes.csv".format(dpath,table) # [ ] Eventually delete these files.
-        with open(pipe_delimited_file_path,'wb') as f:
-            f.write(r.content)
-        events_shelf, events_headers, events_file_path = parse_file(pipe_delimited_file_path,table) # Where a shelf is a list of dictionaries
+        pipe_delimited_file_path = fetched_export_path(table) # [ ] Eventually delete these files.
+        if stream_download and parsed_file_exists(finished):
+            # The export was already streamed into the parser by an earlier run.
+            print("Reusing the {} export parsed by an earlier run.".format(table))
+            content_hash = journaled_hash
+            # (If the parse came from a local file, there are no validators.)
+            etag = finished.get('download', {}).get('etag')
+            last_modified = finished.get('download', {}).get('last_modified')
+        elif not stream_download and 'download' in finished and os.path.exists(pipe_delimited_file_path) and file_hash(pipe_delimited_file_path) == journaled_hash:
+            print("Reusing the {} file downloaded by an earlier run.".format(table))
+            etag = finished['download'].get('etag')
+            last_modified = finished['download'].get('last_modified')
+            content_hash = journaled_hash
+        else:
+            print("Getting {} from bigburgh.com".format(table))
+            with report.stage('download', table) as stage:
+                r = download_session().get(BIGBURGH_URL.format(table), headers=conditional_headers(last_publish),
+                    stream=stream_download, timeout=DOWNLOAD_TIMEOUT)
+                if r.status_code == 304:
+                    print("{} has not changed since it was last published. Skipping it.".format(table))
+                    stage['not_modified'] = True
+                    r.close()
+                    return
+                r.raise_for_status()
+                etag = r.headers.get('ETag')
+                last_modified = r.headers.get('Last-Modified')
+                if stream_download:
+                    # The body is read (and hashed) by the parse stage below.
+                    raw_digest = hashlib.sha256()
+                    export_lines = decoded_lines(export_chunks(r, raw_digest,
+                        pipe_delimited_file_path if keep_files else None))
+                else:
+                    with open(pipe_delimited_file_path,'wb') as f:
+                        f.write(r.content)
+                    stage['bytes'] = len(r.content)
+            if export_lines is None:
+                content_hash = file_hash(pipe_delimited_file_path)
+                record_step(table, target, 'download', current_year_month, content_hash, etag=etag, last_modified=last_modified)
+            else:
+                content_hash = None # Not known until the whole export has been read.
 
     #print("events_file_path = {}".format(events_file_path)) This is in tmp/tmp/
     else: # fetch_files is false but the nth file location was not given
-        print("The location of file {} was not specified.".format(n))
+        raise ValueError("There is no {} export to publish. (Give its location, or fetch it.)".format(table))
+
+    if content_hash != journaled_hash:
+        finished = {} # Anything done earlier was done with different data.
+    # With batched uploads, the rows are loaded through the schema once
+    # and fanned out to all the resources at the end, rather than being
+    # run through a separate pipeline for each resource. Then, unless the
+    # export is parsed in streaming mode, the parsed rows are only needed
+    # in memory, and the tmp CSV file is only written if keep_files is True.
+    fanning_out = UPLOAD_BATCH_SIZE is not None
+    write_tmp_file = streaming or not fanning_out or keep_files
+    if parsed_file_exists(finished):
+        print("Reusing the {} file parsed by an earlier run.".format(table))
+        events_file_path = finished['parse']['output']
+        shelf_size = finished['parse']['rows']
+        digest = finished['parse']['digest']
+        shelf = None
+    else:
+        content_digest = hashlib.sha256()
+        profile = table_profile(table)
+        with report.stage('parse', table) as stage:
+            if export_lines is None and write_tmp_file:
+                events_shelf, events_headers, events_file_path = parse_file(pipe_delimited_file_path,table,streaming,content_digest,current_year_month,profile=profile) # Where a shelf is a Shelf of rows
+                stage['bytes'] = os.path.getsize(pipe_delimited_file_path)
+            elif export_lines is None:
+                events_file_path = None
+                with open(pipe_delimited_file_path, 'r', newline='') as f:
+                    events_shelf, events_headers = parse_lines(f,events_file_path,streaming,content_digest,current_year_month,profile=profile,table=table)
+                stage['bytes'] = os.path.getsize(pipe_delimited_file_path)
+            else: # Parse the export as it's downloaded (export_chunks counts the bytes).
+                events_file_path = "{}tmp/tmp/{}.csv".format(dpath,table) if write_tmp_file else None
+                try:
+                    events_shelf, events_headers = parse_lines(export_lines,events_file_path,streaming,content_digest,current_year_month,profile=profile,table=table)
+                finally:
+                    r.close()
+            # In streaming mode, parse_file hands back just the row count.
+            shelf_size = events_shelf if streaming else len(events_shelf)
+            shelf = None if streaming else events_shelf # The rows, if they're in memory
+            stage['rows'] = shelf_size
+            stage['quality'] = profile.as_dict()
+            # Catch a bad export before anything is sent (or the parse is journaled).
+            problems = quality_problems(table,profile)
+            if len(problems) > 0:
+                stage['quality_problems'] = problems
+                raise DataQualityError("The {} export failed the quality checks: {}".format(table,"; ".join(problems)))
+        digest = content_digest.hexdigest()
+        if export_lines is not None:
+            content_hash = raw_digest.hexdigest()
+            record_step(table, target, 'download', current_year_month, content_hash, etag=etag, last_modified=last_modified)
+        record_step(table, target, 'parse', current_year_month, content_hash, output=events_file_path, rows=shelf_size, digest=digest)
+
+    if digest == last_publish.get('digest'):
+        print("The {} rows are identical to the ones last published. Skipping them.".format(table))
+        clear_journal(table,target)
         return
 
     schema = schema_dict[table]
-    events_fields = schema().serialize_to_ckan_fields()
+    events_fields = ckan_fields[table]
     kwparams = dict(target = events_file_path, update_method = 'insert', schema = schema, 
         fields_to_publish = events_fields, key_fields = key_fields,
         pipe_name = 'BigBurghPipe{}'.format(n), resource_name = resource_name,
         server = server)
+    site, API_key, package_id = open_a_channel(SETTINGS_FILE,server)
+    destinations = []
 
-    resource_id = clear_and_upload(kwparams)
+    if 'current' in finished:
+        print("{} was already updated by an earlier run.".format(resource_name))
+    elif not update_current:
+        print("Leaving {} as it is.".format(resource_name))
+    elif fanning_out:
+        if identity_fields is None:
+            current_id, keys = None, None
+        else: # Send only the rows that have changed.
+            current_id, keys = plan_changes(kwparams,identity_fields,snapshot_path(table,target),shelf)
+        if keys is None:
+            current_id = prepare_datastore(site,package_id,resource_name,events_fields,API_key)
+        if keys is None or len(keys) > 0:
+            destinations.append(dict(name=resource_name, step='current', resource_id=current_id,
+                accept=None if keys is None else key_filter(identity_fields,keys)))
+        else: # Nothing to send.
+            save_snapshot(events_file_path, snapshot_path(table,target), shelf)
+            record_step(table, target, 'current', current_year_month, content_hash)
+    else:
+        with report.stage('current', table, rows=shelf_size):
+            if identity_fields is None:
+                resource_id = clear_and_upload(kwparams)
+            else: # Send only the rows that have changed.
+                resource_id = upload_changes(kwparams,identity_fields,snapshot_path(table,target))
+        record_step(table, target, 'current', current_year_month, content_hash)
 
     if add_to_archive:
-        site, API_key, package_id = open_a_channel(SETTINGS_FILE,server)
-       
         # Add to the aggregate archive of all months.
         # Check if there's already enough records in the resource (archive_resource_name)
+        archive_schema = schema_dict[table+'_archive']
+        events_fields = ckan_fields[table+'_archive']
+        archive_filter = None # Picks out the rows that aren't archived yet (if only some are).
         archive_resource_id = find_resource_id(site,package_id,archive_resource_name,API_key)
-        current_year_month = datetime.strftime(datetime.now(),"%Y%m")
-        if archive_resource_id is not None:
-            query = "SELECT * FROM \"{}\" WHERE year_month = \'{}\' LIMIT 999999".format(archive_resource_id,current_year_month)
-            loaded_data = query_any_resource(site, query, archive_resource_id, {'year_month': current_year_month}, API_key)
+        if 'cumulative_archive' in finished:
+            print("{} was already updated by an earlier run.".format(archive_resource_name))
+            archive = False
+        elif archive_resource_id is not None and archived_locally(table,target,current_year_month,events_file_path,shelf_size,identity_fields,shelf):
+            print("According to the local history, {} already has all of this month's {} rows.".format(archive_resource_name,table))
+            archive = False
+        elif archive_resource_id is not None:
+            with ckan_slot(site), report.stage('archive_count', table) as stage:
+                number_of_records = count_any_resource(site, archive_resource_id, {'year_month': current_year_month}, API_key)
+                stage['rows'] = number_of_records
             # Eventually the API key won't be needed here, once the dataset is public.
-            number_of_records = len(loaded_data)
-            # [ ] Check whether any of the loaded_data collides with the new data. (It probably does.)
 
-            if number_of_records >= len(events_shelf): # Assume that the data for the month is sufficiently complete:
+            if number_of_records >= shelf_size: # Assume that the data for the month is sufficiently complete:
                 archive = False
             elif number_of_records == 0: # Definitely insert the new data into the archive.
                 archive = True
                 archive_update_method = 'insert'
+                number_to_archive = shelf_size
+            elif identity_fields is not None:
+                # Only insert the rows that aren't already in this month's archive.
+                archive = True
+                archive_update_method = 'insert'
+                key_columns = [published_names[archive_schema][field] for field in identity_fields]
+                with ckan_slot(site), report.stage('archive_key_index', table) as stage:
+                    key_index = build_key_index(site, archive_resource_id, key_columns, current_year_month, API_key)
+                    stage['rows'] = sum(key_index.values())
+                archive_filter = unarchived_filter(identity_fields, key_index)
+                number_to_archive = None # Not known until the rows have been filtered.
             else:
                 archive = True
                 #archive_update_method = 'insert'
                 # On second thought, let's always insert these records until we find an issue with this.
                 archive_update_method = 'insert'
+                number_to_archive = shelf_size
                 # But in these instances, let's send a message that this should be investigated:
-                msg = "number_of_records = {}, while len(events_shelf) = {}. Inserting new records into {}, but it would be a good idea to check manually for conflicts and see if this is (in general) a good solution.".format(number_of_records, len(events_shelf), archive_resource_name)
+                msg = "number_of_records = {}, while len(events_shelf) = {}. Inserting new records into {}, but it would be a good idea to check manually for conflicts and see if this is (in general) a good solution.".format(number_of_records, shelf_size, archive_resource_name)
                 send_to_slack(msg,username='snuffleupghus',channel='@david',icon=':snuffleupagus:')
         else:
             archive = True
             archive_update_method = 'insert'
+            number_to_archive = shelf_size
 
-
-        archive_schema = schema_dict[table+'_archive']
-        events_fields = archive_schema().serialize_to_ckan_fields()
-        events_fields = [events_fields[-1]] + events_fields[:-1]
-        if archive:
-            # Add year_month field to data through the schema.
-            resource_id = transmit(target = events_file_path, update_method = archive_update_method, 
-                schema = archive_schema, fields_to_publish = events_fields, key_fields = key_fields,
-                pipe_name = 'BigBurghArchivePipe{}'.format(n), 
-                resource_name = archive_resource_name, server = server)
+        if archive and fanning_out:
+            archive_resource_id = prepare_datastore(site,package_id,archive_resource_name,events_fields,API_key,truncate=False)
+            destinations.append(dict(name=archive_resource_name, step='cumulative_archive', resource_id=archive_resource_id,
+                accept=archive_filter, add_fields={'year_month': current_year_month}))
+        else:
+            if archive:
+                archive_target = events_file_path
+                if archive_filter is not None:
+                    archive_target = re.sub(r'\.csv$', '-unarchived.csv', events_file_path)
+                    number_to_archive = write_filtered_rows(events_file_path, archive_filter, archive_target)
+                    print("{} of the {} {} rows are not yet in {}.".format(number_to_archive, shelf_size, table, archive_resource_name))
+                if number_to_archive > 0:
+                    # Add year_month field to data through the schema.
+                    with report.stage('cumulative_archive', table, rows=number_to_archive):
+                        resource_id = transmit(target = archive_target, update_method = archive_update_method, 
+                            schema = archive_schema, fields_to_publish = events_fields, key_fields = key_fields,
+                            pipe_name = 'BigBurghArchivePipe{}'.format(n), 
+                            resource_name = archive_resource_name, server = server)
+                # (When the archive is skipped, the local history is left
+                # alone: a row count doesn't say which rows are there.)
+                remember_archived_rows(table, target, current_year_month, events_file_path, identity_fields, shelf)
+            record_step(table, target, 'cumulative_archive', current_year_month, content_hash)
         
         ##############################################################################################
         # Also, and in any event, reate a new archive for just that month (if it doesn't already exist).
@@ -529,53 +1776,546 @@ def get_nth_file_and_insert(fetch_files,n,table,key_fields,resource_designation,
             # to be added, whereas if you set the key field to be the name of the
             # event, a duplicate (or near duplicate) causes an error when insertions
             # are attempted.
-        resource_id = clear_and_upload(kwparams)
+        if 'monthly_archive' in finished:
+            print("{} was already created by an earlier run.".format(month_archive_resource_name))
+        elif fanning_out:
+            month_archive_resource_id = prepare_datastore(site,package_id,month_archive_resource_name,events_fields,API_key)
+            destinations.append(dict(name=month_archive_resource_name, step='monthly_archive',
+                resource_id=month_archive_resource_id, add_fields={'year_month': current_year_month}))
+        else:
+            with report.stage('monthly_archive', table, rows=shelf_size):
+                resource_id = clear_and_upload(kwparams)
+            record_step(table, target, 'monthly_archive', current_year_month, content_hash)
+
+    if len(destinations) > 0:
+        # Go through the rows once, and send each row everywhere it goes.
+        with ckan_slot(site), report.stage('fan_out', table, destinations=[d['name'] for d in destinations]) as stage:
+            with parsed_rows(events_file_path, shelf) as rows:
+                sent = fan_out(site, rows, schema, destinations, API_key)
+            stage['rows'] = shelf_size
+            if shelf is None:
+                stage['bytes'] = os.path.getsize(events_file_path)
+            stage['rows_sent'] = dict(zip(stage['destinations'], sent))
+        invalidate_package(site,package_id)
+        for d in destinations:
+            if d['step'] == 'current' and identity_fields is not None:
+                save_snapshot(events_file_path, snapshot_path(table,target), shelf)
+            if d['step'] == 'cumulative_archive':
+                remember_archived_rows(table, target, current_year_month, events_file_path, identity_fields, shelf)
+            record_step(table, target, d['step'], current_year_month, content_hash)
+    if add_to_archive:
         print("============================================================")
 
-schema_dict = {'events': EventsSchema,
-                'events_archive': EventsArchiveSchema,
-                'safePlaces': SafePlacesSchema,
-                'safePlaces_archive': SafePlacesArchiveSchema,
-                'services': ServicesSchema,
-                'services_archive': ServicesArchiveSchema
-                }
+    if update_current:
+        # Index the published facilities by location, so that "what's near X"
+        # can be answered without fetching the whole resource.
+        with report.stage('spatial_index', table) as stage:
+            with parsed_rows(events_file_path, shelf) as rows:
+                index = SpatialIndex.from_rows(rows, spatial_label_fields(table))
+            index.save(spatial_index_path(table))
+            stage['rows'] = len(index)
+
+    if update_current and add_to_archive:
+        # Everything went through, so remember what was published. (After
+        # a partial run, the journal is kept, so that a full run can skip
+        # the steps that were done.)
+        save_table_state(table, target, digest=digest, year_month=current_year_month,
+            etag=etag, last_modified=last_modified)
+        clear_journal(table,target)
+
+# The plan mode works out what a run would do to CKAN (which resources get
+# created, cleared, deleted from, or inserted into, and how many rows go
+# where) without writing anything there, by making the same decisions as
+# get_nth_file_and_insert with the same read-only lookups. The size of each
+# upload is estimated by loading a sample of PLAN_SAMPLE_SIZE of its rows
+# through the schema.
+PLAN_SAMPLE_SIZE = 500
+WRITE_ACTIONS = ['create', 'create_datastore', 'rebuild', 'clear', 'delete', 'insert']
+# (A table can also be skipped, or blocked by the quality checks.)
+
+def sample_rows(rows,accept=None):
+    # Count the rows that the predicate accepts (all of them, by default),
+    # keeping the first PLAN_SAMPLE_SIZE of those as a sample.
+    count, sample = 0, []
+    for row in rows:
+        if accept is None or accept(row):
+            count += 1
+            if len(sample) < PLAN_SAMPLE_SIZE:
+                sample.append(row)
+    return count, sample
+
+def payload_estimate(schema,sample,count,add_fields=None):
+    # Estimate the bytes of JSON records that sending count rows like the
+    # sample would take.
+    if count == 0 or len(sample) == 0:
+        return 0
+    sample_bytes = 0
+    for record in transform_rows(schema, sample):
+        sample_bytes += len(json.dumps(dict(record, **add_fields) if add_fields else record))
+    return int(round(sample_bytes*count/len(sample)))
+
+def operation(table,step,resource_name,action,rows=0,payload_bytes=0,**details):
+    op = dict(table=table, step=step, resource=resource_name, action=action, rows=rows, payload_bytes=payload_bytes)
+    if action == 'insert' and UPLOAD_BATCH_SIZE is not None:
+        op['requests'] = -(-rows // UPLOAD_BATCH_SIZE)
+    op.update(details)
+    return op
+
+def plan_table(fetch_files,n,table,resource_designation,server,add_to_archive=False,force=False,identity_fields=None,local_file=None,update_current=True):
+    # Work out what get_nth_file_and_insert would do with a table, and
+    # return the list of operations, without writing anything to CKAN (or
+    # to the state, the journal, the snapshots, or the local history). With
+    # fetch_files, the export is downloaded to where the fetch subcommand
+    # puts it, so that publishing without fetch_files uses the same file.
+    resource_name = "Current List of {}".format(resource_designation)
+    archive_resource_name = "{} Archive (Cumulative)".format(resource_designation)
+    now = datetime.now()
+    current_year_month = datetime.strftime(now,"%Y%m")
+    month_archive_resource_name = "{}-{} {} Archive".format(now.year,datetime.strftime(now,"%m"),resource_designation)
+
+    target = publishing_target(server)
+    last_publish = table_state(table,target)
+    if force or last_publish.get('year_month') != current_year_month:
+        last_publish = {}
+    if not fetch_files and local_file is not None:
+        pipe_delimited_file_path = local_file
+    elif fetch_files:
+        pipe_delimited_file_path = fetched_export_path(table)
+        r = download_session().get(BIGBURGH_URL.format(table), headers=conditional_headers(last_publish), timeout=DOWNLOAD_TIMEOUT)
+        if r.status_code == 304:
+            return [operation(table,'download',None,'skip',reason="not modified since it was last published")]
+        r.raise_for_status()
+        os.makedirs(os.path.dirname(pipe_delimited_file_path), exist_ok=True)
+        with open(pipe_delimited_file_path,'wb') as f:
+            f.write(r.content)
+    else:
+        return [operation(table,'download',None,'skip',reason="no export was given")]
+
+    content_hash = file_hash(pipe_delimited_file_path)
+    finished, journaled_hash = ({}, None) if force else finished_steps(table,target,current_year_month)
+    if content_hash != journaled_hash:
+        finished = {}
+    content_digest = hashlib.sha256()
+    profile = table_profile(table)
+    # The export is parsed into its own tmp file, leaving any parsed by an unfinished run alone.
+    shelf, _, events_file_path = parse_file(pipe_delimited_file_path,table+'-plan',False,content_digest,current_year_month,profile=profile,table=table)
+    try:
+        shelf_size = len(shelf)
+        problems = quality_problems(table,profile)
+        if len(problems) > 0:
+            return [operation(table,'parse',None,'block',rows=shelf_size,reason="; ".join(problems),quality=profile.as_dict())]
+        if content_digest.hexdigest() == last_publish.get('digest'):
+            return [operation(table,'parse',None,'skip',rows=shelf_size,reason="the rows are identical to the ones last published")]
+
+        schema = schema_dict[table]
+        archive_schema = schema_dict[table+'_archive']
+        archive_fields = ckan_fields[table+'_archive']
+        site, API_key, package_id = open_a_channel(SETTINGS_FILE,server)
+        operations = []
+
+        def skip(step,name,reason):
+            operations.append(operation(table,step,name,'skip',reason=reason))
+
+        def prepare(step,name,fields,truncate=True):
+            _, action = datastore_plan(site,package_id,name,fields,API_key,truncate)
+            if action != 'keep':
+                operations.append(operation(table,step,name,action))
+
+        def insert(step,name,schema,accept=None,add_fields=None,**details):
+            count, sample = sample_rows(shelf.dicts(), accept)
+            if count == 0:
+                skip(step,name,"there are no rows to send")
+            else:
+                operations.append(operation(table,step,name,'insert',count,
+                    payload_estimate(schema,sample,count,add_fields),**details))
+
+        if 'current' in finished:
+            skip('current',resource_name,"done by an earlier run")
+        elif not update_current:
+            skip('current',resource_name,"only the archives are being updated")
+        else:
+            keys = None
+            if identity_fields is not None:
+                kwparams = dict(target = events_file_path, schema = schema, resource_name = resource_name, server = server)
+                _, keys, changed_keys, deleted_rows = diff_current(kwparams,identity_fields,snapshot_path(table,target),shelf)
+            if keys is None:
+                prepare('current',resource_name,ckan_fields[table])
+                insert('current',resource_name,schema)
+            else:
+                if len(changed_keys) > 0:
+                    operations.append(operation(table,'current',resource_name,'delete',deleted_rows,keys=len(changed_keys)))
+                insert('current',resource_name,schema,key_filter(identity_fields,keys))
+
+        if add_to_archive:
+            archive_resource_id = find_resource_id(site,package_id,archive_resource_name,API_key)
+            number_of_records = 0
+            if 'cumulative_archive' in finished:
+                skip('cumulative_archive',archive_resource_name,"done by an earlier run")
+            elif archive_resource_id is not None and archived_locally(table,target,current_year_month,events_file_path,shelf_size,identity_fields,shelf):
+                skip('cumulative_archive',archive_resource_name,"the local history has all of this month's rows")
+            else:
+                if archive_resource_id is not None:
+                    number_of_records = count_any_resource(site, archive_resource_id, {'year_month': current_year_month}, API_key)
+                if archive_resource_id is not None and number_of_records >= shelf_size:
+                    skip('cumulative_archive',archive_resource_name,"it already has {} rows for {}".format(number_of_records,current_year_month))
+                else:
+                    archive_filter, details = None, {}
+                    if number_of_records > 0 and identity_fields is not None:
+                        key_columns = [published_names[archive_schema][field] for field in identity_fields]
+                        key_index = build_key_index(site, archive_resource_id, key_columns, current_year_month, API_key)
+                        archive_filter = unarchived_filter(identity_fields, key_index)
+                    elif number_of_records > 0:
+                        details['note'] = "{} rows are already archived for {}, so this would also send a Slack alert.".format(number_of_records,current_year_month)
+                    prepare('cumulative_archive',archive_resource_name,archive_fields,truncate=False)
+                    insert('cumulative_archive',archive_resource_name,archive_schema,archive_filter,**details)
+
+            if 'monthly_archive' in finished:
+                skip('monthly_archive',month_archive_resource_name,"done by an earlier run")
+            else:
+                prepare('monthly_archive',month_archive_resource_name,archive_fields)
+                insert('monthly_archive',month_archive_resource_name,archive_schema)
+        return operations
+    finally:
+        os.remove(events_file_path)
+
+# The BigBurgh tables, in the order of their command-line file arguments:
+# (n, table, resource_designation, identity_fields)
+bigburgh_tables = [(spec['n'], table, spec['resource_designation'], spec['identity_fields'])
+                    for table, spec in table_registry.items()]
+
+def format_error():
+    # Format the exception currently being handled for printing and Slacking.
+    e = sys.exc_info()[0]
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+    traceback_msg = ''.join('!! ' + line for line in lines)
+    return e, traceback_msg
 
 def main(**kwargs):
     server = kwargs.pop('server', 'secret-cool-data') #'production')
+    mute_alerts = kwargs.get('mute_alerts',False)
+    failures = [] # (table, exception type, traceback message) for each table that failed
+    report.reset()
     try:
         fetch_files = kwargs.get('fetch_files',False)
-        # No primary key is used since we can't guarantee that there won't be collisions.
-        get_nth_file_and_insert(fetch_files,1,'events',key_fields = [], resource_designation = "Events", server = server, add_to_archive=True)
-        get_nth_file_and_insert(fetch_files,2,'safePlaces',key_fields = [], resource_designation = "Safe Places", server = server, add_to_archive = True)
-        get_nth_file_and_insert(fetch_files,3,'services',key_fields = [], resource_designation = "Services", server = server, add_to_archive=True)
+        streaming = kwargs.get('streaming',False) # Parse the exports without holding them in memory.
+        stream_download = kwargs.get('stream_download',False) # Parse the exports as they're downloaded.
+        keep_files = kwargs.get('keep_files',False) # Also save the streamed exports to disk (for debugging).
+        force = kwargs.get('force',False) # Publish even tables whose data hasn't changed.
+        full_reload = kwargs.get('full_reload',False) # Reload the current resources instead of sending only the changes.
+        local_files = kwargs.get('local_files',{}) # Maps tables to the local exports to use (without fetch_files).
+        tables = kwargs.get('tables',None) # The tables to process (by default, all of them)
+        update_current = kwargs.get('update_current',True) # False updates only the archives.
+        add_to_archive = kwargs.get('add_to_archive',True)
+        # The tables are almost entirely network-bound, so they are run
+        # concurrently (max_workers = 1 runs them one after another).
+        # Separately, ckan_parallelism limits how many of them may talk
+        # to the same CKAN server at once.
+        max_workers = kwargs.get('max_workers',len(bigburgh_tables))
+        set_ckan_parallelism(kwargs.get('ckan_parallelism',CKAN_PARALLELISM))
+        # batch_size (rows per request) turns on batched, parallel uploads.
+        set_upload_batching(kwargs.get('batch_size',UPLOAD_BATCH_SIZE),kwargs.get('upload_workers',UPLOAD_WORKERS))
+        # validation_processes (more than 1) loads the rows through the schemas in worker processes.
+        set_validation_processes(kwargs.get('validation_processes',VALIDATION_PROCESSES))
+        # Exports that fail the quality_thresholds (see data_profile.py) aren't published.
+        set_quality_thresholds(None if kwargs.get('skip_quality_checks',False) else kwargs.get('quality_thresholds',DEFAULT_THRESHOLDS))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # No primary key is used since we can't guarantee that there won't be collisions.
+            futures = {executor.submit(get_nth_file_and_insert, fetch_files, n, table, key_fields = [],
+                    resource_designation = resource_designation, server = server, add_to_archive = add_to_archive,
+                    streaming = streaming, force = force,
+                    stream_download = stream_download, keep_files = keep_files,
+                    local_file = local_files.get(table), update_current = update_current,
+                    identity_fields = None if full_reload else identity_fields): table
+                    for n, table, resource_designation, identity_fields in bigburgh_tables
+                    if tables is None or table in tables}
+            for future in as_completed(futures):
+                # Errors are collected per table, so that one failing table doesn't stop the others.
+                table = futures[future]
+                try:
+                    future.result()
+                except:
+                    e, traceback_msg = format_error()
+                    print("Error in the {} pipeline: {} : ".format(table,e))
+                    print(traceback_msg)  # Log it or whatever here
+                    failures.append((table, e, traceback_msg))
         # The main scheme for ensuring that no duplicate rows are archived is running the 
         # script once per month, but it's necessary to make sure that it actually runs successfully!
         
-        # Well, we got to the end of this block, so it seems like the script executed successfully.
+        # If no table failed, it seems like the script executed successfully.
         # Let's add a metadata tag to the package that indicates the last time the ETL script 
         # ran successfully:
 
         # extras metadata dictionary is implemented in CKAN 2.7:
         # extras['etl_last_successfully_run'] = datetime.now().isoformat()
     except:
-        e = sys.exc_info()[0]
+        e, traceback_msg = format_error()
         print("Error: {} : ".format(e))
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
-        traceback_msg = ''.join('!! ' + line for line in lines)
         print(traceback_msg)  # Log it or whatever here
-        msg = "snuffleupghus.py ran into an error: {}.\nHere's the traceback:\n{}".format(e,traceback_msg)
-        mute_alerts = kwargs.get('mute_alerts',False)
+        failures.append((None, e, traceback_msg))
+
+    # Write the machine-readable run report (and optionally print a summary).
+    report.add('server', server)
+    report.add('failures', [{'table': table, 'error': str(e)} for table, e, _ in failures])
+    report.write(kwargs.get('report_path', data_directory() + 'run-report.json'))
+    if kwargs.get('show_summary',False):
+        print(report.summary())
+
+    if len(failures) > 0:
+        # Send one Slack message covering every failure.
+        parts = []
+        for table, e, traceback_msg in failures:
+            where = "" if table is None else " (while processing {})".format(table)
+            parts.append("{}{}.\nHere's the traceback:\n{}".format(e,where,traceback_msg))
+        msg = "snuffleupghus.py ran into {} error{}: {}".format(len(failures), "" if len(failures) == 1 else "s", "\n".join(parts))
         if not mute_alerts:
             send_to_slack(msg,username='snuffleupghus',channel='@david',icon=':snuffleupagus:')
+    return failures
 
-if __name__ == '__main__':
+def describe_operation(op):
+    if op['action'] == 'skip':
+        text = "Skip {}: {}".format(op['resource'] or op['step'], op['reason'])
+    elif op['action'] == 'block':
+        text = "Blocked by the quality checks: {}".format(op['reason'])
+    elif op['action'] == 'insert':
+        text = "Insert {} rows (about {:.1f} kB) into {}".format(op['rows'], op['payload_bytes']/1024, op['resource'])
+    elif op['action'] == 'delete':
+        text = "Delete {} rows (under {} keys) from {}".format(op['rows'], op['keys'], op['resource'])
+    else:
+        descriptions = {'create': "Create the resource (and datastore)", 'create_datastore': "Create the datastore of",
+            'rebuild': "Rebuild the datastore (with new fields) of", 'clear': "Clear the datastore of"}
+        text = "{} {}".format(descriptions[op['action']], op['resource'])
+    if 'note' in op:
+        text += " ({})".format(op['note'])
+    return "{}: {}".format(op['table'], text)
+
+def plan(**kwargs):
+    # Work out what main would do with the same arguments (see plan_table),
+    # print the operations, and write out the plan as JSON (to plan_path,
+    # or else to standard output). Returns the plan.
+    server = kwargs.get('server', 'secret-cool-data')
+    fetch_files = kwargs.get('fetch_files',False)
+    force = kwargs.get('force',False)
+    full_reload = kwargs.get('full_reload',False)
+    local_files = kwargs.get('local_files',{})
+    tables = kwargs.get('tables',None)
+    update_current = kwargs.get('update_current',True)
+    add_to_archive = kwargs.get('add_to_archive',True)
+    set_upload_batching(kwargs.get('batch_size',UPLOAD_BATCH_SIZE),kwargs.get('upload_workers',UPLOAD_WORKERS))
+    set_quality_thresholds(None if kwargs.get('skip_quality_checks',False) else kwargs.get('quality_thresholds',DEFAULT_THRESHOLDS))
+    planned, failures = {}, []
+    with ThreadPoolExecutor(max_workers=kwargs.get('max_workers',len(bigburgh_tables))) as executor:
+        futures = {executor.submit(plan_table, fetch_files, n, table, resource_designation, server,
+                add_to_archive = add_to_archive, force = force, local_file = local_files.get(table),
+                update_current = update_current, identity_fields = None if full_reload else identity_fields): table
+                for n, table, resource_designation, identity_fields in bigburgh_tables
+                if tables is None or table in tables}
+        for future in as_completed(futures):
+            table = futures[future]
+            try:
+                planned[table] = future.result()
+            except:
+                e, traceback_msg = format_error()
+                print("Error while planning {}: {} : ".format(table,e))
+                print(traceback_msg)
+                failures.append({'table': table, 'error': str(e)})
+    operations = [op for _, table, _, _ in bigburgh_tables for op in planned.get(table, [])]
+    writes = [op for op in operations if op['action'] in WRITE_ACTIONS]
+    the_plan = {'created_at': datetime.now().isoformat(), 'server': server,
+        'year_month': datetime.strftime(datetime.now(),"%Y%m"),
+        'writes': len(writes), 'rows_to_send': sum(op['rows'] for op in writes if op['action'] == 'insert'),
+        'payload_bytes': sum(op['payload_bytes'] for op in writes),
+        'operations': operations, 'failures': failures}
+
+    print("============================================================")
+    for op in operations:
+        print(describe_operation(op))
+    if len(writes) == 0:
+        print("Nothing would be written to {}.".format(server))
+    else:
+        print("{} operations would send {} rows (about {:.1f} MB) to {}.".format(len(writes),the_plan['rows_to_send'],the_plan['payload_bytes']/1024**2,server))
+    if kwargs.get('plan_path') is not None:
+        write_json_atomically(kwargs['plan_path'], the_plan)
+        print("Wrote the plan to {}".format(kwargs['plan_path']))
+    else:
+        print(json.dumps(the_plan, indent=4))
+    return the_plan
+
+def fetch_command(args):
+    # Download the exports (for the parse and publish subcommands to use),
+    # recording the ETag and Last-Modified of each one next to it, so that
+    # publishing it saves them in the state. (They describe the file, not
+    # what any CKAN server has, so they aren't kept in the state or journal.)
+    for table in args.tables:
+        filepath = fetched_export_path(table)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # If there's already a copy, only download the export if it has
+        # changed since that copy was fetched.
+        validators = fetched_validators(table,file_hash(filepath)) if os.path.exists(filepath) else {}
+        downloaded = download_export(table, filepath, conditional_headers(validators))
+        if downloaded is None:
+            print("{} has not changed since {} was downloaded.".format(table,filepath))
+            continue
+        size, etag, last_modified = downloaded
+        print("Downloaded {} bytes of {} to {}".format(size,table,filepath))
+        write_json_atomically(fetched_validators_path(table),
+            {'content_hash': file_hash(filepath), 'etag': etag, 'last_modified': last_modified})
+    return 0
+
+def parse_command(args):
+    # Parse (and optionally validate) the exports, without touching CKAN.
+    failed = False
+    if args.validation_processes is not None:
+        set_validation_processes(args.validation_processes)
+    for table in args.tables:
+        filepath = getattr(args, table) or fetched_export_path(table)
+        if not os.path.exists(filepath):
+            print("There is no {} export at {}. (The fetch subcommand downloads it.)".format(table,filepath))
+            failed = True
+            continue
+        os.makedirs(os.path.join(os.path.dirname(filepath), 'tmp'), exist_ok=True)
+        digest = hashlib.sha256()
+        profile = table_profile(table)
+        start = time.time()
+        rows, headers, outputfilepath = parse_file(filepath, table, streaming=True, digest=digest, profile=profile)
+        print("{}: Parsed {} rows from {} into {} in {:.3f} seconds (digest {})".format(table,rows,filepath,outputfilepath,time.time()-start,digest.hexdigest()))
+        print(profile.summary())
+        problems = quality_problems(table,profile)
+        if len(problems) > 0:
+            print("{}: The export fails the quality checks: {}".format(table,"; ".join(problems)))
+            failed = True
+        if args.validate:
+            schema = schema_dict[table]
+            with open(outputfilepath, newline='', encoding='utf-8') as f:
+                try:
+                    validated = sum(1 for _ in transform_rows(schema, numbered_rows(f), 'line', tmp_file_description(outputfilepath)))
+                except ValueError as e:
+                    print("{}: {}".format(table,e))
+                    failed = True
+                    continue
+            print("{}: All {} rows loaded through {}".format(table,validated,schema.__name__))
+    return 1 if failed else 0
+
+def publish_command(args):
+    # Run the pipeline (the archive subcommand leaves the current resources alone).
+    local_files = {}
+    for table in args.tables:
+        if getattr(args, table) is not None:
+            local_files[table] = getattr(args, table)
+        elif os.path.exists(fetched_export_path(table)): # Left by the fetch subcommand
+            local_files[table] = fetched_export_path(table)
+    options = dict(fetch_files = args.fetch, server = args.server, mute_alerts = args.mute_alerts,
+        tables = args.tables, local_files = local_files, force = args.force, full_reload = args.full_reload,
+        streaming = args.streaming, stream_download = args.stream_download, keep_files = args.keep_files,
+        batch_size = args.batch_size, upload_workers = args.upload_workers, max_workers = args.max_workers,
+        validation_processes = args.validation_processes, skip_quality_checks = args.skip_quality_checks,
+        report_path = args.report, show_summary = args.summary,
+        update_current = args.command == 'publish',
+        add_to_archive = args.command == 'archive' or not args.current_only)
+    failures = main(**{key: value for key, value in options.items() if value is not None})
+    return 1 if len(failures) > 0 else 0
+
+def plan_command(args):
+    # Print what publishing would do (without writing anything to CKAN).
+    local_files = {}
+    for table in args.tables:
+        if getattr(args, table) is not None:
+            local_files[table] = getattr(args, table)
+        elif os.path.exists(fetched_export_path(table)):
+            local_files[table] = fetched_export_path(table)
+    options = dict(fetch_files = args.fetch, server = args.server, tables = args.tables, local_files = local_files,
+        force = args.force, full_reload = args.full_reload, batch_size = args.batch_size, plan_path = args.output,
+        skip_quality_checks = args.skip_quality_checks,
+        update_current = not args.archive_only, add_to_archive = not args.current_only)
+    the_plan = plan(**{key: value for key, value in options.items() if value is not None})
+    if len(the_plan['failures']) > 0:
+        return 1
+    return 2 if args.exit_code and the_plan['writes'] > 0 else 0
+
+def build_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog='snuffleupghus.py', description="Publish the BigBurgh exports to CKAN.")
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    def add_common_options(subparser, local_files=True):
+        subparser.add_argument('--tables', nargs='+', choices=list(table_registry), default=list(table_registry),
+            help="The tables to process (by default, all of them)")
+        if local_files:
+            for table in table_registry:
+                subparser.add_argument('--'+table, metavar='PATH', help="A local {} export to use".format(table))
+
+    fetch = subparsers.add_parser('fetch', help="Download the exports from bigburgh.com")
+    add_common_options(fetch, local_files=False)
+    fetch.set_defaults(run=fetch_command)
+
+    parse = subparsers.add_parser('parse', help="Parse the exports (without touching CKAN)")
+    add_common_options(parse)
+    parse.add_argument('--validate', action='store_true',
+        help="Also load the rows through the schemas (which imports marshmallow and wprdc-etl)")
+    parse.add_argument('--validation-processes', type=int, help="How many processes to load the rows through the schemas with")
+    parse.set_defaults(run=parse_command)
+
+    for name, description in [('publish', "Update the current resources and the archives"),
+                              ('archive', "Update only the archives")]:
+        publish = subparsers.add_parser(name, help=description)
+        add_common_options(publish)
+        publish.add_argument('--server', default='secret-cool-data', help="The server (in the settings file) to publish to")
+        publish.add_argument('--fetch', action='store_true', help="Download the exports instead of using local ones")
+        publish.add_argument('--mute-alerts', action='store_true', help="Don't send errors to Slack")
+        publish.add_argument('--force', action='store_true', help="Publish even tables whose data hasn't changed")
+        publish.add_argument('--full-reload', action='store_true', help="Reload the current resources instead of sending only the changes")
+        publish.add_argument('--streaming', action='store_true', help="Parse the exports without holding them in memory")
+        publish.add_argument('--stream-download', action='store_true', help="Parse the exports as they're downloaded")
+        publish.add_argument('--keep-files', action='store_true', help="Also save streamed exports to disk")
+        publish.add_argument('--batch-size', type=int, help="Send the rows in batches of this size (in parallel)")
+        publish.add_argument('--upload-workers', type=int, help="How many batches to send at once")
+        publish.add_argument('--max-workers', type=int, help="How many tables to process at once")
+        publish.add_argument('--validation-processes', type=int, help="How many processes to load the rows through the schemas with")
+        publish.add_argument('--skip-quality-checks', action='store_true', help="Publish even exports that fail the quality checks")
+        publish.add_argument('--report', metavar='PATH', help="Where to write the run report")
+        publish.add_argument('--summary', action='store_true', help="Print a summary of the run report")
+        if name == 'publish':
+            publish.add_argument('--current-only', action='store_true', help="Leave the archives alone")
+        publish.set_defaults(run=publish_command)
+
+    plan_parser = subparsers.add_parser('plan', help="Show what publish would do, without writing anything to CKAN")
+    add_common_options(plan_parser)
+    plan_parser.add_argument('--server', default='secret-cool-data', help="The server (in the settings file) to plan for")
+    plan_parser.add_argument('--fetch', action='store_true', help="Download the exports (for publish to use) instead of using local ones")
+    plan_parser.add_argument('--force', action='store_true', help="Plan to publish even tables whose data hasn't changed")
+    plan_parser.add_argument('--full-reload', action='store_true', help="Plan to reload the current resources instead of sending only the changes")
+    plan_parser.add_argument('--batch-size', type=int, help="The batch size to count upload requests with")
+    plan_parser.add_argument('--skip-quality-checks', action='store_true', help="Plan to publish even exports that fail the quality checks")
+    plan_parser.add_argument('--current-only', action='store_true', help="Leave the archives alone")
+    plan_parser.add_argument('--archive-only', action='store_true', help="Leave the current resources alone")
+    plan_parser.add_argument('--output', metavar='PATH', help="Where to write the plan as JSON (by default, it's printed)")
+    plan_parser.add_argument('--exit-code', action='store_true', help="Exit with status 2 if the plan would write anything to CKAN")
+    plan_parser.set_defaults(run=plan_command)
+    return parser
+
+def legacy_cli(argv):
+    # The original interface: fetch_files server [mute_alerts], where the
+    # arguments after fetch_files and server (starting with the one in the
+    # mute_alerts position) are taken as the local files of the tables.
     print(sys.argv)
-    if len(sys.argv) in [1,2]:
+    if len(argv) < 2:
         print("At a minimum, the fetch_files and server parameters must be specified as the first two command-line parameters.")
-    else:
-        fetch_files = (sys.argv[1].lower() == 'true')
-        mute_alerts = False
-        if len(sys.argv) > 3:
-            mute_alerts = bool(sys.argv[3])
-        main(fetch_files=fetch_files,server=sys.argv[2],mute_alerts=mute_alerts)
+        return
+    fetch_files = (argv[0].lower() == 'true')
+    mute_alerts = False
+    if len(argv) > 2:
+        mute_alerts = bool(argv[2])
+    local_files = {table: argv[n+1] for n, table, _, _ in bigburgh_tables if len(argv) > n+1}
+    main(fetch_files=fetch_files,server=argv[1],mute_alerts=mute_alerts,local_files=local_files)
+
+subcommands = ['fetch', 'parse', 'publish', 'archive', 'plan']
+
+def cli(argv):
+    if len(argv) > 0 and argv[0] not in subcommands and not argv[0].startswith('-'):
+        return legacy_cli(argv)
+    args = build_parser().parse_args(argv)
+    return args.run(args)
+
+if __name__ == '__main__':
+    sys.exit(cli(sys.argv[1:]))
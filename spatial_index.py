@@ -0,0 +1,182 @@
+import os, sys, csv, json, math, heapq
+from array import array
+
+EARTH_RADIUS_KM = 6371.0088
+DEFAULT_CELL_SIZE = 0.01 # In degrees (about a kilometer north-south, and less east-west, in Pittsburgh)
+INDEX_FORMAT = 'snuffleupghus-spatial-index'
+
+def haversine_km(latitude_1, longitude_1, latitude_2, longitude_2):
+    # The great-circle distance between two points, in kilometers.
+    phi_1, phi_2 = math.radians(latitude_1), math.radians(latitude_2)
+    d_phi = phi_2 - phi_1
+    d_lambda = math.radians(longitude_2 - longitude_1)
+    a = math.sin(d_phi/2)**2 + math.cos(phi_1)*math.cos(phi_2)*math.sin(d_lambda/2)**2
+    return 2*EARTH_RADIUS_KM*math.asin(min(1.0, math.sqrt(a)))
+
+class SpatialIndex:
+    """A compact grid index over the coordinates of the facilities in a
+    table, for finding the ones nearest to a point (nearest) or within a
+    given distance of it (within) without scanning every row.
+
+    The coordinates are kept in arrays of doubles, and each grid cell
+    (cell_size degrees on a side) holds an array of the positions of the
+    points that fall inside it, so a query only looks at the points in the
+    cells around it. Each point also has a label (the values of
+    label_fields, like the name and address of the facility), which is what
+    the queries return, along with the distances in kilometers.
+
+    An index is saved as a sidecar file (a JSON header line with the
+    labels, followed by the raw coordinate arrays) and the grid is rebuilt
+    when it's loaded."""
+
+    def __init__(self, latitudes, longitudes, labels, label_fields, cell_size=DEFAULT_CELL_SIZE):
+        self.latitudes = array('d', latitudes)
+        self.longitudes = array('d', longitudes)
+        self.labels = list(labels)
+        self.label_fields = list(label_fields)
+        self.cell_size = cell_size
+        if not len(self.latitudes) == len(self.longitudes) == len(self.labels):
+            raise ValueError("Every point needs a latitude, a longitude, and a label.")
+        self.cells = {}
+        for position, (latitude, longitude) in enumerate(zip(self.latitudes, self.longitudes)):
+            self.cells.setdefault(self.cell(latitude, longitude), array('L')).append(position)
+
+    @classmethod
+    def from_rows(cls, rows, label_fields, cell_size=DEFAULT_CELL_SIZE):
+        # Index rows (dicts with latitude and longitude values), skipping
+        # those without coordinates.
+        latitudes, longitudes, labels = array('d'), array('d'), []
+        for row in rows:
+            if row.get('latitude') in [None, ''] or row.get('longitude') in [None, '']:
+                continue
+            latitudes.append(float(row['latitude']))
+            longitudes.append(float(row['longitude']))
+            labels.append([row.get(field) for field in label_fields])
+        return cls(latitudes, longitudes, labels, label_fields, cell_size)
+
+    @classmethod
+    def from_csv(cls, filepath, label_fields, cell_size=DEFAULT_CELL_SIZE):
+        # Index the rows of a tmp CSV file.
+        with open(filepath, newline='', encoding='utf-8') as f:
+            return cls.from_rows(csv.DictReader(f), label_fields, cell_size)
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    def cell(self, latitude, longitude):
+        return (math.floor(latitude/self.cell_size), math.floor(longitude/self.cell_size))
+
+    def result(self, distance, position):
+        return distance, dict(zip(self.label_fields, self.labels[position]))
+
+    def within(self, latitude, longitude, radius_km):
+        # Return the (distance, label) pairs of all the points within
+        # radius_km of the given point, nearest first.
+        angle = radius_km/EARTH_RADIUS_KM
+        d_latitude = math.degrees(angle)
+        cos_latitude = math.cos(math.radians(latitude))
+        if angle >= math.pi/2 or math.sin(angle) >= cos_latitude: # The circle reaches a pole.
+            d_longitude = 180.0
+        else:
+            d_longitude = math.degrees(math.asin(math.sin(angle)/cos_latitude))
+        low_row, low_column = self.cell(latitude - d_latitude, longitude - d_longitude)
+        high_row, high_column = self.cell(latitude + d_latitude, longitude + d_longitude)
+        if (high_row - low_row + 1)*(high_column - low_column + 1) > len(self.cells):
+            # It's quicker to go through the occupied cells than all the ones in the box.
+            cells = [cell for cell in self.cells if low_row <= cell[0] <= high_row and low_column <= cell[1] <= high_column]
+        else:
+            cells = [(row, column) for row in range(low_row, high_row + 1) for column in range(low_column, high_column + 1)]
+        found = []
+        for cell in cells:
+            for position in self.cells.get(cell, ()):
+                distance = haversine_km(latitude, longitude, self.latitudes[position], self.longitudes[position])
+                if distance <= radius_km:
+                    found.append((distance, position))
+        found.sort()
+        return [self.result(distance, position) for distance, position in found]
+
+    def nearest(self, latitude, longitude, k=5):
+        # Return the (distance, label) pairs of the k points nearest to the
+        # given point, nearest first. Rings of cells are searched outward
+        # from the point's cell until no point outside the searched block
+        # could be closer than the kth-nearest point found so far. (Once
+        # the rings would cover more cells than are occupied, as happens
+        # far from the data, the remaining occupied cells are scanned.)
+        if k <= 0 or len(self) == 0:
+            return []
+        center = self.cell(latitude, longitude)
+        best = [] # A max-heap (by negated distance) of the k nearest points so far
+
+        def consider(positions):
+            for position in positions:
+                distance = haversine_km(latitude, longitude, self.latitudes[position], self.longitudes[position])
+                if len(best) < k:
+                    heapq.heappush(best, (-distance, position))
+                elif distance < -best[0][0]:
+                    heapq.heapreplace(best, (-distance, position))
+
+        ring = 0
+        while True:
+            if (2*ring + 1)**2 > len(self.cells):
+                for cell, positions in self.cells.items():
+                    if max(abs(cell[0] - center[0]), abs(cell[1] - center[1])) >= ring:
+                        consider(positions)
+                break
+            for cell in self.ring_cells(center, ring):
+                consider(self.cells.get(cell, ()))
+            if len(best) == k and -best[0][0] <= self.distance_outside(latitude, longitude, ring):
+                break
+            ring += 1
+        return [self.result(-negated, position) for negated, position in sorted(best, reverse=True)]
+
+    def ring_cells(self, center, ring):
+        # The cells exactly ring cells away from center (in rows or columns).
+        row, column = center
+        if ring == 0:
+            yield center
+            return
+        for c in range(column - ring, column + ring + 1):
+            yield (row - ring, c)
+            yield (row + ring, c)
+        for r in range(row - ring + 1, row + ring):
+            yield (r, column - ring)
+            yield (r, column + ring)
+
+    def distance_outside(self, latitude, longitude, ring):
+        # A lower bound on the distance from the given point to any point
+        # outside the block of cells within ring cells of its own.
+        row, column = self.cell(latitude, longitude)
+        south, north = (row - ring)*self.cell_size, (row + ring + 1)*self.cell_size
+        west, east = (column - ring)*self.cell_size, (column + ring + 1)*self.cell_size
+        d_latitude = math.radians(min(latitude - south, north - latitude))
+        d_longitude = math.radians(min(longitude - west, east - longitude, 90.0))
+        # The closest a point at that difference in longitude can be:
+        across = math.asin(math.cos(math.radians(latitude))*math.sin(d_longitude))
+        return EARTH_RADIUS_KM*min(d_latitude, across)
+
+    def save(self, filepath):
+        # Write the index out as a sidecar file (atomically).
+        header = {'format': INDEX_FORMAT, 'version': 1, 'byteorder': sys.byteorder,
+                  'cell_size': self.cell_size, 'count': len(self),
+                  'label_fields': self.label_fields, 'labels': self.labels}
+        os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+        temporary_path = filepath + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            self.latitudes.tofile(f)
+            self.longitudes.tofile(f)
+        os.replace(temporary_path, filepath)
+
+    @classmethod
+    def load(cls, filepath):
+        with open(filepath, 'rb') as f:
+            header = json.loads(f.readline().decode('utf-8'))
+            if header.get('format') != INDEX_FORMAT:
+                raise ValueError("{} is not a spatial index file.".format(filepath))
+            latitudes, longitudes = array('d'), array('d')
+            latitudes.fromfile(f, header['count'])
+            longitudes.fromfile(f, header['count'])
+        if header['byteorder'] != sys.byteorder:
+            latitudes.byteswap()
+            longitudes.byteswap()
+        return cls(latitudes, longitudes, header['labels'], header['label_fields'], header['cell_size'])
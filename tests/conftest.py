@@ -0,0 +1,72 @@
+import os, sys, json
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import snuffleupghus
+import benchmark
+from fake_ckan import FakeCKAN
+
+SERVER = 'fake' # The name of the fake CKAN server in the generated settings file
+OTHER_SERVER = 'production' # The name of a second one (see other_ckan)
+
+@pytest.fixture(autouse=True)
+def run_settings(monkeypatch):
+    # main (and the setters it calls) change these module-level settings,
+    # so they're put back after each test.
+    for name in ['UPLOAD_BATCH_SIZE', 'UPLOAD_WORKERS', 'UPLOAD_RETRIES', 'CKAN_PARALLELISM',
+                 'VALIDATION_PROCESSES', 'QUALITY_THRESHOLDS', 'BIGBURGH_URL']:
+        monkeypatch.setattr(snuffleupghus, name, getattr(snuffleupghus, name))
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # A scratch data directory (with the tmp directories that parsing and
+    # downloading write to), which is also the working directory.
+    (tmp_path / 'exports' / 'tmp').mkdir(parents=True)
+    (tmp_path / 'tmp' / 'tmp').mkdir(parents=True)
+    monkeypatch.setattr(snuffleupghus, 'DATA_PATH', str(tmp_path / 'data'))
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+@pytest.fixture
+def ckan(workdir, monkeypatch):
+    # A FakeCKAN, configured as the server SERVER in a settings file.
+    with FakeCKAN() as fake:
+        settings_path = workdir / 'settings.json'
+        settings_path.write_text(json.dumps({'loader': {SERVER: {'ckan_root_url': fake.site,
+            'package_id': fake.package_id, 'ckan_api_key': 'test'}}}))
+        monkeypatch.setattr(snuffleupghus, 'SETTINGS_FILE', str(settings_path))
+        yield fake
+
+@pytest.fixture
+def other_ckan(ckan, workdir):
+    # A second FakeCKAN, configured as the server OTHER_SERVER in the same settings file.
+    with FakeCKAN() as fake:
+        settings_path = workdir / 'settings.json'
+        settings = json.loads(settings_path.read_text())
+        settings['loader'][OTHER_SERVER] = {'ckan_root_url': fake.site,
+            'package_id': fake.package_id, 'ckan_api_key': 'test'}
+        settings_path.write_text(json.dumps(settings))
+        yield fake
+
+@pytest.fixture
+def exports(workdir):
+    # Write synthetic exports (with the real headers) and return their paths by table.
+    def write(rows, tables=None, seed=0):
+        paths = {}
+        for table in tables or snuffleupghus.table_registry:
+            paths[table] = str(workdir / 'exports' / (table + '.csv'))
+            benchmark.write_synthetic_export(table, paths[table], rows, seed)
+        return paths
+    return write
+
+@pytest.fixture
+def bigburgh(workdir, exports, monkeypatch):
+    # Serve a synthetic events export as bigburgh.com would (with Last-Modified and If-Modified-Since).
+    exports(300, ['events'])
+    httpd, base_url = benchmark.serve_directory(str(workdir / 'exports'))
+    monkeypatch.setattr(snuffleupghus, 'BIGBURGH_URL', base_url + '/{}.csv')
+    yield httpd
+    httpd.shutdown()
+
+def resource_named(ckan, name):
+    return next(r for r in ckan.resources.values() if r['name'] == name)
@@ -0,0 +1,34 @@
+import csv
+import snuffleupghus
+from conftest import SERVER, resource_named
+
+def test_a_new_month_alone_does_not_reload_the_current_resource(ckan, exports):
+    rows = 600
+    paths = exports(rows, ['events'])
+    assert snuffleupghus.main(local_files=paths, server=SERVER, mute_alerts=True, force=True, batch_size=250, tables=['events']) == []
+    current = resource_named(ckan, "Current List of Events")
+    assert ckan.rows_received[current['id']] == rows
+
+    # Make the published snapshot look like it was made last month.
+    snapshot = snuffleupghus.snapshot_path('events', snuffleupghus.publishing_target(SERVER))
+    with open(snapshot, newline='') as f:
+        snapshot_rows = list(csv.DictReader(f))
+    for row in snapshot_rows:
+        row['year_month'] = '190001'
+    with open(snapshot, 'w', newline='') as f:
+        writer = csv.DictWriter(f, list(snapshot_rows[0]), lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(snapshot_rows)
+
+    assert snuffleupghus.main(local_files=paths, server=SERVER, mute_alerts=True, force=True, batch_size=250, tables=['events']) == []
+    assert ckan.rows_received[current['id']] == rows # Nothing was resent.
+    assert len(current['_records']) == rows
+
+def test_changed_rows_are_replaced(ckan, exports):
+    paths = exports(600, ['events'])
+    assert snuffleupghus.main(local_files=paths, server=SERVER, mute_alerts=True, force=True, batch_size=250, tables=['events']) == []
+    paths = exports(650, ['events']) # The same rows, plus 50 new ones
+    assert snuffleupghus.main(local_files=paths, server=SERVER, mute_alerts=True, force=True, batch_size=250, tables=['events']) == []
+    current = resource_named(ckan, "Current List of Events")
+    assert ckan.rows_received[current['id']] == 650
+    assert len(current['_records']) == 650
@@ -0,0 +1,23 @@
+import argparse
+import snuffleupghus
+from conftest import SERVER
+
+def test_publishing_a_fetched_export_saves_its_validators(ckan, bigburgh, capsys):
+    args = argparse.Namespace(tables=['events'])
+    assert snuffleupghus.fetch_command(args) == 0
+    local_files = {'events': snuffleupghus.fetched_export_path('events')}
+    assert snuffleupghus.main(local_files=local_files, server=SERVER, mute_alerts=True, batch_size=250, tables=['events']) == []
+    state = snuffleupghus.table_state('events', snuffleupghus.publishing_target(SERVER))
+    assert state['last_modified'] is not None
+
+    # Fetching again asks whether the export has changed since it was fetched.
+    capsys.readouterr()
+    assert snuffleupghus.fetch_command(args) == 0
+    assert "events has not changed" in capsys.readouterr().out
+    assert snuffleupghus.fetched_validators('events', snuffleupghus.file_hash(local_files['events']))['last_modified'] == state['last_modified']
+
+def test_publishing_without_an_export_fails(ckan):
+    failures = snuffleupghus.main(local_files={}, server=SERVER, mute_alerts=True, tables=['events'])
+    (table, e, traceback_msg), = failures
+    assert table == 'events' and e is ValueError
+    assert "There is no events export" in traceback_msg
@@ -0,0 +1,43 @@
+import snuffleupghus
+from conftest import SERVER, OTHER_SERVER, resource_named
+
+def publish_rows(exports, start, stop, server=SERVER):
+    # Publish rows start to stop (of a synthetic export) of the events table.
+    path = exports(stop, ['events'])['events']
+    with open(path) as f:
+        lines = f.readlines()
+    with open(path, 'w') as f:
+        f.writelines(lines[:2] + lines[2+start:])
+    assert snuffleupghus.main(local_files={'events': path}, server=server, mute_alerts=True, force=True, batch_size=250, tables=['events']) == []
+
+def archived_history(ckan, server=SERVER):
+    # The number of rows in the cumulative archive and in the local history for this month.
+    archive = resource_named(ckan, "Events Archive (Cumulative)")
+    history = snuffleupghus.local_history(snuffleupghus.publishing_target(server))
+    year_month, = history.months('events')
+    return len(archive['_records']), history.count('events', year_month)
+
+def test_archived_rows_are_added_to_the_history(ckan, exports):
+    publish_rows(exports, 0, 600)
+    assert archived_history(ckan) == (600, 600)
+    publish_rows(exports, 300, 1000) # 400 rows that aren't archived yet
+    assert archived_history(ckan) == (1000, 1000)
+
+def test_history_is_kept_when_the_archive_is_skipped(ckan, exports):
+    publish_rows(exports, 0, 600)
+    # The archive already has as many rows as this export, so it's skipped
+    # (without finding out which rows are there).
+    publish_rows(exports, 300, 900)
+    assert archived_history(ckan) == (600, 600)
+    history = snuffleupghus.local_history(snuffleupghus.publishing_target(SERVER))
+    year_month, = history.months('events')
+    names = history.columns('events', year_month, ['event_name'])['event_name']
+    assert names[0] == 'Event 0' # (Rather than the first row of the second export)
+
+def test_another_servers_history_does_not_skip_the_archive(ckan, other_ckan, exports):
+    publish_rows(exports, 0, 400)
+    publish_rows(exports, 400, 700, OTHER_SERVER)
+    # The first 400 rows are in the first server's archive, but not in this one.
+    publish_rows(exports, 0, 400, OTHER_SERVER)
+    assert archived_history(ckan) == (400, 400)
+    assert archived_history(other_ckan, OTHER_SERVER) == (700, 700)
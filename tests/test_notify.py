@@ -0,0 +1,57 @@
+import json, socket, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import notify
+
+class StubSlack(BaseHTTPRequestHandler):
+    # A webhook that records each post, answering with the queued statuses (then 200).
+    def do_POST(self):
+        self.server.posts.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+def unused_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+@pytest.fixture
+def slack():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StubSlack)
+    httpd.posts, httpd.statuses = [], []
+    httpd.url = 'http://127.0.0.1:{}/'.format(httpd.server_address[1])
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+
+def test_a_burst_of_messages_goes_out_as_one_post(slack):
+    notifier = notify.SlackNotifier(slack.url, coalesce_seconds=0.5, min_interval=0)
+    for number in range(3):
+        assert notifier.send("Message {}".format(number), channel='@david')
+    assert notifier.flush(5)
+    post, = slack.posts
+    assert post['channel'] == '@david'
+    assert post['text'].startswith("3 messages:")
+    assert all("Message {}".format(number) in post['text'] for number in range(3))
+
+def test_a_rate_limited_post_is_retried(slack):
+    slack.statuses = [429]
+    notifier = notify.SlackNotifier(slack.url, coalesce_seconds=0, min_interval=0)
+    notifier.send("Retry me")
+    assert notifier.flush(5)
+    assert len(slack.posts) == 2
+    assert slack.posts[0] == slack.posts[1]
+
+def test_an_unreachable_webhook_does_not_raise(monkeypatch):
+    monkeypatch.setattr(notify.time, 'sleep', lambda seconds: None)
+    notifier = notify.SlackNotifier('http://127.0.0.1:{}/'.format(unused_port()), coalesce_seconds=0,
+        min_interval=0, max_attempts=2)
+    assert notifier.send("Nobody is listening")
+    assert not notifier.flush(5)
+    assert notifier.flush(5) # Nothing has been sent (or lost) since.
@@ -0,0 +1,24 @@
+import snuffleupghus
+
+# An events export with headers in the style of bigburgh.com's
+TITLE_CASE_EXPORT = """sep=|
+Event Name|Recurring, One-Time or One-on-One?|Program (Facility) Name|Program Neighborhood|Program Address|Program Lat and Long|Organization Name|Category One|Category Two|(Event) Recommended For :|(Event) Requirements|Event Phone|Event Narrative|Schedule|Holiday Exception
+Free Lunch|Recurring|Community Kitchen|Oakland|1 Main St|Latitude: 40.44, Longitude: -79.99|Helping Hands|Food|Health|Everyone|None|412-555-0001|"Lunch, served daily"|Noon|Closed on holidays
+Job Fair|One-Time|Library|Downtown|2 Main St|Latitude: 40.44, Longitude: -80.00|City|Work||Adults||412-555-0002|Bring a resume|9 AM|
+"""
+
+def test_title_case_headers_are_renamed_like_the_extractor_does():
+    shelf, headers = snuffleupghus.parse_lines(TITLE_CASE_EXPORT.splitlines(True), None, year_month='202601', profile=snuffleupghus.table_profile('events'))
+    assert headers[0] == 'Event Name'
+    assert set(shelf.headers) == {field for field, _, _ in snuffleupghus.table_registry['events']['fields']} | {'year_month'}
+    first, second = shelf.dicts()
+    assert (first['event_name'], first['latitude'], first['longitude'], first['category']) == ('Free Lunch', '40.44', '-79.99', 'Food|Health')
+    assert (second['longitude'], second['category']) == ('-80.0', 'Work')
+    identity_fields = snuffleupghus.table_registry['events']['identity_fields']
+    _, keyed = snuffleupghus.key_rows(shelf.headers, shelf, identity_fields)
+    assert ('Job Fair', 'Library', '2 Main St') in keyed
+
+def test_title_case_headers_pass_the_quality_checks():
+    profile = snuffleupghus.table_profile('events')
+    snuffleupghus.parse_lines(TITLE_CASE_EXPORT.splitlines(True), None, profile=profile)
+    assert snuffleupghus.quality_problems('events', profile) == []
@@ -0,0 +1,37 @@
+import os, copy
+import snuffleupghus
+from conftest import SERVER, resource_named
+
+READ_ONLY_ACTIONS = {'package_show', 'resource_show', 'datastore_search', 'datastore_search_sql'}
+
+def data_files(workdir):
+    # The contents of everything under the data directory (the state, the
+    # journal, the snapshots and the local history).
+    contents = {}
+    for directory, _, filenames in os.walk(str(workdir / 'data')):
+        for filename in filenames:
+            with open(os.path.join(directory, filename), 'rb') as f:
+                contents[os.path.join(directory, filename)] = f.read()
+    return contents
+
+def planned(ckan, workdir, paths):
+    ckan.calls.clear()
+    resources, received, files = copy.deepcopy(ckan.resources), dict(ckan.rows_received), data_files(workdir)
+    the_plan = snuffleupghus.plan(local_files=paths, server=SERVER, batch_size=250, tables=['events'],
+        plan_path=str(workdir / 'plan.json'))
+    assert set(ckan.calls) <= READ_ONLY_ACTIONS
+    assert ckan.resources == resources and dict(ckan.rows_received) == received
+    assert data_files(workdir) == files
+    return the_plan
+
+def test_plan_mode_only_reads_from_ckan(ckan, exports, workdir):
+    paths = exports(300, ['events'])
+    first_plan = planned(ckan, workdir, paths) # Nothing has been published yet.
+    assert first_plan['failures'] == [] and first_plan['writes'] > 0
+    assert snuffleupghus.main(local_files=paths, server=SERVER, mute_alerts=True, batch_size=250, tables=['events']) == []
+    changed_paths = exports(350, ['events'])
+    second_plan = planned(ckan, workdir, changed_paths) # Working out the changes since the last run.
+    assert second_plan['failures'] == [] and second_plan['writes'] > 0
+    assert len(ckan.calls) > 0
+    current = resource_named(ckan, "Current List of Events")
+    assert len(current['_records']) == 300
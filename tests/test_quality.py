@@ -0,0 +1,40 @@
+import pytest
+import snuffleupghus
+from data_profile import DataProfile
+
+def test_empty_coordinates_are_malformed():
+    malformed = []
+    latitudes, longitudes = snuffleupghus.parse_coordinates(['Latitude: , Longitude: ',
+        'Latitude: 40.44, Longitude: -79.99', '', None], malformed)
+    assert (latitudes, longitudes) == ([None, 40.44, None, None], [None, -79.99, None, None])
+    assert malformed == ['Latitude: , Longitude: ', '']
+    for value in ['Latitude: , Longitude: ', '']:
+        with pytest.raises(ValueError, match="Unable to parse the coordinates"):
+            snuffleupghus.parse_coordinates([value])
+
+def test_only_services_tolerates_a_double_comma():
+    value = 'Latitude: 40.44,, Longitude: -79.99'
+    services_pattern = snuffleupghus.coordinates_pattern('services')
+    assert snuffleupghus.parse_coordinates([value], pattern=services_pattern) == ([40.44], [-79.99])
+    for table in ['events', 'safePlaces']:
+        malformed = []
+        snuffleupghus.parse_coordinates([value], malformed, snuffleupghus.coordinates_pattern(table))
+        assert malformed == [value]
+
+def test_only_what_parsing_rejected_is_blocked_by_default():
+    profile = DataProfile('event_name')
+    assert snuffleupghus.quality_problems('events', profile) == [] # No rows at all
+    for number in range(10): # Most rows lack coordinates, the rest are far away, and one has no name.
+        profile.add({'event_name': "Event {}".format(number) if number > 0 else '',
+            'latitude': '0.0' if number < 3 else None, 'longitude': '0.0' if number < 3 else None})
+    assert snuffleupghus.quality_problems('events', profile) == []
+    profile.malformed_coordinates.append('Latitude: , Longitude: ')
+    problems = snuffleupghus.quality_problems('events', profile)
+    assert len(problems) == 1 and 'malformed coordinates' in problems[0]
+
+def test_the_other_checks_can_be_turned_on():
+    snuffleupghus.set_quality_thresholds({'min_rows': 1, 'empty_name_fraction': 0})
+    profile = DataProfile('event_name')
+    assert snuffleupghus.quality_problems('events', profile) == ["only 0 rows (the minimum is 1)"]
+    profile.add({'event_name': '', 'latitude': None, 'longitude': None})
+    assert snuffleupghus.quality_problems('events', profile) == ["100.0% of the rows have no event_name"]
@@ -0,0 +1,49 @@
+import snuffleupghus
+from conftest import SERVER, OTHER_SERVER, resource_named
+
+def publish(paths, server=SERVER, **kwargs):
+    return snuffleupghus.main(local_files=paths, server=server, mute_alerts=True, batch_size=250, tables=['events'], **kwargs)
+
+def interrupted(monkeypatch, paths, server=SERVER, **kwargs):
+    # Publish, failing after the uploads (while the spatial index is built).
+    def fail(*args, **kwargs):
+        raise RuntimeError("Interrupted")
+    with monkeypatch.context() as m:
+        m.setattr(snuffleupghus.SpatialIndex, 'from_rows', fail)
+        (table, _, _), = publish(paths, server, **kwargs)
+    assert table == 'events'
+
+def journaled_steps(server=SERVER):
+    year_month = snuffleupghus.datetime.now().strftime("%Y%m")
+    steps, _ = snuffleupghus.finished_steps('events', snuffleupghus.publishing_target(server), year_month)
+    return steps
+
+def test_a_resumed_run_skips_the_finished_steps(ckan, exports, monkeypatch):
+    paths = exports(300, ['events'])
+    interrupted(monkeypatch, paths)
+    assert {'parse', 'current', 'cumulative_archive', 'monthly_archive'} <= set(journaled_steps())
+    received = dict(ckan.rows_received)
+    assert publish(paths) == []
+    assert ckan.rows_received == received # Nothing was sent again.
+    assert journaled_steps() == {}
+    target = snuffleupghus.publishing_target(SERVER)
+    assert 'digest' in snuffleupghus.table_state('events', target)
+    assert len(resource_named(ckan, "Events Archive (Cumulative)")['_records']) == 300
+
+def test_another_servers_unfinished_run_is_not_resumed(ckan, other_ckan, exports, monkeypatch):
+    paths = exports(300, ['events'])
+    interrupted(monkeypatch, paths)
+    assert journaled_steps(OTHER_SERVER) == {}
+    assert publish(paths, OTHER_SERVER) == []
+    year_month = snuffleupghus.datetime.now().strftime("%Y-%m")
+    for name in ["Current List of Events", "Events Archive (Cumulative)", "{} Events Archive".format(year_month)]:
+        assert len(resource_named(other_ckan, name)['_records']) == 300, name
+
+def test_a_streamed_download_can_resume_a_local_files_parse(ckan, bigburgh, exports, monkeypatch):
+    paths = exports(300, ['events']) # The same export that bigburgh serves
+    interrupted(monkeypatch, paths, keep_files=True)
+    assert 'download' not in journaled_steps()
+    assert snuffleupghus.main(fetch_files=True, stream_download=True, server=SERVER, mute_alerts=True,
+        batch_size=250, tables=['events']) == []
+    state = snuffleupghus.table_state('events', snuffleupghus.publishing_target(SERVER))
+    assert state['etag'] is None and state['last_modified'] is None
@@ -0,0 +1,61 @@
+import socket
+import ckanapi
+import pytest
+import requests
+import snuffleupghus
+
+class FlakyAction:
+    # Stands in for ckan.action, raising the given exceptions (in order)
+    # before succeeding.
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.calls = 0
+
+    def datastore_upsert(self, **kwargs):
+        self.calls += 1
+        if len(self.failures) > 0:
+            raise self.failures.pop(0)
+        return {}
+
+class FlakyCKAN:
+    def __init__(self, failures):
+        self.action = FlakyAction(failures)
+
+@pytest.fixture(autouse=True)
+def no_sleeping(monkeypatch):
+    monkeypatch.setattr(snuffleupghus.time, 'sleep', lambda seconds: None)
+
+def refused_connection():
+    # A real error from connecting to a local port that nothing listens on
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    try:
+        requests.post('http://127.0.0.1:{}/api/action/datastore_upsert'.format(port), timeout=5)
+    except requests.ConnectionError as e:
+        return e
+
+def test_unsent_inserts_are_retried():
+    ckan = FlakyCKAN([refused_connection(), requests.exceptions.ConnectTimeout()])
+    assert snuffleupghus._send_batch(ckan, 'resource', [{'a': 1}], 'insert', 1, 3) == 1
+    assert ckan.action.calls == 3
+
+@pytest.mark.parametrize('error', [requests.exceptions.ReadTimeout(), ckanapi.CKANAPIError('502 Bad Gateway'),
+                                   requests.ConnectionError('Connection aborted.')])
+def test_inserts_that_may_have_gone_through_are_not_retried(error):
+    ckan = FlakyCKAN([error])
+    with pytest.raises(type(error)):
+        snuffleupghus._send_batch(ckan, 'resource', [{'a': 1}], 'insert', 1, 3)
+    assert ckan.action.calls == 1
+
+@pytest.mark.parametrize('error', [ckanapi.NotAuthorized(), ckanapi.NotFound(), ckanapi.ValidationError({})])
+def test_hopeless_batches_fail_at_once(error):
+    ckan = FlakyCKAN([error])
+    with pytest.raises(type(error)):
+        snuffleupghus._send_batch(ckan, 'resource', [{'a': 1}], 'upsert', 1, 3)
+    assert ckan.action.calls == 1
+
+def test_upserts_are_retried():
+    ckan = FlakyCKAN([requests.exceptions.ReadTimeout(), ckanapi.CKANAPIError('502 Bad Gateway')])
+    assert snuffleupghus._send_batch(ckan, 'resource', [{'a': 1}], 'upsert', 1, 3) == 1
+    assert ckan.action.calls == 3
@@ -0,0 +1,13 @@
+import snuffleupghus
+import benchmark
+
+def test_a_shelf_holds_rows_in_less_memory_than_dicts(exports):
+    rows = 20000
+    path = exports(rows, ['events'])['events']
+    _, _, tmp_path = snuffleupghus.parse_file(path, 'events', streaming=True)
+    results = {}
+    shelf = benchmark.measured(results, 'shelf memory', lambda: snuffleupghus.parse_file(path, 'events')[0])
+    dicts = benchmark.measured(results, 'dict rows memory', benchmark.dict_rows, tmp_path)
+    assert len(shelf) == len(dicts) == rows
+    assert list(shelf.dicts()) == dicts
+    assert results['shelf memory'] < 0.75*results['dict rows memory'], results
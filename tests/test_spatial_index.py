@@ -0,0 +1,57 @@
+import random
+import pytest
+from spatial_index import SpatialIndex, haversine_km
+
+def random_index(count=2000, seed=0, cell_size=0.01):
+    # Points scattered over Pittsburgh, with a few clumps and a few far away.
+    rng = random.Random(seed)
+    latitudes, longitudes, labels = [], [], []
+    for i in range(count):
+        if i % 10 == 0:
+            latitude, longitude = 40.44 + rng.gauss(0, 0.001), -79.99 + rng.gauss(0, 0.001)
+        elif i % 250 == 0:
+            latitude, longitude = rng.uniform(-60, 60), rng.uniform(-180, 180)
+        else:
+            latitude, longitude = rng.uniform(40.36, 40.50), rng.uniform(-80.09, -79.86)
+        latitudes.append(latitude)
+        longitudes.append(longitude)
+        labels.append(["Place {}".format(i), "{} Main St".format(i)])
+    return SpatialIndex(latitudes, longitudes, labels, ['name', 'address'], cell_size)
+
+def brute_force(index, latitude, longitude):
+    # The (distance, name) pairs of all the points, nearest first.
+    return sorted((haversine_km(latitude, longitude, point_latitude, point_longitude), label[0])
+        for point_latitude, point_longitude, label in zip(index.latitudes, index.longitudes, index.labels))
+
+QUERIES = [(40.44, -79.99), (40.4405, -79.9895), (40.37, -80.08), (40.55, -79.70), (40.0, -75.0), (-33.9, 151.2), (89.9, 10.0)]
+
+def assert_same_results(results, expected):
+    assert [distance for distance, _ in results] == pytest.approx([distance for distance, _ in expected])
+    assert sorted(label['name'] for _, label in results) == sorted(name for _, name in expected)
+
+@pytest.mark.parametrize('cell_size', [0.01, 0.002, 1.0])
+def test_nearest_and_within_match_brute_force(cell_size):
+    index = random_index(cell_size=cell_size)
+    for latitude, longitude in QUERIES:
+        everything = brute_force(index, latitude, longitude)
+        for k in [1, 5, 50]:
+            assert_same_results(index.nearest(latitude, longitude, k), everything[:k])
+        for radius_km in [0.1, 1.0, 5.0, 500.0]:
+            assert_same_results(index.within(latitude, longitude, radius_km),
+                [(distance, name) for distance, name in everything if distance <= radius_km])
+    assert index.nearest(40.44, -79.99, 0) == []
+    assert len(index.nearest(40.44, -79.99, len(index) + 10)) == len(index)
+
+def test_an_index_survives_the_sidecar_round_trip(tmp_path):
+    index = random_index(count=500)
+    path = str(tmp_path / 'indexes' / 'events.index')
+    index.save(path)
+    loaded = SpatialIndex.load(path)
+    assert (list(loaded.latitudes), list(loaded.longitudes)) == (list(index.latitudes), list(index.longitudes))
+    assert (loaded.labels, loaded.label_fields, loaded.cell_size) == (index.labels, index.label_fields, index.cell_size)
+    for latitude, longitude in QUERIES:
+        assert loaded.nearest(latitude, longitude, 10) == index.nearest(latitude, longitude, 10)
+        assert loaded.within(latitude, longitude, 2.0) == index.within(latitude, longitude, 2.0)
+    (tmp_path / 'not-an-index').write_text('{"format": "something else"}\n')
+    with pytest.raises(ValueError, match="is not a spatial index file"):
+        SpatialIndex.load(str(tmp_path / 'not-an-index'))
@@ -0,0 +1,30 @@
+import snuffleupghus
+from conftest import SERVER, OTHER_SERVER, resource_named
+
+def publish(paths, server, **kwargs):
+    assert snuffleupghus.main(local_files=paths, server=server, mute_alerts=True, batch_size=250, tables=['events'], **kwargs) == []
+
+def resource_rows(ckan):
+    year_month = snuffleupghus.datetime.now().strftime("%Y-%m")
+    return [len(resource_named(ckan, name)['_records']) for name in
+        ["Current List of Events", "Events Archive (Cumulative)", "{} Events Archive".format(year_month)]]
+
+def test_publishing_to_one_server_does_not_skip_another(ckan, other_ckan, exports):
+    paths = exports(300, ['events'])
+    publish(paths, SERVER)
+    publish(paths, OTHER_SERVER)
+    assert resource_rows(ckan) == resource_rows(other_ckan) == [300, 300, 300]
+    # Each server's state now says the rows were published there.
+    other_calls = other_ckan.calls['datastore_upsert']
+    publish(paths, OTHER_SERVER)
+    assert other_ckan.calls['datastore_upsert'] == other_calls
+
+def test_changes_are_worked_out_against_each_servers_snapshot(ckan, other_ckan, exports):
+    paths = exports(600, ['events'])
+    publish(paths, SERVER)
+    publish(paths, OTHER_SERVER)
+    publish(exports(650, ['events']), SERVER) # Only the first server gets the new rows.
+    current = resource_named(other_ckan, "Current List of Events")
+    received = other_ckan.rows_received[current['id']]
+    publish(exports(600, ['events']), OTHER_SERVER, force=True)
+    assert other_ckan.rows_received[current['id']] == received # Nothing changed there.
@@ -0,0 +1,44 @@
+import os, math
+import snuffleupghus
+from conftest import SERVER, resource_named
+
+def test_clear_and_upload_sends_each_row_once(ckan, exports):
+    rows = 1100
+    path = exports(rows, ['events'])['events']
+    snuffleupghus.set_upload_batching(400)
+    _, _, target = snuffleupghus.parse_file(path, 'events', streaming=True)
+    kwparams = dict(target = target, update_method = 'insert', schema = snuffleupghus.schema_dict['events'],
+        fields_to_publish = snuffleupghus.ckan_fields['events'], key_fields = [],
+        resource_name = 'Current List of Events', server = SERVER)
+    for run in [1, 2]: # The second run replaces the rows rather than adding to them.
+        resource_id = snuffleupghus.clear_and_upload(kwparams)
+        assert ckan.rows_received[resource_id] == run*rows
+        assert len(ckan.resources[resource_id]['_records']) == rows
+        assert ckan.calls['datastore_upsert'] == run*math.ceil(rows/400)
+
+def test_main_sends_each_row_once_to_each_resource(ckan, exports):
+    rows, batch_size = 1200, 500
+    paths = exports(rows)
+    failures = snuffleupghus.main(local_files=paths, server=SERVER, mute_alerts=True, force=True, batch_size=batch_size)
+    assert failures == []
+    year_month = snuffleupghus.datetime.now().strftime("%Y-%m")
+    resource_names = []
+    for _, table, designation, _ in snuffleupghus.bigburgh_tables:
+        resource_names += ["Current List of {}".format(designation),
+                           "{} Archive (Cumulative)".format(designation),
+                           "{} {} Archive".format(year_month, designation)]
+    for name in resource_names:
+        resource = resource_named(ckan, name)
+        assert ckan.rows_received[resource['id']] == rows, name
+        assert len(resource['_records']) == rows, name
+    assert ckan.calls['datastore_upsert'] == len(resource_names)*math.ceil(rows/batch_size)
+
+def test_fanned_out_rows_stay_in_memory(ckan, exports, workdir):
+    rows = 300
+    paths = exports(rows)
+    for run in [1, 2]: # The second run finds its rows unchanged in the snapshot written from the shelf.
+        failures = snuffleupghus.main(local_files=paths, server=SERVER, mute_alerts=True, force=True, batch_size=200)
+        assert failures == []
+        assert sorted(os.listdir(workdir / 'exports' / 'tmp')) == []
+        resource = resource_named(ckan, "Current List of Events")
+        assert ckan.rows_received[resource['id']] == rows
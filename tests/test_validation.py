@@ -0,0 +1,72 @@
+import csv
+import pytest
+import snuffleupghus
+
+def parsed_with_bad_rows(exports, rows, bad_rows):
+    # Parse a synthetic events export and give the rows at the bad_rows
+    # positions of the tmp file an unloadable latitude.
+    path = exports(rows, ['events'])['events']
+    _, _, tmp_path = snuffleupghus.parse_file(path, 'events', streaming=True)
+    with open(tmp_path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    for position in bad_rows:
+        rows[position]['latitude'] = 'north'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, list(rows[0]), lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+    return path, tmp_path
+
+def validated(tmp_path, records=None):
+    # Load the tmp file through the events schema, collecting the records in records.
+    records = [] if records is None else records
+    with open(tmp_path, newline='') as f:
+        for record in snuffleupghus.transform_rows(snuffleupghus.schema_dict['events'], snuffleupghus.numbered_rows(f),
+                'line', snuffleupghus.tmp_file_description(tmp_path)):
+            records.append(record)
+    return records
+
+@pytest.fixture
+def validation_pool(monkeypatch):
+    # Two validation processes, with small chunks (so that there are more
+    # chunks than the pool has in flight).
+    monkeypatch.setattr(snuffleupghus, 'VALIDATION_CHUNK_SIZE', 250)
+    snuffleupghus.set_validation_processes(2)
+    yield
+    snuffleupghus.set_validation_processes(None)
+
+def test_load_errors_name_the_tmp_file(exports):
+    _, tmp_path = parsed_with_bad_rows(exports, 10, [4])
+    with pytest.raises(ValueError) as raised:
+        validated(tmp_path)
+    assert str(raised.value).startswith("Line 6 of the parsed (comma-delimited) file {} could not be loaded".format(tmp_path))
+
+def test_the_validation_processes_keep_the_rows_in_order(exports, validation_pool):
+    _, tmp_path = parsed_with_bad_rows(exports, 3000, [])
+    records = validated(tmp_path)
+    snuffleupghus.set_validation_processes(None)
+    assert records == validated(tmp_path)
+    assert [record['event_name'] for record in records[:3]] == ['Event 0', 'Event 1', 'Event 2']
+    assert len(records) == 3000
+
+def test_the_validation_processes_report_the_bad_rows(exports, validation_pool):
+    _, tmp_path = parsed_with_bad_rows(exports, 3000, [1300, 1420, 2900])
+    records = []
+    with pytest.raises(ValueError) as raised:
+        validated(tmp_path, records)
+    # Like the serial loading, the records before the first bad row come
+    # out, and then every bad row in its chunk is described.
+    assert len(records) == 1300
+    assert str(raised.value).startswith("2 rows of the parsed (comma-delimited) file {} could not be loaded through EventsSchema: "
+        "line 1302: ".format(tmp_path))
+    assert "; line 1422: " in str(raised.value) and "line 2902" not in str(raised.value)
+    snuffleupghus.set_validation_processes(None)
+    serial_records = []
+    with pytest.raises(ValueError, match="Line 1302 of the parsed"):
+        validated(tmp_path, serial_records)
+    assert serial_records == records
+
+def test_parse_validates_with_a_process_pool(exports, validation_pool, capsys):
+    path = exports(1000, ['events'])['events']
+    assert snuffleupghus.cli(['parse', '--tables', 'events', '--events', path, '--validate', '--validation-processes', '2']) == 0
+    assert "events: All 1000 rows loaded through EventsSchema" in capsys.readouterr().out